@@ -0,0 +1,90 @@
+"""
+Measure how much space compressing stored message bodies saves, and what it
+costs in CPU time per message, for a few typical kinds of message.
+
+Run from the repository root::
+
+    python benchmarks/compression.py [repeat]
+
+The zstd rows are only included if the ``zstandard`` package is installed.
+
+"""
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from django.conf import settings
+if not settings.configured and not os.environ.get('DJANGO_SETTINGS_MODULE'):
+    settings.configure(
+        DATABASES={'default': {'ENGINE': 'django.db.backends.sqlite3',
+                               'NAME': ':memory:'}},
+        INSTALLED_APPS=('django_mailer',),
+    )
+
+from django.core import mail
+from django_mailer import compression
+
+
+WORDS = ('your order has shipped and will arrive within three business days '
+         'thank you for shopping with us please contact support if anything '
+         'is wrong').split()
+
+
+def text(words, seed=0):
+    generator = random.Random(seed)
+    return ' '.join([generator.choice(WORDS) for i in range(words)])
+
+
+def samples():
+    plain = mail.EmailMessage('Your order', text(300), 'shop@example.com',
+                              ['customer@example.com'])
+    html = mail.EmailMultiAlternatives('Newsletter', text(300),
+                                       'news@example.com',
+                                       ['reader@example.com'])
+    html.attach_alternative(
+        '<html><body>%s</body></html>' % ''.join(
+            ['<p style="font-family: Arial; color: #333">%s</p>' %
+             text(40, seed=i) for i in range(30)]), 'text/html')
+    attachment = mail.EmailMessage('Invoice', text(100), 'shop@example.com',
+                                   ['customer@example.com'])
+    attachment.attach('invoice.txt', text(20000), 'application/octet-stream')
+    return [(name, email_message.message().as_string().decode('utf-8'))
+            for name, email_message in (('plain text', plain),
+                                        ('html', html),
+                                        ('attachment', attachment))]
+
+
+def timed(func, value, repeat):
+    start = time.time()
+    for i in range(repeat):
+        result = func(value)
+    return result, (time.time() - start) / repeat
+
+
+def main(repeat=200):
+    methods = [('zlib', 1), ('zlib', 6), ('zlib', 9)]
+    if compression.zstandard is not None:
+        methods += [('zstd', 3), ('zstd', 10)]
+    print '%-11s %-8s %9s %9s %6s %12s %12s' % (
+        'message', 'method', 'stored', 'original', 'saved', 'compress',
+        'decompress')
+    for name, body in samples():
+        for method, level in methods:
+            compressed, compress_time = timed(
+                lambda value: compression.compress(value, method=method,
+                                                   level=level),
+                body, repeat)
+            decompressed, decompress_time = timed(compression.decompress,
+                                                  compressed, repeat)
+            assert decompressed == body
+            print '%-11s %-8s %9d %9d %5.0f%% %10.1fus %10.1fus' % (
+                name, '%s-%s' % (method, level), len(compressed), len(body),
+                100 - 100.0 * len(compressed) / len(body),
+                compress_time * 1e6, decompress_time * 1e6)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,77 @@
+"""
+Compare the delivery throughput of ``engine.send_all`` (with one and with
+several delivery threads) and ``async_engine.send_all`` against a local SMTP
+server which delays every reply to simulate the round trip to a remote mail
+server.
+
+Run from the repository root::
+
+    python benchmarks/delivery.py [messages] [latency]
+
+An in-memory SQLite database is used unless ``DJANGO_SETTINGS_MODULE`` is
+set, in which case that project's database is used (and written to).
+
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from django.conf import settings
+if not settings.configured and not os.environ.get('DJANGO_SETTINGS_MODULE'):
+    settings.configure(
+        DATABASES={'default': {'ENGINE': 'django.db.backends.sqlite3',
+                               'NAME': ':memory:'}},
+        INSTALLED_APPS=('django_mailer',),
+    )
+
+from django.core import mail
+from django.core.management import call_command
+from django_mailer import async_engine, engine, models, send_mass_mail
+from django_mailer.tests.base import SMTPSink
+import logging
+import warnings
+
+
+def seed(count):
+    models.QueuedMessage.objects.all().delete()
+    models.Log.objects.all().delete()
+    models.Message.objects.all().delete()
+    send_mass_mail(('Message %s' % i, 'A message body.\n' * 50,
+                    'sender@example.com', ['user%s@example.com' % i])
+                   for i in range(count))
+
+
+def main(count=500, latency=0.01):
+    call_command('syncdb', verbosity=0, interactive=False)
+    logging.getLogger('django_mailer').addHandler(logging.StreamHandler())
+    logging.getLogger('django_mailer').setLevel(logging.ERROR)
+    warnings.simplefilter('ignore', DeprecationWarning)
+    sink = SMTPSink(latency=latency)
+    sink.start()
+    settings.EMAIL_HOST = sink.host
+    settings.EMAIL_PORT = sink.port
+    print '%s messages, %.0fms latency per SMTP reply' % (count,
+                                                          latency * 1000)
+    runs = (
+        ('send_all', lambda: engine.send_all()),
+        ('send_all, 8 workers', lambda: engine.send_all(workers=8)),
+        ('async, 50 sessions',
+         lambda: async_engine.send_all(concurrency=50)),
+    )
+    for name, func in runs:
+        seed(count)
+        del sink.messages[:]
+        start = time.time()
+        func()
+        seconds = time.time() - start
+        assert len(sink.messages) == count
+        print '%-22s %7.3fs (%8.1f msgs/sec)' % (name, seconds,
+                                                 count / seconds)
+    sink.stop()
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    main(*[int(args[0])] + [float(arg) for arg in args[1:]])
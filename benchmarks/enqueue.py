@@ -0,0 +1,71 @@
+"""
+Compare the time taken to queue one message to many recipients, one row at a
+time (the way django-mailer used to) against the multi-row INSERT path used by
+``queue_email_message``.
+
+Run from the repository root::
+
+    python benchmarks/enqueue.py [recipients]
+
+An in-memory SQLite database is used unless ``DJANGO_SETTINGS_MODULE`` is
+set, in which case that project's database is used (and written to).
+
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from django.conf import settings
+if not settings.configured and not os.environ.get('DJANGO_SETTINGS_MODULE'):
+    settings.configure(
+        DATABASES={'default': {'ENGINE': 'django.db.backends.sqlite3',
+                               'NAME': ':memory:'}},
+        INSTALLED_APPS=('django_mailer',),
+    )
+
+from django.core import mail
+from django.core.management import call_command
+from django.db import transaction
+from django_mailer import models, queue_email_message
+
+
+def queue_one_by_one(email_message):
+    count = 0
+    for to_email in email_message.recipients():
+        message = models.Message.objects.create(
+            to_address=to_email, from_address=email_message.from_email,
+            subject=email_message.subject,
+            encoded_message=email_message.message().as_string())
+        models.QueuedMessage(message=message).save()
+        count += 1
+    transaction.commit_unless_managed()
+    return count
+
+
+def timed(func, email_message):
+    models.QueuedMessage.objects.all().delete()
+    models.Message.objects.all().delete()
+    start = time.time()
+    count = func(email_message)
+    return count, time.time() - start
+
+
+def main(recipients=5000):
+    call_command('syncdb', verbosity=0, interactive=False)
+    email_message = mail.EmailMessage(
+        'Newsletter', 'A newsletter body.\n' * 200, 'news@example.com',
+        ['user%s@example.com' % i for i in range(recipients)])
+    results = []
+    for name, func in (('one by one', queue_one_by_one),
+                       ('bulk', queue_email_message)):
+        count, seconds = timed(func, email_message)
+        results.append(seconds)
+        print '%-12s %6d messages in %7.3fs (%8.0f msgs/sec)' % (
+            name, count, seconds, count / seconds)
+    print 'speedup: %.1fx' % (results[0] / results[1])
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
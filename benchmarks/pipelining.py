@@ -0,0 +1,75 @@
+"""
+Measure the delivery throughput of ``engine.send_all`` over a single SMTP
+connection with and without the PIPELINING and CHUNKING extensions, against a
+local SMTP server which delays its replies to simulate the round trip to a
+remote mail server.
+
+Run from the repository root::
+
+    python benchmarks/pipelining.py [messages] [latency]
+
+An in-memory SQLite database is used unless ``DJANGO_SETTINGS_MODULE`` is
+set, in which case that project's database is used (and written to).
+
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from django.conf import settings
+if not settings.configured and not os.environ.get('DJANGO_SETTINGS_MODULE'):
+    settings.configure(
+        DATABASES={'default': {'ENGINE': 'django.db.backends.sqlite3',
+                               'NAME': ':memory:'}},
+        INSTALLED_APPS=('django_mailer',),
+    )
+
+from django.core.management import call_command
+from django_mailer import engine, models, send_mass_mail
+from django_mailer.tests.base import SMTPSink
+import logging
+import warnings
+
+
+def seed(count):
+    models.QueuedMessage.objects.all().delete()
+    models.Log.objects.all().delete()
+    models.Message.objects.all().delete()
+    send_mass_mail(('Message %s' % i, 'A message body.\n' * 50,
+                    'sender@example.com', ['user%s@example.com' % i])
+                   for i in range(count))
+
+
+def main(count=200, latency=0.04):
+    call_command('syncdb', verbosity=0, interactive=False)
+    logging.getLogger('django_mailer').addHandler(logging.StreamHandler())
+    logging.getLogger('django_mailer').setLevel(logging.ERROR)
+    warnings.simplefilter('ignore', DeprecationWarning)
+    print '%s messages, %.0fms latency per SMTP round trip' % (
+        count, latency * 1000)
+    runs = (
+        ('no extensions', ()),
+        ('PIPELINING', ('PIPELINING',)),
+        ('CHUNKING', ('CHUNKING',)),
+        ('PIPELINING + CHUNKING', ('PIPELINING', 'CHUNKING')),
+    )
+    for name, extensions in runs:
+        sink = SMTPSink(latency=latency, extensions=extensions)
+        sink.start()
+        settings.EMAIL_HOST = sink.host
+        settings.EMAIL_PORT = sink.port
+        seed(count)
+        start = time.time()
+        engine.send_all()
+        seconds = time.time() - start
+        sink.stop()
+        assert len(sink.messages) == count
+        print '%-22s %7.3fs (%6.1f msgs/sec)' % (name, seconds,
+                                                 count / seconds)
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    main(*[convert(arg) for convert, arg in zip((int, float), args)])
@@ -0,0 +1,123 @@
+"""
+Measure how long it takes a sending process to claim a block of queued
+messages as the queue grows, with and without the composite queue index and
+keyset pagination between blocks.
+
+A fifth of the queue (at the front) is leased to another sending process,
+which every block has to skip past unless blocks are claimed with keyset
+pagination.
+
+Run from the repository root::
+
+    python benchmarks/queue_blocks.py [sizes...]
+
+An in-memory SQLite database is used unless ``DJANGO_SETTINGS_MODULE`` is
+set, in which case that project's database is used (and written to).
+
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from django.conf import settings
+if not settings.configured and not os.environ.get('DJANGO_SETTINGS_MODULE'):
+    settings.configure(
+        DATABASES={'default': {'ENGINE': 'django.db.backends.sqlite3',
+                               'NAME': ':memory:'}},
+        INSTALLED_APPS=('django_mailer',),
+    )
+
+from django.core.management import call_command
+from django.db import connection, transaction, DatabaseError
+from django_mailer import models
+import datetime
+
+
+BLOCK_SIZE = 500
+BLOCKS = 10
+INDEX = 'django_mailer_queuedmessage_queue'
+
+
+def seed(size):
+    models.QueuedMessage.objects.all().delete()
+    models.Message.objects.all().delete()
+    body = models.MessageBody.objects.store('Subject: benchmark\n\nbody')
+    cursor = connection.cursor()
+    qn = connection.ops.quote_name
+    now = datetime.datetime.now()
+    cursor.executemany(
+        'INSERT INTO %s (to_address, from_address, subject, body_id, '
+        '%s, date_created) VALUES (%%s, %%s, %%s, %%s, %%s, %%s)' % (
+            qn(models.Message._meta.db_table), qn('encoded_message')),
+        [('user%s@example.com' % i, 'news@example.com', 'benchmark',
+          body.pk, '', now) for i in range(size)])
+    cursor.execute('SELECT MIN(id) FROM %s' %
+                   qn(models.Message._meta.db_table))
+    first_id = cursor.fetchone()[0]
+    cursor.executemany(
+        'INSERT INTO %s (message_id, priority, retries, date_queued, '
+        'lease_owner) VALUES (%%s, %%s, 0, %%s, %%s)' % (
+            qn(models.QueuedMessage._meta.db_table)),
+        [(first_id + i, 3, now + datetime.timedelta(microseconds=i),
+          i < size // 5 and 'other' or '') for i in range(size)])
+    models.QueuedMessage.objects.filter(lease_owner='other').update(
+        lease_expires=now + datetime.timedelta(hours=1))
+    transaction.commit_unless_managed()
+
+
+def set_index(enabled):
+    cursor = connection.cursor()
+    if connection.vendor == 'mysql':
+        try:
+            cursor.execute('DROP INDEX %s ON %s' % (
+                INDEX, models.QueuedMessage._meta.db_table))
+        except DatabaseError:
+            pass
+    else:
+        cursor.execute('DROP INDEX IF EXISTS %s' % INDEX)
+    if enabled:
+        cursor.execute('CREATE INDEX %s ON %s (deferred, priority, '
+                       'date_queued, id)' % (
+                           INDEX, models.QueuedMessage._meta.db_table))
+
+
+def claim_blocks(keyset):
+    queue = models.QueuedMessage.objects
+    after = None
+    timings = []
+    for i in range(BLOCKS):
+        start = time.time()
+        block = list(queue.claim('benchmark', limit=BLOCK_SIZE, after=after))
+        timings.append(time.time() - start)
+        if not block:
+            break
+        if keyset:
+            last = block[-1]
+            after = (last.priority, last.date_queued, last.pk)
+        # Pretend the block was sent.
+        queue.filter(pk__in=[q.pk for q in block]).delete()
+        transaction.commit_unless_managed()
+    return sum(timings) / len(timings)
+
+
+def main(*sizes):
+    sizes = sizes or (10000, 50000, 200000)
+    call_command('syncdb', verbosity=0, interactive=False)
+    variants = (('no index', False, False), ('index', True, False),
+                ('index + keyset', True, True))
+    print '%-10s' % 'queue' + ''.join(['%18s' % name
+                                       for name, _, _ in variants])
+    for size in sizes:
+        row = '%-10d' % size
+        for name, index, keyset in variants:
+            seed(size)
+            set_index(index)
+            row += '%15.1fms' % (claim_blocks(keyset) * 1000)
+        print row
+        sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
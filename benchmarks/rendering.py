@@ -0,0 +1,89 @@
+"""
+Measure how queueing a stream of distinct email messages scales with the
+number of processes encoding them (see
+``django_mailer.bulk.queue_email_message_stream``).
+
+Each message has an HTML alternative and a 50KB attachment, so that building
+its MIME (header folding, quoted-printable and base64 encoding) dominates the
+time taken to queue it.
+
+Run from the repository root::
+
+    python benchmarks/rendering.py [messages] [max processes]
+
+An in-memory SQLite database is used unless ``DJANGO_SETTINGS_MODULE`` is
+set, in which case that project's database is used (and written to).
+
+"""
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from django.conf import settings
+if not settings.configured and not os.environ.get('DJANGO_SETTINGS_MODULE'):
+    settings.configure(
+        DATABASES={'default': {'ENGINE': 'django.db.backends.sqlite3',
+                               'NAME': ':memory:'}},
+        INSTALLED_APPS=('django_mailer',),
+    )
+
+from django.core import mail
+from django.core.management import call_command
+from django_mailer import bulk, models
+import multiprocessing
+
+
+WORDS = ('your order has shipped and will arrive within three business days '
+         'thank you for shopping with us please contact support if anything '
+         'is wrong').split()
+
+
+def email_messages(count):
+    generator = random.Random(0)
+    attachment = ''.join([chr(generator.randrange(256))
+                          for i in range(50000)])
+    for i in range(count):
+        text = ' '.join([generator.choice(WORDS) for j in range(300)])
+        email_message = mail.EmailMultiAlternatives(
+            'Your invoice %s' % i, text, 'shop@example.com',
+            ['customer%s@example.com' % i])
+        email_message.attach_alternative(
+            '<html><body><p>%s</p></body></html>' % text, 'text/html')
+        email_message.attach('invoice-%s.pdf' % i, attachment,
+                             'application/pdf')
+        yield email_message
+
+
+def timed(messages, processes):
+    for model in (models.QueuedMessage, models.Message, models.MessageBody):
+        model.objects.all().delete()
+    start = time.time()
+    count = bulk.queue_email_message_stream(email_messages(messages),
+                                            processes=processes)
+    return count, time.time() - start
+
+
+def main(messages=2000, max_processes=None):
+    call_command('syncdb', verbosity=0, interactive=False)
+    max_processes = max_processes or multiprocessing.cpu_count()
+    counts = [1]
+    while counts[-1] * 2 <= max_processes:
+        counts.append(counts[-1] * 2)
+    if counts[-1] != max_processes:
+        counts.append(max_processes)
+    print '%-10s %10s %12s %8s' % ('processes', 'seconds', 'msgs/sec',
+                                   'speedup')
+    baseline = None
+    for processes in counts:
+        count, seconds = timed(messages, processes)
+        baseline = baseline or seconds
+        print '%-10d %10.2f %12.0f %7.1fx' % (processes, seconds,
+                                              count / seconds,
+                                              baseline / seconds)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -35,13 +35,46 @@ def send_mail(subject, message, from_email, recipient_list,
                                  recipient_list)
     queue_email_message(email_message, priority=priority)
 
-def send_mass_mail(datatuple, fail_silently=False, auth_user=None, auth_password=None, connection=None):
 
-    # datatuple: (subject, message, from_email, recipient_list)
-    for msg in datatuple:
-        send_mail(msg[0], msg[1], msg[2], msg[3])
-    
-    send_mail(subject, message, from_email, recipient_list, priority=priority)
+def send_mass_mail(datatuple, fail_silently=False, auth_user=None,
+                   auth_password=None, connection=None, priority=None,
+                   chunk_size=None, progress=None, processes=None):
+    """
+    Add new messages to the mail queue for each tuple in ``datatuple``.
+
+    This is a replacement for Django's ``send_mass_mail`` core email method.
+    Each item of ``datatuple`` is a tuple in the format ``(subject, message,
+    from_email, recipient_list)``. ``datatuple`` may be a generator, in which
+    case it is consumed lazily.
+
+    Messages are written to the queue in chunks of ``chunk_size`` messages,
+    each in a single transaction (see
+    ``django_mailer.bulk.queue_email_message_stream``). If a ``progress``
+    callable is provided, it is called after each chunk has been written with
+    the number of messages queued so far.
+
+    With more than one of ``processes`` (default ``MAILER_BULK_PROCESSES``),
+    the messages are encoded by a pool of processes.
+
+    The ``fail_silently``, ``auth_user``, ``auth_password`` and ``connection``
+    arguments are only provided to match the signature of the emulated
+    function. These arguments are not used.
+
+    Returns the number of messages queued.
+
+    """
+    from django.core.mail import EmailMessage
+    from django.utils.encoding import force_unicode
+    from django_mailer import bulk
+
+    email_messages = (EmailMessage(force_unicode(subject), message,
+                                   from_email, recipient_list)
+                      for subject, message, from_email, recipient_list
+                      in datatuple)
+    return bulk.queue_email_message_stream(email_messages, priority=priority,
+                                           chunk_size=chunk_size,
+                                           progress=progress,
+                                           processes=processes)
 
 
 def mail_admins(subject, message, fail_silently=False, priority=None):
@@ -105,9 +138,12 @@ def queue_email_message(email_message, fail_silently=False, priority=None):
     The ``fail_silently`` argument is not used and is only provided to match
     the signature of the ``EmailMessage.send`` function which it may emulate
     (see ``queue_django_mail``).
+
+    The message is only encoded once, however many recipients it has, and the
+    queued messages for every recipient are written in a single transaction.
     
     """
-    from django_mailer import constants, models
+    from django_mailer import bulk, constants
 
     if priority == constants.PRIORITY_EMAIL_NOW:
         if hasattr(email_message, '_actual_send') and\
@@ -117,18 +153,7 @@ def queue_email_message(email_message, fail_silently=False, priority=None):
             send_email = email_message.send
         return send_email()
 
-    count = 0
-    for to_email in email_message.recipients():
-        message = models.Message.objects.create(
-            to_address=to_email, from_address=email_message.from_email,
-            subject=email_message.subject,
-            encoded_message=email_message.message().as_string())
-        queued_message = models.QueuedMessage(message=message)
-        if priority:
-            queued_message.priority = priority
-        queued_message.save()
-        count += 1
-    return count
+    return bulk.queue_email_messages([email_message], priority=priority)
 
 
 def queue_django_mail():
@@ -1,25 +1,225 @@
+from django.conf import settings
 from django.contrib import admin
+from django.contrib.admin.filterspecs import FilterSpec
+from django.contrib.admin.options import IncorrectLookupParameters
+from django.contrib.admin.views.main import ChangeList, MAX_SHOW_ALL_ALLOWED
+from django.core.paginator import InvalidPage, Page, Paginator
+from django.db import connections
+from django.db.models.sql.datastructures import EmptyResultSet
 from django_mailer import models
-
-
-class Message(admin.ModelAdmin):
+import re
+
+
+# Change lists with no more than this many results are counted exactly. Larger
+# ones are estimated from the database's planner statistics where possible.
+COUNT_LIMIT = getattr(settings, "MAILER_ADMIN_COUNT_LIMIT", 10000)
+
+# The query string parameter of a keyset paginated change list, holding the
+# primary key which the page starts after.
+KEYSET_VAR = 'after'
+
+
+def estimated_count(queryset, limit=None):
+    """
+    Return a tuple of the number of rows in a queryset and whether that
+    number is an estimate.
+
+    Up to ``limit`` rows (default ``MAILER_ADMIN_COUNT_LIMIT``, or 10000) are
+    counted exactly, with a ``COUNT`` which stops after ``limit + 1`` rows.
+    Beyond that, PostgreSQL and MySQL estimate the count from their planner
+    statistics (using ``EXPLAIN``). Other databases count every row.
+
+    """
+    limit = limit or COUNT_LIMIT
+    queryset = queryset.order_by().values('pk')
+    connection = connections[queryset.db]
+    try:
+        sql, params = queryset[:limit + 1].query\
+                                          .get_compiler(queryset.db).as_sql()
+    except EmptyResultSet:
+        return 0, False
+    cursor = connection.cursor()
+    cursor.execute('SELECT COUNT(*) FROM (%s) counted' % sql, params)
+    count = cursor.fetchone()[0]
+    if count <= limit:
+        return count, False
+    sql, params = queryset.query.get_compiler(queryset.db).as_sql()
+    estimate = None
+    if connection.vendor == 'postgresql':
+        cursor.execute('EXPLAIN ' + sql, params)
+        match = re.search(r' rows=(\d+)', cursor.fetchone()[0])
+        if match:
+            estimate = int(match.group(1))
+    elif connection.vendor == 'mysql':
+        cursor.execute('EXPLAIN ' + sql, params)
+        names = [column[0].lower() for column in cursor.description]
+        row = cursor.fetchone()
+        if 'rows' in names and row[names.index('rows')] is not None:
+            estimate = int(row[names.index('rows')])
+    if estimate is None:
+        return queryset.count(), False
+    return max(count, estimate), True
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    A paginator which counts its queryset with ``estimated_count``, so that
+    large querysets aren't counted in full on every page.
+
+    ``estimated`` is ``True`` once the count has been estimated. Pages aren't
+    cut short at an estimated count.
+
+    """
+    estimated = False
+
+    def _get_count(self):
+        if self._count is None:
+            self._count, self.estimated = estimated_count(self.object_list)
+        return self._count
+    count = property(_get_count)
+
+    def page(self, number):
+        number = self.validate_number(number)
+        bottom = (number - 1) * self.per_page
+        return Page(self.object_list[bottom:bottom + self.per_page], number,
+                    self)
+
+
+class KeysetChangeList(ChangeList):
+    """
+    A change list which, while it is ordered by primary key, pages through
+    the results by primary key (``?after=<pk>``) rather than by offset, so
+    that later pages are as quick to load as the first. Other orderings are
+    paginated by page number.
+
+    Results are counted with the model admin's paginator, and the unfiltered
+    total is only counted when a filter is applied.
+
+    """
+    def get_query_set(self):
+        # Taken out of the parameters so that links to other filters and
+        # orderings start from the first page.
+        self.after = self.params.pop(KEYSET_VAR, None)
+        return super(KeysetChangeList, self).get_query_set()
+
+    def get_results(self, request):
+        paginator = self.model_admin.get_paginator(request, self.query_set,
+                                                   self.list_per_page)
+        result_count = paginator.count
+        if not self.query_set.query.where:
+            full_result_count = result_count
+        else:
+            full_result_count = self.model_admin.get_paginator(
+                request, self.root_query_set, self.list_per_page).count
+        can_show_all = result_count <= MAX_SHOW_ALL_ALLOWED
+        multi_page = result_count > self.list_per_page
+        self.keyset = self.order_field in ('pk', self.lookup_opts.pk.name)
+        self.first_url = self.next_url = None
+
+        if (self.show_all and can_show_all) or not multi_page:
+            self.keyset = False
+            result_list = self.query_set._clone()
+        elif self.keyset:
+            queryset = self.query_set
+            if self.after is not None:
+                lookup = self.order_type == 'desc' and 'pk__lt' or 'pk__gt'
+                try:
+                    queryset = queryset.filter(**{lookup: self.after})
+                except (TypeError, ValueError):
+                    raise IncorrectLookupParameters
+                self.first_url = self.get_query_string()
+            result_list = list(queryset[:self.list_per_page + 1])
+            if len(result_list) > self.list_per_page:
+                result_list = result_list[:self.list_per_page]
+                self.next_url = self.get_query_string(
+                    {KEYSET_VAR: result_list[-1].pk})
+        else:
+            try:
+                result_list = paginator.page(self.page_num+1).object_list
+            except InvalidPage:
+                raise IncorrectLookupParameters
+
+        self.result_count = result_count
+        self.full_result_count = full_result_count
+        self.result_list = result_list
+        self.can_show_all = can_show_all
+        self.multi_page = multi_page
+        self.paginator = paginator
+
+
+class DeferredFilterSpec(FilterSpec):
+    """
+    Filter queued messages by whether they are deferred (rather than by the
+    date they were deferred).
+
+    """
+    def __init__(self, f, request, params, model, model_admin,
+                 field_path=None):
+        super(DeferredFilterSpec, self).__init__(f, request, params, model,
+                                                 model_admin,
+                                                 field_path=field_path)
+        self.lookup_kwarg = '%s__isnull' % self.field_path
+        self.lookup_val = request.GET.get(self.lookup_kwarg, None)
+
+    def choices(self, cl):
+        for display, value in (('All', None), ('Yes', 'False'),
+                               ('No', 'True')):
+            yield {'selected': self.lookup_val == value,
+                   'query_string': cl.get_query_string(
+                       {self.lookup_kwarg: value}),
+                   'display': display}
+
+# Ahead of the date filter, which would otherwise be used for this field.
+FilterSpec.filter_specs.insert(0, (
+    lambda f: getattr(f, 'model', None) is models.QueuedMessage and
+        f.name == 'deferred', DeferredFilterSpec))
+
+
+class ScalableModelAdmin(admin.ModelAdmin):
+    """
+    A model admin whose change list stays quick on very large tables. Counts
+    are estimated (see ``estimated_count``), the results are keyset
+    paginated while they're ordered by primary key and the fields in
+    ``deferred_fields`` aren't loaded.
+
+    """
+    paginator = EstimatedCountPaginator
+    deferred_fields = ()
+
+    def queryset(self, request):
+        queryset = super(ScalableModelAdmin, self).queryset(request)
+        if self.deferred_fields:
+            queryset = queryset.defer(*self.deferred_fields)
+        return queryset
+
+    def get_changelist(self, request, **kwargs):
+        return KeysetChangeList
+
+
+class Message(ScalableModelAdmin):
     list_display = ('to_address', 'subject', 'date_created')
+    ordering = ('-id',)
+    deferred_fields = ('legacy_encoded_message',)
 
 
-class MessageRelatedModelAdmin(admin.ModelAdmin):
-    list_select_related = True
+class MessageRelatedModelAdmin(ScalableModelAdmin):
+    # Only the message is needed (following every relation would also load
+    # the message bodies), and sorting by its columns would sort the whole
+    # table, so they aren't sortable.
+    deferred_fields = ('message__legacy_encoded_message',)
+
+    def queryset(self, request):
+        return super(MessageRelatedModelAdmin, self).queryset(request)\
+                                                    .select_related('message')
 
     def message__to_address(self, obj):
         return obj.message.to_address
-    message__to_address.admin_order_field = 'message__to_address'
 
     def message__subject(self, obj):
         return obj.message.subject
-    message__subject.admin_order_field = 'message__subject'
 
     def message__date_created(self, obj):
-        return obj.message.to_address
-    message__date_created.admin_order_field = 'message__date_created'
+        return obj.message.date_created
 
 
 class QueuedMessage(MessageRelatedModelAdmin):
@@ -30,6 +230,8 @@ class QueuedMessage(MessageRelatedModelAdmin):
 
     list_display = ('id', 'message__to_address', 'message__subject',
                     'message__date_created', 'priority', 'not_deferred')
+    list_filter = ('priority', 'deferred')
+    ordering = ('id',)
 
 
 class Blacklist(admin.ModelAdmin):
@@ -41,6 +243,7 @@ class Log(MessageRelatedModelAdmin):
                     'date')
     list_filter = ('result',)
     list_display_links = ('id', 'result')
+    ordering = ('-id',)
 
 
 admin.site.register(models.Message, Message)
@@ -0,0 +1,392 @@
+"""
+An event-driven alternative to the "engine room" of django mailer.
+
+Rather than waiting on one SMTP conversation at a time, the methods here keep
+many SMTP sessions to the mail server open at once and drive them all from a
+single thread with ``asyncore``. This suits mail servers with a high latency
+per message, where a thread per connection (see ``engine.send_all``) gets
+expensive.
+
+The database is read and written once per block of messages rather than once
+per message.
+
+STARTTLS is not supported; use ``engine.send_all`` if ``EMAIL_USE_TLS`` is
+set.
+
+"""
+from collections import deque
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.mail.utils import DNS_NAME
+from django_mailer import constants, engine, metrics, models, ratelimit
+from django_mailer.blacklist import get_index as get_blacklist_index
+import asynchat
+import asyncore
+import base64
+import logging
+import smtplib
+import socket
+import sys
+import time
+
+
+# The maximum number of concurrent SMTP sessions to the mail server.
+CONCURRENCY = getattr(settings, "MAILER_ASYNC_CONCURRENCY", 50)
+
+# How long to wait (in seconds) for a reply from the mail server before the
+# session is abandoned.
+TIMEOUT = getattr(settings, "MAILER_ASYNC_TIMEOUT", 60)
+
+logger = logging.getLogger('django_mailer.async_engine')
+
+
+class SMTPSession(asynchat.async_chat):
+    """
+    A non-blocking SMTP client session which sends groups of identical queued
+    messages (see ``engine._group_messages``), taken one group at a time from
+    its ``Delivery``, until there are none left. Each group is sent in a
+    single SMTP transaction with an ``RCPT TO`` for each recipient.
+
+    """
+    def __init__(self, delivery):
+        asynchat.async_chat.__init__(self, map=delivery.map)
+        self.delivery = delivery
+        self.set_terminator('\r\n')
+        self.incoming = []
+        self.reply_lines = []
+        self.group = None
+        self.greeted = False
+        self.state = 'greeting'
+        self.last_activity = time.time()
+        family, socktype, proto, _, address = socket.getaddrinfo(
+            delivery.host, delivery.port, 0, socket.SOCK_STREAM)[0]
+        self.create_socket(family, socktype)
+        try:
+            self.connect(address)
+        except socket.error:
+            self.close()
+            raise
+
+    def command(self, line, state):
+        self.state = state
+        if isinstance(line, unicode):
+            line = line.encode('utf-8')
+        self.push(line + '\r\n')
+
+    def collect_incoming_data(self, data):
+        self.incoming.append(data)
+
+    def found_terminator(self):
+        line = ''.join(self.incoming)
+        self.incoming = []
+        self.last_activity = time.time()
+        self.reply_lines.append(line[4:])
+        if line[3:4] == '-':
+            return
+        try:
+            code = int(line[:3])
+        except ValueError:
+            code = -1
+        reply = '\n'.join(self.reply_lines)
+        self.reply_lines = []
+        getattr(self, 'reply_%s' % self.state)(code, reply)
+
+    def reply_greeting(self, code, reply):
+        if code != 220:
+            return self.fail_session(smtplib.SMTPConnectError(code, reply))
+        self.greeted = True
+        self.command('EHLO %s' % DNS_NAME.get_fqdn(), 'ehlo')
+
+    def reply_ehlo(self, code, reply):
+        if code != 250:
+            return self.command('HELO %s' % DNS_NAME.get_fqdn(), 'helo')
+        self.authenticate()
+
+    def reply_helo(self, code, reply):
+        if code != 250:
+            return self.fail_session(smtplib.SMTPHeloError(code, reply))
+        self.authenticate()
+
+    def authenticate(self):
+        if not self.delivery.username:
+            return self.next_message()
+        credentials = base64.b64encode('\0%s\0%s' % (self.delivery.username,
+                                                     self.delivery.password))
+        self.command('AUTH PLAIN %s' % credentials, 'auth')
+
+    def reply_auth(self, code, reply):
+        if code != 235:
+            return self.fail_session(
+                smtplib.SMTPAuthenticationError(code, reply))
+        self.next_message()
+
+    def next_message(self):
+        while True:
+            self.group = self.delivery.next_group()
+            if self.group is None:
+                return self.command('QUIT', 'quit')
+            self.refused = {}
+            self.recipient = 0
+            self.started = time.time()
+            message = self.group[0].message
+            try:
+                self.data = message.encoded_message.encode('utf-8')
+            except Exception, err:
+                # A mail merge message which can't be rendered fails on its
+                # own, without starting a transaction.
+                self.finish_group(err)
+            else:
+                break
+        self.command('MAIL FROM:%s' % smtplib.quoteaddr(message.from_address),
+                     'mail')
+
+    def reply_mail(self, code, reply):
+        if code != 250:
+            return self.fail_group(smtplib.SMTPSenderRefused(
+                code, reply, self.group[0].message.from_address))
+        self.send_rcpt()
+
+    def send_rcpt(self):
+        to_address = self.group[self.recipient].message.to_address
+        self.command('RCPT TO:%s' % smtplib.quoteaddr(to_address), 'rcpt')
+
+    def reply_rcpt(self, code, reply):
+        if code not in (250, 251):
+            to_address = self.group[self.recipient].message.to_address
+            self.refused[to_address] = (code, reply)
+        self.recipient += 1
+        if self.recipient < len(self.group):
+            return self.send_rcpt()
+        if len(self.refused) == len(set([queued_message.message.to_address
+                                         for queued_message in self.group])):
+            return self.fail_group()
+        self.command('DATA', 'data')
+
+    def reply_data(self, code, reply):
+        if code != 354:
+            return self.fail_group(smtplib.SMTPDataError(code, reply))
+        data = smtplib.quotedata(self.data)
+        if data[-2:] != '\r\n':
+            data += '\r\n'
+        self.state = 'sent'
+        self.push(data + '.\r\n')
+
+    def reply_sent(self, code, reply):
+        if code != 250:
+            self.finish_group(smtplib.SMTPDataError(code, reply))
+        else:
+            self.finish_group()
+        self.next_message()
+
+    def reply_rset(self, code, reply):
+        self.next_message()
+
+    def reply_quit(self, code, reply):
+        self.close()
+        self.delivery.session_closed(self)
+
+    def finish_group(self, err=None):
+        """
+        Report the results for the current group of messages: failed with
+        ``err`` if it is provided, otherwise sent unless the recipient was
+        refused.
+
+        """
+        metrics.registry.observe('smtp_seconds', time.time() - self.started)
+        for queued_message in self.group:
+            to_address = queued_message.message.to_address
+            if err is None and to_address in self.refused:
+                self.delivery.done(queued_message, constants.RESULT_FAILED,
+                                   smtplib.SMTPRecipientsRefused(
+                                       {to_address: self.refused[to_address]}))
+            elif err is None:
+                self.delivery.done(queued_message, constants.RESULT_SENT)
+            else:
+                self.delivery.done(queued_message, constants.RESULT_FAILED,
+                                   err)
+        self.group = None
+
+    def fail_group(self, err=None):
+        """
+        Fail the current group of messages and reset the SMTP transaction.
+
+        """
+        self.finish_group(err)
+        self.command('RSET', 'rset')
+
+    def fail_session(self, err):
+        """
+        Abandon the session, failing the messages currently being sent.
+
+        """
+        if self.group is not None:
+            self.finish_group(err)
+        self.close()
+        self.delivery.session_failed(self, err)
+
+    def handle_connect(self):
+        pass
+
+    def handle_close(self):
+        if self.state == 'quit':
+            self.close()
+            self.delivery.session_closed(self)
+        else:
+            self.fail_session(smtplib.SMTPServerDisconnected(
+                'Connection unexpectedly closed'))
+
+    def handle_error(self):
+        err = sys.exc_info()[1]
+        self.fail_session(err)
+
+
+class Delivery(object):
+    """
+    Deliver a list of groups of queued messages (see
+    ``engine._group_messages``) over up to ``concurrency`` concurrent SMTP
+    sessions to the mail server.
+
+    The number of sessions bounds the concurrency for the mail server in the
+    same way a semaphore would: a session only takes a new group once it has
+    finished with its last one.
+
+    """
+    def __init__(self, groups, concurrency=None, host=None,
+                 port=None, username=None, password=None):
+        self.pending = deque(groups)
+        self.concurrency = concurrency or CONCURRENCY
+        self.host = host or settings.EMAIL_HOST
+        self.port = port or settings.EMAIL_PORT
+        if username is None:
+            username = settings.EMAIL_HOST_USER
+        if password is None:
+            password = settings.EMAIL_HOST_PASSWORD
+        self.username = username and password and username
+        self.password = password
+        self.map = {}
+        self.sessions = []
+        self.results = []
+        self.error = None
+        self.reconnects = 0
+
+    def next_group(self):
+        if self.pending:
+            return self.pending.popleft()
+
+    def done(self, queued_message, result, err=None):
+        log_message = ''
+        if err is not None:
+            logger.warning("Message to %s deferred due to failure: %s" %
+                           (queued_message.message.to_address.encode("utf-8"),
+                            err))
+            log_message = unicode(err)
+        self.results.append((queued_message, result, log_message))
+
+    def start_session(self):
+        try:
+            self.sessions.append(SMTPSession(self))
+        except socket.error, err:
+            self.error = err
+
+    def session_closed(self, session):
+        if session in self.sessions:
+            self.sessions.remove(session)
+
+    def session_failed(self, session, err):
+        """
+        Replace a session which failed after it had been greeted by the mail
+        server. Sessions which couldn't connect are not replaced, so that the
+        delivery stops when the mail server is unreachable.
+
+        """
+        self.error = err
+        self.session_closed(session)
+        if session.greeted and self.pending:
+            self.reconnects += 1
+            self.start_session()
+
+    def run(self, tick=None):
+        """
+        Deliver the messages, returning a list of ``(queued_message, result,
+        log_message)`` tuples.
+
+        The optional ``tick`` callable is called regularly while the messages
+        are being delivered.
+
+        """
+        for i in range(min(self.concurrency, len(self.pending))):
+            self.start_session()
+        while self.map:
+            asyncore.loop(timeout=1, map=self.map, count=1)
+            now = time.time()
+            for session in list(self.sessions):
+                if now - session.last_activity > TIMEOUT:
+                    session.fail_session(socket.timeout('timed out'))
+            if tick:
+                tick()
+        # If every session failed, the messages which are left are deferred.
+        while self.pending:
+            for queued_message in self.pending.popleft():
+                self.done(queued_message, constants.RESULT_FAILED, self.error)
+        return self.results
+
+
+def send_all(block_size=500, concurrency=None):
+    """
+    Send all non-deferred messages in the queue over concurrent SMTP sessions.
+
+    Messages are leased in blocks in the same way as ``engine.send_all``.
+    Each block is delivered over up to ``concurrency`` SMTP sessions (the
+    ``MAILER_ASYNC_CONCURRENCY`` setting by default, or 50), then the results
+    for the whole block are written to the database at once.
+
+    Returns a tuple of the number of messages sent, deferred and skipped.
+
+    """
+    if settings.EMAIL_USE_TLS:
+        raise ImproperlyConfigured("The asynchronous engine doesn't support "
+                                   "EMAIL_USE_TLS.")
+    start_time = time.time()
+    counts = {constants.RESULT_SENT: 0, constants.RESULT_FAILED: 0,
+              constants.RESULT_SKIPPED: 0}
+    worker_id = engine._worker_id()
+    reconnects = 0
+    try:
+        blacklist = get_blacklist_index()
+        limiter = ratelimit.get_limiter()
+        for queue in engine._message_blocks(block_size, worker_id):
+            deliver, skipped = engine._split_blacklisted(queue, blacklist)
+            results = [(queued_message, constants.RESULT_SKIPPED, '')
+                       for queued_message in skipped]
+            renewed = [time.time()]
+
+            def tick():
+                renewed[0] = engine._renew_leases(worker_id, renewed[0])
+            groups = engine._rate_limit(engine._group_messages(deliver),
+                                        limiter)
+            delivery = Delivery(groups, concurrency=concurrency)
+            results.extend(delivery.run(tick=tick))
+            reconnects += delivery.reconnects
+            engine._record_many(results, worker_id=worker_id)
+            for queued_message, result, log_message in results:
+                counts[result] += 1
+    finally:
+        models.QueuedMessage.objects.release_leases(worker_id)
+
+    metrics.registry.increment('smtp_reconnects_total', reconnects)
+    if metrics.is_exported():
+        metrics.collect_queue_depth()
+    metrics.registry.flush()
+    sent = counts[constants.RESULT_SENT]
+    deferred = counts[constants.RESULT_FAILED]
+    skipped = counts[constants.RESULT_SKIPPED]
+    if sent or deferred or skipped:
+        log = logger.warning
+    else:
+        log = logger.info
+    log("%s sent, %s deferred, %s skipped." % (sent, deferred, skipped))
+    if reconnects:
+        log("Reconnected to the mail server %s time%s." %
+            (reconnects, reconnects != 1 and 's' or ''))
+    logger.debug("Completed in %.2f seconds." % (time.time() - start_time))
+    return sent, deferred, skipped
@@ -1,13 +1,43 @@
 from django.core.mail.backends.base import BaseEmailBackend
-from django_mailer.models import Message
+from django.db import DatabaseError
+from django_mailer import bulk
+
 
 class DbBackend(BaseEmailBackend):
+    """
+    An email backend which adds messages to the queue rather than sending
+    them.
+
+    Each batch of messages passed to ``send_messages`` is queued with one
+    ``Message`` per recipient, written with multi-row INSERT statements in a
+    single transaction.
+
+    The messages can be assigned a priority in the queue by passing a
+    ``priority`` argument when getting the connection, for example::
+
+        connection = get_connection('django_mailer.backend.DbBackend',
+                                    priority=constants.PRIORITY_HIGH)
+        connection.send_messages(email_messages)
+
+    """
+    def __init__(self, fail_silently=False, priority=None, **kwargs):
+        super(DbBackend, self).__init__(fail_silently=fail_silently, **kwargs)
+        self.priority = priority
 
     def send_messages(self, email_messages):
-        num_sent = 0
-        for email in email_messages:
-            msg = Message()
-            msg.email = email
-            msg.save()
-            num_sent += 1
-        return num_sent
\ No newline at end of file
+        """
+        Queue one or more ``EmailMessage`` objects and return the number of
+        email messages queued (messages without recipients are ignored).
+
+        """
+        email_messages = [email_message for email_message in email_messages
+                          if email_message.recipients()]
+        if not email_messages:
+            return 0
+        try:
+            bulk.queue_email_messages(email_messages, priority=self.priority)
+        except DatabaseError:
+            if not self.fail_silently:
+                raise
+            return 0
+        return len(email_messages)
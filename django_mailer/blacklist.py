@@ -0,0 +1,180 @@
+"""
+An in-memory index of blacklisted e-mail addresses.
+
+Checking every queued message against a list of blacklisted addresses is a
+linear scan, which gets expensive with a large blacklist. The index here
+normalizes the addresses into a hash set (or optionally, a much more compact
+Bloom filter) so each check takes constant time, and supports ``*@domain``
+entries which blacklist a whole domain.
+
+"""
+from django.conf import settings
+from django.db.models import Count, Max
+from django_mailer import models
+from email.utils import parseaddr
+import hashlib
+import math
+import struct
+
+
+# Whether to index blacklisted addresses in a Bloom filter rather than a set.
+# This uses far less memory for large blacklists; addresses which the filter
+# matches are confirmed against the database.
+USE_BLOOM_FILTER = getattr(settings, "MAILER_BLACKLIST_BLOOM_FILTER", False)
+
+# The false positive rate of the Bloom filter.
+BLOOM_ERROR_RATE = getattr(settings, "MAILER_BLACKLIST_BLOOM_ERROR_RATE",
+                           0.001)
+
+_index = None
+
+
+def normalize(address):
+    """
+    Return the normalized (lowercase, without any display name) form of an
+    e-mail address.
+
+    """
+    address = address.strip()
+    return (parseaddr(address)[1] or address).lower()
+
+
+class BloomFilter(object):
+    """
+    A Bloom filter of strings, sized for ``capacity`` items with the given
+    false positive ``error_rate``.
+
+    """
+    def __init__(self, capacity, error_rate=0.001):
+        self.capacity = max(1, capacity)
+        self.size = max(8, int(math.ceil(
+            -self.capacity * math.log(error_rate) / math.log(2) ** 2)))
+        self.hashes = max(1, int(round(
+            self.size / float(self.capacity) * math.log(2))))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, item):
+        # Double hashing: derive all the positions from two 64-bit hashes.
+        h1, h2 = struct.unpack('<QQ', hashlib.md5(item).digest())
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, item):
+        for position in self._positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, item):
+        for position in self._positions(item):
+            if not self.bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+
+class BlacklistIndex(object):
+    """
+    An index of the ``Blacklist`` table.
+
+    Call ``refresh`` to load the table. Later calls only load entries added
+    since the last refresh (those with a greater primary key), unless entries
+    have been removed from the table in the meantime, in which case the index
+    is rebuilt.
+
+    Addresses are compared case-insensitively. A ``*@domain`` entry blacklists
+    every address at that domain.
+
+    """
+    def __init__(self, use_bloom_filter=None):
+        if use_bloom_filter is None:
+            use_bloom_filter = USE_BLOOM_FILTER
+        self.use_bloom_filter = use_bloom_filter
+        self.clear()
+
+    def clear(self):
+        self.addresses = set()
+        self.domains = set()
+        self.bloom_filter = None
+        self.rows = 0
+        self.last_pk = None
+
+    def refresh(self):
+        """
+        Load any entries added to the ``Blacklist`` table since the last
+        refresh.
+
+        Changes are detected from the number of entries in the table and the
+        greatest primary key, which a single query returns. If entries have
+        been removed, the index is rebuilt.
+
+        """
+        fingerprint = models.Blacklist.objects.aggregate(
+            total=Count('pk'), last_pk=Max('pk'))
+        total, last_pk = fingerprint['total'], fingerprint['last_pk']
+        if (total, last_pk) == (self.rows, self.last_pk):
+            return
+        if last_pk is not None and (self.last_pk is None or
+                                    last_pk > self.last_pk):
+            queryset = models.Blacklist.objects.filter(pk__lte=last_pk)
+            if self.last_pk is not None:
+                queryset = queryset.filter(pk__gt=self.last_pk)
+            elif self.use_bloom_filter:
+                # Leave room for the blacklist to double in size before the
+                # filter needs rebuilding.
+                self.bloom_filter = BloomFilter(total * 2, BLOOM_ERROR_RATE)
+            entries = queryset.values_list('email', flat=True)
+            for email in entries.iterator():
+                self.rows += 1
+                self.add(email)
+            self.last_pk = last_pk
+        if self.rows != total or (self.bloom_filter and
+                                  self.rows > self.bloom_filter.capacity):
+            # Entries have been removed, or added with a lower primary key
+            # than one already loaded (by a transaction which committed
+            # later), or the Bloom filter is over capacity, so rebuild the
+            # index.
+            self.clear()
+            self.refresh()
+
+    def add(self, email):
+        email = normalize(email)
+        if email.startswith('*@'):
+            self.domains.add(email[2:])
+        elif self.bloom_filter is not None:
+            self.bloom_filter.add(email.encode('utf-8'))
+        else:
+            self.addresses.add(email)
+
+    def __contains__(self, address):
+        address = normalize(address)
+        if address.rpartition('@')[2] in self.domains:
+            return True
+        if self.bloom_filter is None:
+            return address in self.addresses
+        if address.encode('utf-8') not in self.bloom_filter:
+            return False
+        # Confirm the match, which may be a false positive.
+        return models.Blacklist.objects.filter(normalized_email=address)\
+                                       .exists()
+
+
+def get_index():
+    """
+    Return the shared ``BlacklistIndex``, refreshed with any entries added to
+    the ``Blacklist`` table since it was last used.
+
+    """
+    global _index
+    if _index is None:
+        _index = BlacklistIndex()
+    _index.refresh()
+    return _index
+
+
+def is_blacklisted(address):
+    """
+    Check a single address against the ``Blacklist`` table (without loading
+    the whole table).
+
+    """
+    address = normalize(address)
+    domain = address.rpartition('@')[2]
+    return models.Blacklist.objects.filter(
+        normalized_email__in=[address, '*@%s' % domain]).exists()
@@ -0,0 +1,481 @@
+"""
+Helpers for writing many queue rows to the database at once.
+
+Queueing a message to a large number of recipients (or a large number of
+messages) through the ORM costs two INSERT statements per recipient. The
+functions here build the rows in memory and write them with multi-row INSERT
+statements instead.
+
+"""
+from django.conf import settings
+from django.db import connection, models as db_models, transaction, \
+    IntegrityError
+from django.template import Template
+from django_mailer import merge, models, notify
+import collections
+import datetime
+import itertools
+import sys
+
+
+# The maximum number of rows written by a single multi-row INSERT statement.
+BATCH_SIZE = getattr(settings, "MAILER_BULK_BATCH_SIZE", 500)
+
+# The number of messages written per transaction when queueing a stream of
+# email messages.
+CHUNK_SIZE = getattr(settings, "MAILER_BULK_CHUNK_SIZE", 5000)
+
+# The number of processes which encode email messages when queueing a stream
+# of them (1 encodes them in the queueing process).
+PROCESSES = getattr(settings, "MAILER_BULK_PROCESSES", 1)
+
+# The number of email messages passed to an encoding process at a time.
+ENCODE_CHUNK_SIZE = getattr(settings, "MAILER_BULK_ENCODE_CHUNK_SIZE", 100)
+
+# SQLite refuses statements with more than this many query parameters.
+SQLITE_MAX_VARIABLES = 999
+
+
+def _can_insert_many():
+    """
+    Return whether the database backend supports multi-row INSERT statements
+    which can also report the primary keys of the rows that were created.
+
+    """
+    vendor = connection.vendor
+    if vendor == 'sqlite':
+        from django.db.backends.sqlite3.base import Database
+        # Multi-row VALUES clauses were added in SQLite 3.7.11.
+        return Database.sqlite_version_info >= (3, 7, 11)
+    if vendor == 'postgresql':
+        return connection.features.can_return_id_from_insert
+    return vendor == 'mysql'
+
+
+def _batch_size(fields):
+    batch_size = max(1, BATCH_SIZE)
+    if connection.vendor == 'sqlite':
+        batch_size = min(batch_size, SQLITE_MAX_VARIABLES // len(fields))
+    return batch_size
+
+
+def insert(objs):
+    """
+    Save a list of new (unsaved) model instances of the same model, using as
+    few INSERT statements as possible.
+
+    The primary key of each instance is set after it has been inserted so that
+    the instances can be referenced by other rows.
+
+    Multi-row INSERT statements are used for SQLite, MySQL and PostgreSQL.
+    Primary keys are retrieved with ``RETURNING`` on PostgreSQL. On SQLite and
+    MySQL they are calculated from the last inserted row id, relying on a
+    single statement being allocated consecutive ids (MySQL needs an
+    ``innodb_autoinc_lock_mode`` of 0 or 1 for that to hold). Other database
+    backends fall back to saving each instance separately.
+
+    Signals are not sent for the inserted rows.
+
+    """
+    if not objs:
+        return
+    if not _can_insert_many():
+        for obj in objs:
+            obj.save(force_insert=True)
+        return
+    opts = objs[0]._meta
+    qn = connection.ops.quote_name
+    fields = [field for field in opts.local_fields
+              if not isinstance(field, db_models.AutoField)]
+    columns = ', '.join([qn(field.column) for field in fields])
+    placeholders = '(%s)' % ', '.join(['%s'] * len(fields))
+    returning = connection.vendor == 'postgresql'
+    batch_size = _batch_size(fields)
+    cursor = connection.cursor()
+    for start in range(0, len(objs), batch_size):
+        batch = objs[start:start + batch_size]
+        params = []
+        for obj in batch:
+            for field in fields:
+                value = field.pre_save(obj, True)
+                params.append(field.get_db_prep_save(value,
+                                                     connection=connection))
+        sql = 'INSERT INTO %s (%s) VALUES %s' % (
+            qn(opts.db_table), columns,
+            ', '.join([placeholders] * len(batch)))
+        if returning:
+            sql += ' RETURNING %s' % qn(opts.pk.column)
+        cursor.execute(sql, params)
+        if returning:
+            ids = [row[0] for row in cursor.fetchall()]
+        elif connection.vendor == 'sqlite':
+            # SQLite reports the id of the last row inserted.
+            last_id = cursor.lastrowid
+            ids = range(last_id - len(batch) + 1, last_id + 1)
+        else:
+            # MySQL reports the id of the first row inserted.
+            first_id = cursor.lastrowid
+            ids = range(first_id, first_id + len(batch))
+        for obj, pk in zip(batch, ids):
+            obj.pk = pk
+    transaction.set_dirty()
+
+
+def _stored_bodies(hashes):
+    """
+    Return a dictionary of the primary keys of the stored bodies with the
+    given hashes, keyed by hash.
+
+    """
+    stored = {}
+    queryset = models.MessageBody.objects.all()
+    for start in range(0, len(hashes), BATCH_SIZE):
+        batch = hashes[start:start + BATCH_SIZE]
+        stored.update(queryset.filter(hash__in=batch)
+                              .values_list('hash', 'pk'))
+    return stored
+
+
+def store_bodies(encoded_messages):
+    """
+    Return a list of ``MessageBody`` instances for a list of encoded messages
+    (in the same order), creating the bodies which don't exist yet with
+    multi-row INSERT statements.
+
+    Each distinct encoded message is only hashed and stored once. If a
+    concurrent process stores one of the same bodies first, the INSERT is
+    rolled back to a savepoint (leaving the rest of the transaction intact)
+    and that process's body is used instead.
+
+    """
+    hashes = {}
+    for encoded_message in encoded_messages:
+        if encoded_message not in hashes:
+            hashes[encoded_message] = models.MessageBody.get_hash(
+                encoded_message)
+    by_hash = {}
+    for hash, pk in _stored_bodies(list(set(hashes.values()))).items():
+        by_hash[hash] = models.MessageBody(pk=pk, hash=hash)
+    existing = [body.pk for body in by_hash.values()]
+    queryset = models.MessageBody.objects.all()
+    for start in range(0, len(existing), BATCH_SIZE):
+        queryset.filter(pk__in=existing[start:start + BATCH_SIZE])\
+                .update(date_used=datetime.datetime.now())
+    new_bodies = []
+    for encoded_message, hash in hashes.items():
+        body = by_hash.get(hash)
+        if body is None:
+            body = by_hash[hash] = models.MessageBody(hash=hash)
+            new_bodies.append(body)
+        body.encoded_message = encoded_message
+    while new_bodies:
+        sid = transaction.savepoint()
+        try:
+            insert(new_bodies)
+        except IntegrityError:
+            exc_info = sys.exc_info()
+            transaction.savepoint_rollback(sid)
+            # A concurrent process stored some of the same bodies first, so
+            # use those and store the rest again.
+            stored = _stored_bodies([body.hash for body in new_bodies])
+            if not stored:
+                raise exc_info[0], exc_info[1], exc_info[2]
+            for body in new_bodies:
+                body.pk = stored.get(body.hash)
+            new_bodies = [body for body in new_bodies if body.pk is None]
+        else:
+            transaction.savepoint_commit(sid)
+            break
+    return [by_hash[hashes[encoded_message]]
+            for encoded_message in encoded_messages]
+
+
+def _atomic(func):
+    """
+    Call ``func`` in a transaction of its own, returning its result.
+
+    If the caller is already managing a transaction, ``func`` is called in a
+    savepoint of that transaction instead, so that the caller's transaction
+    is neither committed early nor (if ``func`` fails) rolled back beyond the
+    savepoint.
+
+    """
+    if not transaction.is_managed():
+        return transaction.commit_on_success(func)()
+    sid = transaction.savepoint()
+    try:
+        result = func()
+    except:
+        transaction.savepoint_rollback(sid)
+        raise
+    transaction.savepoint_commit(sid)
+    return result
+
+
+def queue_messages(messages, priority=None):
+    """
+    Add a list of new (unsaved) ``Message`` instances to the queue, writing
+    the messages, their bodies and their queue rows in a single transaction
+    (see ``_atomic``), then notify any waiting sending processes.
+
+    Returns the number of messages queued.
+
+    """
+    unsaved = [message for message in messages
+               if hasattr(message, '_new_encoded_message')]
+
+    def queue():
+        bodies = store_bodies([message._new_encoded_message
+                               for message in unsaved])
+        for message, body in zip(unsaved, bodies):
+            message.body = body
+        insert(messages)
+        queued_messages = []
+        counts = {}
+        for message in messages:
+            queued_message = models.QueuedMessage(message_id=message.pk)
+            if priority:
+                queued_message.priority = priority
+            queued_messages.append(queued_message)
+            key = (queued_message.priority, False)
+            counts[key] = counts.get(key, 0) + 1
+        insert(queued_messages)
+        models.QueueCounter.objects.adjust(counts)
+
+    _atomic(queue)
+    for message in unsaved:
+        del message._new_encoded_message
+    if messages:
+        notify.notify()
+    return len(messages)
+
+
+def queue_email_messages(email_messages, priority=None):
+    """
+    Add new messages to the email queue for every recipient of each of the
+    given ``EmailMessage`` instances.
+
+    Each ``EmailMessage`` is only encoded once, no matter how many recipients
+    it has, and all messages are written using multi-row INSERT statements in
+    a single transaction.
+
+    Returns the number of messages queued.
+
+    """
+    messages = []
+    for email_message in email_messages:
+        messages.extend(_build_messages(email_message))
+    return queue_messages(messages, priority=priority)
+
+
+def queue_email_message_stream(email_messages, priority=None,
+                               chunk_size=None, progress=None,
+                               processes=None):
+    """
+    Add new messages to the email queue for every recipient of each
+    ``EmailMessage`` in an iterable (which may be a generator).
+
+    The iterable is consumed lazily and messages are written in chunks of
+    ``chunk_size`` (default ``MAILER_BULK_CHUNK_SIZE``, or 5000), each chunk in
+    its own transaction. Only one chunk is ever held in memory.
+
+    With more than one of ``processes`` (default ``MAILER_BULK_PROCESSES``,
+    or 1), the email messages are encoded by a pool of processes (see
+    ``_encode_parallel``) while this process writes them to the database.
+    The messages must then be picklable.
+
+    If a ``progress`` callable is provided, it is called after each chunk has
+    been committed with the total number of messages queued so far.
+
+    Returns the number of messages queued.
+
+    """
+    chunk_size = max(1, chunk_size or CHUNK_SIZE)
+    processes = processes or PROCESSES
+    if processes > 1:
+        encoded_messages = _encode_parallel(email_messages, processes)
+    else:
+        encoded_messages = itertools.imap(_encode, email_messages)
+    count = 0
+    messages = []
+    for encoded in encoded_messages:
+        messages.extend(_build_encoded_messages(encoded))
+        if len(messages) >= chunk_size:
+            count += queue_messages(messages, priority=priority)
+            messages = []
+            if progress:
+                progress(count)
+    if messages:
+        count += queue_messages(messages, priority=priority)
+        if progress:
+            progress(count)
+    return count
+
+
+def queue_template_messages(subject, text, from_email, recipients, html=None,
+                            priority=None, chunk_size=None, progress=None):
+    """
+    Queue a mail merge: a message to each recipient rendered from the
+    ``subject``, ``text`` and (optional) ``html`` Django templates when it is
+    sent (see ``django_mailer.merge``).
+
+    ``recipients`` is an iterable (which may be a generator) of ``(to_address,
+    context)`` tuples, where ``context`` is a dictionary which can be encoded
+    as JSON. The templates are stored once, and each queued message only
+    stores its recipient's context, so nothing is rendered here. The templates
+    are compiled first though, so a ``TemplateSyntaxError`` is raised here
+    rather than when the messages are sent.
+
+    Messages are written in chunks of ``chunk_size`` (default
+    ``MAILER_BULK_CHUNK_SIZE``, or 5000), each chunk in its own transaction.
+    If a ``progress`` callable is provided, it is called after each chunk has
+    been committed with the total number of messages queued so far.
+
+    Returns the number of messages queued.
+
+    """
+    from_email = from_email or settings.DEFAULT_FROM_EMAIL
+    chunk_size = max(1, chunk_size or CHUNK_SIZE)
+    for source in (subject, text, html):
+        if source:
+            Template(source)
+    template = models.MessageTemplate.objects.store(from_email, subject, text,
+                                                    html or '')
+    subject = ' '.join(subject.split())[:255]
+    count = 0
+    messages = []
+    for to_address, context in recipients:
+        messages.append(models.Message(
+            to_address=to_address, from_address=from_email, subject=subject,
+            template=template, context=merge.encode_context(context)))
+        if len(messages) >= chunk_size:
+            count += queue_messages(messages, priority=priority)
+            messages = []
+            if progress:
+                progress(count)
+    if messages:
+        count += queue_messages(messages, priority=priority)
+        if progress:
+            progress(count)
+    return count
+
+
+def _encode(email_message):
+    """
+    Return a tuple of the recipients, sender, subject and encoded message (or
+    ``None`` if it has no recipients) of an ``EmailMessage``.
+
+    """
+    recipients = email_message.recipients()
+    encoded_message = None
+    if recipients:
+        encoded_message = email_message.message().as_string()
+    return (recipients, email_message.from_email, email_message.subject,
+            encoded_message)
+
+
+def _encode_chunk(email_messages):
+    return [_encode(email_message) for email_message in email_messages]
+
+
+def _encode_parallel(email_messages, processes, chunk_size=None):
+    """
+    Encode an iterable of email messages in a pool of ``processes``
+    processes, yielding the result of ``_encode`` for each message in the
+    same order as the iterable.
+
+    Messages are passed to the pool in chunks of ``chunk_size`` (default
+    ``MAILER_BULK_ENCODE_CHUNK_SIZE``, or 100). The iterable is consumed
+    lazily: no more than two chunks per process are being encoded (or waiting
+    to be) at a time. An exception raised while encoding a message is raised
+    here when that message's result is reached, and the pool is terminated.
+
+    """
+    import multiprocessing
+    chunk_size = max(1, chunk_size or ENCODE_CHUNK_SIZE)
+    pool = multiprocessing.Pool(processes)
+    pending = collections.deque()
+    try:
+        chunk = []
+        for email_message in email_messages:
+            chunk.append(email_message)
+            if len(chunk) < chunk_size:
+                continue
+            pending.append(pool.apply_async(_encode_chunk, (chunk,)))
+            chunk = []
+            while len(pending) >= processes * 2:
+                for encoded in pending.popleft().get():
+                    yield encoded
+        if chunk:
+            pending.append(pool.apply_async(_encode_chunk, (chunk,)))
+        while pending:
+            for encoded in pending.popleft().get():
+                yield encoded
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def _build_messages(email_message):
+    """
+    Return a list of new (unsaved) ``Message`` instances, one for each
+    recipient of an ``EmailMessage``.
+
+    """
+    return _build_encoded_messages(_encode(email_message))
+
+
+def _build_encoded_messages(encoded):
+    """
+    Return a list of new (unsaved) ``Message`` instances from the result of
+    ``_encode``.
+
+    """
+    recipients, from_email, subject, encoded_message = encoded
+    return [models.Message(to_address=to_email, from_address=from_email,
+                           subject=subject, encoded_message=encoded_message)
+            for to_email in recipients]
+
+
+def migrate_message_bodies(chunk_size=None, progress=None):
+    """
+    Move the encoded messages of messages queued before bodies were stored
+    separately into shared ``MessageBody`` rows.
+
+    Messages are converted in chunks of ``chunk_size`` (default
+    ``MAILER_BULK_CHUNK_SIZE``, or 5000), each chunk in its own transaction,
+    so the conversion can be interrupted and resumed. If a ``progress``
+    callable is provided, it is called after each chunk has been committed
+    with the total number of messages converted so far.
+
+    Returns the number of messages converted.
+
+    """
+    chunk_size = max(1, chunk_size or CHUNK_SIZE)
+    queryset = models.Message.objects.filter(body=None).order_by('pk')
+    count = 0
+    last_pk = 0
+    while True:
+        rows = list(queryset.filter(pk__gt=last_pk)
+                    .values_list('pk', 'legacy_encoded_message')[:chunk_size])
+        if not rows:
+            break
+        last_pk = rows[-1][0]
+
+        @transaction.commit_on_success
+        def convert():
+            bodies = store_bodies([encoded_message
+                                   for pk, encoded_message in rows])
+            pks_by_body = {}
+            for (pk, encoded_message), body in zip(rows, bodies):
+                pks_by_body.setdefault(body.pk, []).append(pk)
+            for body_pk, pks in pks_by_body.items():
+                for start in range(0, len(pks), BATCH_SIZE):
+                    models.Message.objects.filter(
+                        pk__in=pks[start:start + BATCH_SIZE], body=None)\
+                        .update(body=body_pk, legacy_encoded_message='')
+        convert()
+        count += len(rows)
+        if progress:
+            progress(count)
+    return count
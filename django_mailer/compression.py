@@ -0,0 +1,98 @@
+"""
+Optional compression of stored message bodies.
+
+Compressed bodies are stored as text: a format marker followed by the base64
+encoded compressed content. Header field names can't contain spaces, so no
+encoded message can start with one of the markers and compressed and
+uncompressed bodies can be stored side by side.
+
+"""
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+import base64
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# The compression method for new message bodies: None (don't compress),
+# 'zlib' or 'zstd' (which needs the ``zstandard`` package).
+METHOD = getattr(settings, "MAILER_COMPRESSION", None)
+
+# The compression level passed to the compressor.
+LEVEL = getattr(settings, "MAILER_COMPRESSION_LEVEL", 6)
+
+# Bodies shorter than this many characters aren't worth compressing.
+MIN_SIZE = getattr(settings, "MAILER_COMPRESSION_MIN_SIZE", 1024)
+
+MARKERS = {
+    'zlib': u'zlib base64:',
+    'zstd': u'zstd base64:',
+}
+
+
+def _zstandard():
+    if zstandard is None:
+        raise ImproperlyConfigured("The zstandard package is needed for zstd "
+                                   "compressed message bodies.")
+    return zstandard
+
+
+def method_of(value):
+    """
+    Return the compression method of a stored value, or ``None`` if it isn't
+    compressed.
+
+    """
+    if value:
+        for method, marker in MARKERS.items():
+            if value.startswith(marker):
+                return method
+    return None
+
+
+def compress(value, method=None, level=None):
+    """
+    Compress a message body with ``method`` (the ``MAILER_COMPRESSION``
+    setting by default), returning the text to store.
+
+    Values which are already compressed, empty or shorter than
+    ``MAILER_COMPRESSION_MIN_SIZE`` are returned unchanged, as is every value
+    if there is no compression method.
+
+    """
+    method = method or METHOD
+    if not method or not value or len(value) < MIN_SIZE or method_of(value):
+        return value
+    if method not in MARKERS:
+        raise ImproperlyConfigured("Unknown message body compression method: "
+                                   "%r" % method)
+    if level is None:
+        level = LEVEL
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    if method == 'zstd':
+        data = _zstandard().ZstdCompressor(level=level).compress(value)
+    else:
+        data = zlib.compress(value, level)
+    return MARKERS[method] + base64.b64encode(data).decode('ascii')
+
+
+def decompress(value):
+    """
+    Return the original message body of a stored value, which is returned
+    unchanged if it isn't compressed.
+
+    """
+    method = method_of(value)
+    if method is None:
+        return value
+    data = base64.b64decode(value[len(MARKERS[method]):])
+    if method == 'zstd':
+        data = _zstandard().ZstdDecompressor().decompress(data)
+    else:
+        data = zlib.decompress(data)
+    return data.decode('utf-8')
@@ -6,19 +6,51 @@ Methods here actually handle the sending of queued messages.
 """
 from django.conf import settings
 from django.core.mail import SMTPConnection
-from django_mailer import constants, models
+from django.db import transaction
+from django_mailer import bulk, constants, metrics, models, notify, \
+    ratelimit, retry, smtp
+from django_mailer.blacklist import get_index as get_blacklist_index, \
+    is_blacklisted
 from lockfile import FileLock, AlreadyLocked, LockTimeout
 from socket import error as SocketError
+import Queue
+import datetime
 import logging
+import math
 import smtplib
+import socket
+import sys
 import tempfile
+import threading
 import time
 import os
+import uuid
 
 
-# When queue is empty, how long to wait (in seconds) before checking again.
+# When queue is empty, how long to wait (in seconds) before checking again if
+# no notification that messages have been queued arrives.
 EMPTY_QUEUE_SLEEP = getattr(settings, "MAILER_EMPTY_QUEUE_SLEEP", 30)
 
+# The number of seconds a sending process leases a block of queued messages
+# for. Leases are renewed while the block is being sent, so this only needs to
+# be long enough to recover quickly from a sending process which dies.
+LEASE_DURATION = getattr(settings, "MAILER_LEASE_DURATION", 300)
+
+# How many results of sending messages are buffered, and for how many seconds,
+# before they are written to the database. Messages sent since the last write
+# are sent again if the sending process dies.
+WRITE_BUFFER_SIZE = getattr(settings, "MAILER_WRITE_BUFFER_SIZE", 500)
+WRITE_BUFFER_INTERVAL = getattr(settings, "MAILER_WRITE_BUFFER_INTERVAL", 5)
+
+# The maximum number of recipients of an identical message which are sent the
+# message in a single SMTP transaction. Set to 1 to send every message
+# separately.
+MAX_RECIPIENTS = getattr(settings, "MAILER_MAX_RECIPIENTS", 50)
+
+# Whether to also use a lock file so that only one sending process can run at
+# a time on this host. Leasing makes this unnecessary.
+USE_FILE_LOCK = getattr(settings, "MAILER_USE_FILE_LOCK", False)
+
 # Lock timeout value. how long to wait for the lock to become available.
 # default behavior is to never wait for the lock to be available.
 LOCK_WAIT_TIMEOUT = getattr(settings, "MAILER_LOCK_WAIT_TIMEOUT", -1)
@@ -27,79 +59,208 @@ LOCK_PATH = os.path.join(tempfile.gettempdir(), 'send_mail')
 
 logger = logging.getLogger('django_mailer.engine')
 
-def _message_queue(block_size):
+
+def _worker_id():
     """
-    A generator which iterates queued messages in blocks so that new
-    prioritised messages can be inserted during iteration of a large number of
-    queued messages.
-    
-    To avoid an infinite loop, yielded messages *must* be deleted or deferred.
+    Return an identifier for a sending process which is unique across hosts.
     
     """
+    return '%s:%s:%s' % (socket.gethostname()[:64], os.getpid(),
+                         uuid.uuid4().hex[:8])
+
+
+def _message_blocks(block_size, worker_id):
+    """
+    A generator which leases blocks of queued messages to ``worker_id`` and
+    yields each block, so that new prioritised messages can be inserted during
+    iteration of a large number of queued messages.
+
+    Since other processes sending concurrently can only claim messages which
+    aren't leased, they never send the same messages.
+
+    Each block is a list of queued messages with their messages loaded. The
+    bodies shared by the messages are loaded separately (see
+    ``_load_bodies``) so that each distinct body is only read once.
+
+    Blocks are claimed with keyset pagination: each block starts after the
+    last (non-deferred) message of the previous block in queue order, unless
+    a message with a higher priority has been queued in the meantime. The
+    key is also reset every ``MAILER_LEASE_DURATION`` seconds, so that
+    messages which have become available behind it (whose leases have
+    expired or been released, or which have been retried) are claimed
+    within that time rather than when the queue has been cleared.
+
+    To avoid an infinite loop, all messages in a block *must* be deleted or
+    deferred before the next block is requested.
+
+    """
+    after = [None]
+    # When the blocks last started from the front of the queue.
+    restarted = [time.time()]
+
     def get_block():
-        queue = models.QueuedMessage.objects.non_deferred().select_related()
-        if block_size:
-            queue = queue[:block_size]
+        start_time = time.time()
+        if start_time - restarted[0] >= LEASE_DURATION:
+            after[0] = None
+            restarted[0] = start_time
+        queue = list(models.QueuedMessage.objects.claim(
+            worker_id, limit=block_size, lease_duration=LEASE_DURATION,
+            after=after[0]).select_related('message'))
+        keys = [(queued_message.priority, queued_message.date_queued,
+                 queued_message.pk) for queued_message in queue
+                if queued_message.deferred is None]
+        if keys:
+            after[0] = max(keys)
+        _load_bodies([queued_message.message for queued_message in queue])
+        metrics.registry.observe('db_fetch_seconds', time.time() - start_time)
         return queue
     queue = get_block()
     while queue:
-        for message in queue:
-            yield message
+        yield queue
         queue = get_block()
 
 
-def send_all(block_size=500):
+def _load_bodies(messages):
+    """
+    Load the bodies (and mail merge templates) of a list of messages with one
+    query per batch of distinct bodies, rather than joining the (shared) body
+    to every message.
+
+    """
+    for field_name, model in (('body', models.MessageBody),
+                              ('template', models.MessageTemplate)):
+        field = models.Message._meta.get_field(field_name)
+        ids = list(set([getattr(message, field.attname)
+                        for message in messages
+                        if getattr(message, field.attname)]))
+        objs = {}
+        for start in range(0, len(ids), bulk.BATCH_SIZE):
+            objs.update(model.objects.in_bulk(
+                ids[start:start + bulk.BATCH_SIZE]))
+        cache_name = field.get_cache_name()
+        for message in messages:
+            if getattr(message, field.attname) in objs:
+                setattr(message, cache_name,
+                        objs[getattr(message, field.attname)])
+
+
+def _renew_leases(worker_id, renewed):
+    """
+    Renew the leases held by ``worker_id`` if half the lease duration has
+    passed since they were last renewed (at the ``renewed`` timestamp).
+
+    Returns the timestamp the leases were last renewed at.
+
+    """
+    if time.time() - renewed > LEASE_DURATION / 2.0:
+        models.QueuedMessage.objects.renew_leases(
+            worker_id, lease_duration=LEASE_DURATION)
+        renewed = time.time()
+    return renewed
+
+
+def _still_leased(group, worker_id):
+    """
+    Return the queued messages of a group which are still leased to
+    ``worker_id``, dropping any whose lease has expired or been taken over by
+    another sending process (if this one stalled for longer than the lease
+    duration) so that they aren't sent twice.
+
+    """
+    now = datetime.datetime.now()
+    leased = set(models.QueuedMessage.objects.filter(
+        pk__in=[queued_message.pk for queued_message in group],
+        lease_owner=worker_id, lease_expires__gt=now)
+        .values_list('pk', flat=True))
+    if len(leased) < len(group):
+        lost = len(group) - len(leased)
+        logger.warning("%s message%s no longer leased to this process, not "
+                       "sending." % (lost, lost != 1 and 's' or ''))
+        group = [queued_message for queued_message in group
+                 if queued_message.pk in leased]
+    return group
+
+
+def send_all(block_size=500, workers=1, smtp_connection=None):
     """
     Send all non-deferred messages in the queue.
     
-    A lock file is used to ensure that this process can not be started again
+    Queued messages are leased in blocks to this process while they are
+    sent, so any number of processes (on any number of hosts) can send
+    concurrently without sending the same message twice. Leased messages
+    which are left unsent are released when the process completes, and if the
+    process dies its leases expire after ``MAILER_LEASE_DURATION`` seconds.
+
+    If the ``MAILER_USE_FILE_LOCK`` setting is ``True``, a lock file is also
+    used to ensure that this process can not be started again on this host
     while it is already running.
     
     The ``block_size`` argument allows for queued messages to be iterated in
     blocks, allowing new prioritised messages to be inserted during iteration
     of a large number of queued messages.
+
+    If ``workers`` is more than 1, messages are delivered in parallel by that
+    many threads, each with its own SMTP connection (see ``_send_threaded``).
+    Otherwise an ``smtp.ConnectionManager`` can be provided as the
+    ``smtp_connection`` to be used (and left open) rather than a new one.
     
     """
-    lock = FileLock(LOCK_PATH)
+    lock = None
+    if USE_FILE_LOCK:
+        lock = FileLock(LOCK_PATH)
 
-    logger.debug("Acquiring lock...")
-    try:
-        # lockfile has a bug dealing with a negative LOCK_WAIT_TIMEOUT (which
-        # is the default if it's not provided) systems which use a LinkFileLock
-        # so ensure that it is never a negative number.
-        lock.acquire(LOCK_WAIT_TIMEOUT and max(0, LOCK_WAIT_TIMEOUT))
-    except AlreadyLocked:
-        logger.debug("Lock already in place. Exiting.")
-        return
-    except LockTimeout:
-        logger.debug("Waiting for the lock timed out. Exiting.")
-        return
-    logger.debug("Lock acquired.")
+        logger.debug("Acquiring lock...")
+        try:
+            # lockfile has a bug dealing with a negative LOCK_WAIT_TIMEOUT
+            # (which is the default if it's not provided) systems which use a
+            # LinkFileLock so ensure that it is never a negative number.
+            lock.acquire(LOCK_WAIT_TIMEOUT and max(0, LOCK_WAIT_TIMEOUT))
+        except AlreadyLocked:
+            logger.debug("Lock already in place. Exiting.")
+            return
+        except LockTimeout:
+            logger.debug("Waiting for the lock timed out. Exiting.")
+            return
+        logger.debug("Lock acquired.")
 
     start_time = time.time()
 
     sent = deferred = skipped = 0
     
-    connection = None
+    worker_id = _worker_id()
+    threads = []
+    reconnects = 0
     
     try:
-        connection = SMTPConnection()
-        blacklist = models.Blacklist.objects.values_list('email', flat=True)
-        connection.open()
-        for message in _message_queue(block_size):
-            result = send_message(message, smtp_connection=connection,
-                                  blacklist=blacklist)
-            if result == constants.RESULT_SENT:
-                sent += 1
-            elif result == constants.RESULT_FAILED:
-                deferred += 1
-            elif result == constants.RESULT_SKIPPED:
-                skipped += 1
-        connection.close()
+        blacklist = get_blacklist_index()
+        limiter = ratelimit.get_limiter()
+        if workers > 1:
+            sent, deferred, skipped, threads = _send_threaded(
+                block_size, worker_id, blacklist, workers, limiter)
+            for thread in threads:
+                reconnects += thread.connection.reconnects
+        else:
+            connection = smtp_connection or smtp.ConnectionManager()
+            initial_reconnects = connection.reconnects
+            try:
+                sent, deferred, skipped = _send(block_size, worker_id,
+                                                blacklist, connection,
+                                                limiter)
+            finally:
+                if smtp_connection is None:
+                    connection.close()
+            reconnects = connection.reconnects - initial_reconnects
     finally:
-        logger.debug("Releasing lock...")
-        lock.release()
-        logger.debug("Lock released.")
+        models.QueuedMessage.objects.release_leases(worker_id)
+        if lock:
+            logger.debug("Releasing lock...")
+            lock.release()
+            logger.debug("Lock released.")
+
+    metrics.registry.increment('smtp_reconnects_total', reconnects)
+    if metrics.is_exported():
+        metrics.collect_queue_depth()
+    metrics.registry.flush()
 
     logger.debug("")
     if sent or deferred or skipped:
@@ -107,26 +268,246 @@ def send_all(block_size=500):
     else:
         log = logger.info
     log("%s sent, %s deferred, %s skipped." % (sent, deferred, skipped))
-    logger.debug("Completed in %.2f seconds." % (time.time() - start_time))
+    if reconnects:
+        log("Reconnected to the mail server %s time%s." %
+            (reconnects, reconnects != 1 and 's' or ''))
+    elapsed = time.time() - start_time
+    for thread in threads:
+        log("Worker %s: %s sent, %s deferred, %.2f seconds delivering "
+            "(%.1f messages/second), %s reconnects." %
+            (thread.number, thread.sent, thread.deferred, thread.elapsed,
+             (thread.sent + thread.deferred) / max(thread.elapsed, 0.001),
+             thread.connection.reconnects))
+    logger.debug("Completed in %.2f seconds." % elapsed)
+
+
+class DeliveryThread(threading.Thread):
+    """
+    A thread which delivers groups of queued messages (see
+    ``_group_messages``) taken from the ``tasks`` queue over its own
+    persistent SMTP connection.
+
+    The outcome of delivering each group is put on the ``results`` queue as a
+    tuple of ``(group, results, error)``, where ``results`` is a list of
+    ``(result, log_message)`` tuples for the messages in the group, leaving
+    the database to be updated by the thread which queued the task. If an
+    unexpected error occurs, ``results`` is ``None`` and the ``error`` is the
+    ``sys.exc_info()`` of the exception, so that it can be raised again with
+    its traceback.
+
+    A ``None`` task stops the thread.
+
+    """
+    def __init__(self, number, tasks, results):
+        threading.Thread.__init__(self, name='django_mailer-%s' % number)
+        self.setDaemon(True)
+        self.number = number
+        self.tasks = tasks
+        self.results = results
+        self.sent = self.deferred = 0
+        self.elapsed = 0.0
+        self.connection = smtp.ConnectionManager()
+
+    def run(self):
+        connection = self.connection
+        try:
+            connection.open()
+        except (SocketError, smtplib.SMTPException):
+            # Opening the connection is retried (and the failure reported) as
+            # each message is delivered.
+            pass
+        try:
+            while True:
+                group = self.tasks.get()
+                if group is None:
+                    break
+                start_time = time.time()
+                try:
+                    results = _deliver_group(
+                        [queued_message.message for queued_message in group],
+                        connection)
+                except Exception:
+                    self.results.put((group, None, sys.exc_info()))
+                    continue
+                self.elapsed += time.time() - start_time
+                for result, log_message in results:
+                    if result == constants.RESULT_SENT:
+                        self.sent += 1
+                    else:
+                        self.deferred += 1
+                self.results.put((group, results, None))
+        finally:
+            connection.close()
+
+
+def _send(block_size, worker_id, blacklist, connection, limiter=None):
+    """
+    Send all non-deferred messages in the queue over a single SMTP connection
+    (an ``smtp.ConnectionManager``), returning a tuple of the number of
+    messages sent, deferred and skipped.
+
+    Identical messages in each block are sent together to the recipients at
+    each domain (see ``_group_messages``), subject to the rate ``limiter``
+    (see ``_rate_limit``). The results are written to the database through a
+    ``ResultBuffer``.
+
+    """
+    counts = {constants.RESULT_SENT: 0, constants.RESULT_FAILED: 0,
+              constants.RESULT_SKIPPED: 0}
+    buffer = ResultBuffer(worker_id=worker_id)
+    connection.open()
+    try:
+        for queue in _message_blocks(block_size, worker_id):
+            renewed = time.time()
+            deliver, skipped = _split_blacklisted(queue, blacklist)
+            for queued_message in skipped:
+                buffer.add(queued_message, constants.RESULT_SKIPPED, '')
+                counts[constants.RESULT_SKIPPED] += 1
+            for group in _rate_limit(_group_messages(deliver), limiter):
+                renewed = _renew_leases(worker_id, renewed)
+                group = _still_leased(group, worker_id)
+                if not group:
+                    continue
+                results = _deliver_group(
+                    [queued_message.message for queued_message in group],
+                    connection)
+                for queued_message, (result, log_message) in zip(group,
+                                                                 results):
+                    buffer.add(queued_message, result, log_message)
+                    counts[result] += 1
+            buffer.flush()
+    finally:
+        buffer.flush()
+    return (counts[constants.RESULT_SENT], counts[constants.RESULT_FAILED],
+            counts[constants.RESULT_SKIPPED])
+
+
+def _send_threaded(block_size, worker_id, blacklist, workers, limiter=None):
+    """
+    Send all non-deferred messages in the queue using ``workers`` delivery
+    threads, returning a tuple of the number of messages sent, deferred and
+    skipped, and the list of (finished) delivery threads.
+
+    Leased messages are grouped (see ``_group_messages``) and the groups are
+    fed to the threads through a bounded queue. The threads only talk SMTP:
+    blacklist checks and the deleting, deferring and logging of messages are
+    all done by the calling thread as the results come back. Each block is
+    completely delivered before the next block is claimed.
+
+    """
+    tasks = Queue.Queue(maxsize=workers * 2)
+    results = Queue.Queue()
+    threads = [DeliveryThread(number, tasks, results)
+               for number in range(1, workers + 1)]
+    for thread in threads:
+        thread.start()
+    counts = {constants.RESULT_SENT: 0, constants.RESULT_FAILED: 0,
+              constants.RESULT_SKIPPED: 0}
+    buffer = ResultBuffer(worker_id=worker_id)
+
+    def add_results(group, group_results):
+        for queued_message, (result, log_message) in zip(group,
+                                                         group_results):
+            buffer.add(queued_message, result, log_message)
+            counts[result] += 1
+
+    def handle_result(wait):
+        try:
+            group, group_results, error = results.get(wait)
+        except Queue.Empty:
+            return False
+        if group_results is None:
+            raise error[0], error[1], error[2]
+        add_results(group, group_results)
+        return True
+
+    try:
+        for queue in _message_blocks(block_size, worker_id):
+            renewed = time.time()
+            pending = 0
+            deliver, skipped = _split_blacklisted(queue, blacklist)
+            for queued_message in skipped:
+                buffer.add(queued_message, constants.RESULT_SKIPPED, '')
+                counts[constants.RESULT_SKIPPED] += 1
+            for group in _rate_limit(_group_messages(deliver), limiter):
+                renewed = _renew_leases(worker_id, renewed)
+                group = _still_leased(group, worker_id)
+                if not group:
+                    continue
+                tasks.put(group)
+                pending += 1
+                while pending and handle_result(wait=False):
+                    pending -= 1
+            while pending:
+                handle_result(wait=True)
+                pending -= 1
+                renewed = _renew_leases(worker_id, renewed)
+            buffer.flush()
+    finally:
+        # Stop the threads without delivering anything else, but record the
+        # messages which have already been delivered.
+        while True:
+            try:
+                tasks.get_nowait()
+            except Queue.Empty:
+                break
+        for thread in threads:
+            tasks.put(None)
+        for thread in threads:
+            thread.join()
+        while True:
+            try:
+                group, group_results, error = results.get_nowait()
+            except Queue.Empty:
+                break
+            if group_results is not None:
+                add_results(group, group_results)
+        buffer.flush()
+
+    return (counts[constants.RESULT_SENT], counts[constants.RESULT_FAILED],
+            counts[constants.RESULT_SKIPPED], threads)
 
 
 def send_loop(empty_queue_sleep=None):
     """
-    Loop indefinitely, checking queue at intervals and sending and queued
-    messages.
+    Loop indefinitely, sending queued messages as soon as they are queued.
     
-    The interval (in seconds) can be provided as the ``empty_queue_sleep``
-    argument. The default is attempted to be retrieved from the
-    ``MAILER_EMPTY_QUEUE_SLEEP`` setting (or if not set, 30s is used).
+    While the queue is empty, the loop waits to be notified that messages
+    have been queued (see ``django_mailer.notify``), checking the queue again
+    at least every ``empty_queue_sleep`` seconds. The default is attempted
+    to be retrieved from the ``MAILER_EMPTY_QUEUE_SLEEP`` setting (or if not
+    set, 30s is used).
+
+    The SMTP connection is kept open between runs, with NOOP keepalives
+    while the queue is empty (see ``smtp.ConnectionManager``).
     
     """
     empty_queue_sleep = empty_queue_sleep or EMPTY_QUEUE_SLEEP
-    while True:
-        while not models.QueuedMessage.objects.all():
-            logger.debug("Sleeping for %s seconds before checking queue "
-                          "again." % empty_queue_sleep)
-            time.sleep(empty_queue_sleep)
-        send_all()
+    listener = notify.Listener()
+    connection = smtp.ConnectionManager()
+    wait = empty_queue_sleep
+    if connection.keepalive_interval:
+        wait = min(wait, connection.keepalive_interval)
+    if metrics.PROMETHEUS_PORT:
+        metrics.start_http_server()
+    try:
+        while True:
+            waited = 0
+            while not models.QueuedMessage.objects.available().exists():
+                if not waited:
+                    logger.debug("Waiting up to %s seconds before checking "
+                                 "queue again." % empty_queue_sleep)
+                while waited < empty_queue_sleep:
+                    if listener.wait(wait):
+                        break
+                    waited += wait
+                    connection.keepalive()
+                else:
+                    waited = 0
+            send_all(smtp_connection=connection)
+    finally:
+        listener.close()
+        connection.close()
 
 
 def send_message(queued_message, smtp_connection=None, blacklist=None,
@@ -140,7 +521,8 @@ def send_message(queued_message, smtp_connection=None, blacklist=None,
     successful sent message.
     
     To allow optimizations if multiple messages are to be sent, an SMTP
-    connection can be provided and a list of blacklisted email addresses.
+    connection can be provided and an index of blacklisted email addresses
+    (see ``django_mailer.blacklist``).
     Otherwise an SMTP connection will be opened to send this message and the
     email recipient address checked against the ``Blacklist`` table.
     
@@ -156,42 +538,343 @@ def send_message(queued_message, smtp_connection=None, blacklist=None,
     message = queued_message.message
     if smtp_connection is None:
         smtp_connection = SMTPConnection() #FIXME: deveria receber backend
-    opened_connection = False
 
+    if _is_blacklisted(message, blacklist):
+        result, log_message = constants.RESULT_SKIPPED, ''
+    else:
+        result, log_message = _deliver(message, smtp_connection)
+    _record(queued_message, result, log_message, log=log)
+    return result
+
+
+def _split_blacklisted(queue, blacklist):
+    """
+    Split a list of queued messages into those to deliver and those to skip
+    because their recipient is blacklisted (see ``_is_blacklisted``),
+    returning a tuple of the two lists.
+
+    """
+    start_time = time.time()
+    deliver = []
+    skipped = []
+    for queued_message in queue:
+        if _is_blacklisted(queued_message.message, blacklist):
+            skipped.append(queued_message)
+        else:
+            deliver.append(queued_message)
+    metrics.registry.observe('blacklist_seconds', time.time() - start_time)
+    return deliver, skipped
+
+
+def _is_blacklisted(message, blacklist=None):
+    """
+    Return whether the message recipient is blacklisted, either in the
+    provided ``blacklist`` (a ``BlacklistIndex``) or (if it is ``None``) the
+    ``Blacklist`` table.
+
+    """
     if blacklist is None:
-        blacklisted = models.Blacklist.objects.filter(email=message.to_address)
+        blacklisted = is_blacklisted(message.to_address)
     else:
         blacklisted = message.to_address in blacklist
-
-    log_message = ''
     if blacklisted:
         logger.info("Not sending to blacklisted email: %s" %
                      message.to_address.encode("utf-8"))
-        queued_message.delete()
-        result = constants.RESULT_SKIPPED
+    return blacklisted
+
+
+def _deliver(message, smtp_connection):
+    """
+    Send a message over an SMTP connection, returning a tuple of the result
+    code and a log message.
+
+    SMTP failures result in ``RESULT_FAILED``. The connection is opened if
+    necessary, and closed again if it was opened here.
+
+    """
+    return _deliver_group([message], smtp_connection)[0]
+
+
+def _group_messages(queued_messages, max_recipients=None):
+    """
+    Group a list of queued messages so that each group can be sent in a single
+    SMTP transaction, returning a list of lists of queued messages.
+
+    Messages are grouped if they have the same sender and the same encoded
+    message and their recipients are at the same domain, up to
+    ``max_recipients`` (the ``MAILER_MAX_RECIPIENTS`` setting by default)
+    messages per group. Mail merge messages are never grouped. Groups are in
+    the order of their first message.
+
+    """
+    if max_recipients is None:
+        max_recipients = MAX_RECIPIENTS
+    if max_recipients <= 1:
+        return [[queued_message] for queued_message in queued_messages]
+    groups = []
+    open_groups = {}
+    for queued_message in queued_messages:
+        message = queued_message.message
+        if message.template_id:
+            # Mail merge messages are rendered for their recipient.
+            groups.append([queued_message])
+            continue
+        key = (message.from_address,
+               message.to_address.rpartition('@')[2].lower(),
+               message.body_id or message.encoded_message)
+        group = open_groups.get(key)
+        if group is None or len(group) >= max_recipients:
+            group = open_groups[key] = []
+            groups.append(group)
+        group.append(queued_message)
+    return groups
+
+
+def _rate_limit(groups, limiter):
+    """
+    Return the groups of queued messages (see ``_group_messages``) which the
+    rate ``limiter`` (see ``django_mailer.ratelimit``) allows to be sent now.
+
+    The other groups are held back in the queue, without being deferred,
+    until the limits will allow them to be sent, so that messages to the
+    other domains keep being sent in the meantime. Once a domain (or the
+    global limit) is found to be throttled, the rest of its groups are held
+    back without asking the limiter again.
+
+    """
+    if limiter is None:
+        return groups
+    send = []
+    held = {}
+    waits = {}
+    for group in groups:
+        domain = group[0].message.to_address.rpartition('@')[2].lower()
+        wait = waits.get(ratelimit.GLOBAL) or waits.get(domain)
+        if not wait:
+            wait, limited = limiter.acquire(domain, len(group))
+            if wait:
+                if limited != ratelimit.GLOBAL:
+                    limited = domain
+                waits[limited] = wait
+        if wait:
+            held.setdefault(int(math.ceil(wait)), []).extend(
+                [queued_message.pk for queued_message in group])
+        else:
+            send.append(group)
+    now = datetime.datetime.now()
+    for seconds, pks in held.items():
+        until = now + datetime.timedelta(seconds=seconds)
+        for start in range(0, len(pks), bulk.BATCH_SIZE):
+            models.QueuedMessage.objects.hold(
+                pks[start:start + bulk.BATCH_SIZE], until)
+        logger.info("%s message%s held back for %s seconds by the rate "
+                    "limits." % (len(pks), len(pks) != 1 and 's' or '',
+                                 seconds))
+    return send
+
+
+def _deliver_group(messages, smtp_connection):
+    """
+    Send messages which share the same sender and encoded message over an SMTP
+    connection in a single transaction (with an ``RCPT TO`` for each
+    recipient), returning a list of ``(result, log_message)`` tuples in the
+    same order as the messages.
+
+    The connection can be an ``smtp.ConnectionManager`` (which reconnects if
+    the connection is dropped) or an email backend instance, which is opened
+    if necessary and closed again if it was opened here.
+
+    Recipients refused by the server, and every recipient if the transaction
+    fails, result in ``RESULT_FAILED``. So does a mail merge message which
+    can't be rendered (it isn't sent).
+
+    """
+    if isinstance(smtp_connection, smtp.ConnectionManager):
+        connection = smtp_connection
+    else:
+        connection = smtp.ConnectionManager(smtp_connection)
+    message = messages[0]
+    to_addresses = [m.to_address for m in messages]
+    opened_connection = False
+    refused = error = None
+    logger.info("Sending message to %s: %s" %
+                 (', '.join(to_addresses).encode("utf-8"),
+                  message.subject.encode("utf-8")))
+    try:
+        encoded_message = message.encoded_message
+    except Exception, err:
+        # A mail merge template (or context) which fails to render.
+        error = err
     else:
+        start_time = time.time()
         try:
-            logger.info("Sending message to %s: %s" %
-                         (message.to_address.encode("utf-8"),
-                          message.subject.encode("utf-8")))
-            opened_connection = smtp_connection.open()
-            smtp_connection.connection.sendmail(message.from_address,
-                                                [message.to_address],
-                                                message.encoded_message)
-            queued_message.delete()
-            result = constants.RESULT_SENT
-        except (SocketError, smtplib.SMTPSenderRefused,
-                smtplib.SMTPRecipientsRefused,
-                smtplib.SMTPAuthenticationError), err:
-            queued_message.defer()
+            opened_connection = connection.open()
+            refused = connection.sendmail(
+                message.from_address, to_addresses, encoded_message)
+        except smtplib.SMTPRecipientsRefused, err:
+            refused = err.recipients
+        except (SocketError, smtplib.SMTPException), err:
+            error = err
+        metrics.registry.observe('smtp_seconds', time.time() - start_time)
+
+    results = []
+    for to_address in to_addresses:
+        err = error
+        if err is None and refused and to_address in refused:
+            err = smtplib.SMTPRecipientsRefused(
+                {to_address: refused[to_address]})
+        if err is None:
+            results.append((constants.RESULT_SENT, ''))
+        else:
             logger.warning("Message to %s deferred due to failure: %s" %
-                            (message.to_address.encode("utf-8"), err))
-            log_message = unicode(err)
-            result = constants.RESULT_FAILED
+                            (to_address.encode("utf-8"), err))
+            results.append((constants.RESULT_FAILED, unicode(err)))
+
+    if opened_connection and connection is not smtp_connection:
+        connection.close()
+    return results
+
+
+def _record(queued_message, result, log_message, log=True):
+    """
+    Update the queue with the result of sending a queued message: deleting it
+    if it was sent or skipped, deferring it (to be retried later) if it
+    failed. A message which has failed too many times is deleted instead if
+    the ``MAILER_FINAL_FAILURE`` setting is ``'delete'``.
+
+    By default, a log is created as to the action. Either way, the original
+    message is not deleted.
+
+    """
+    if result == constants.RESULT_FAILED and \
+            not retry.should_delete(queued_message.retries + 1):
+        queued_message.defer()
+    else:
+        queued_message.delete()
     if log:
-        models.Log.objects.create(message=message, result=result,
-                                  log_message=log_message)
+        models.Log.objects.create(message=queued_message.message,
+                                  result=result, log_message=log_message)
+    metrics.report_results([(queued_message, result, log_message)],
+                           datetime.datetime.now())
 
-    if opened_connection:
-        smtp_connection.close()
-    return result
+
+def _record_many(results, worker_id=None):
+    """
+    Update the queue with the results of sending a number of queued messages,
+    given as a list of ``(queued_message, result, log_message)`` tuples.
+
+    This does the same as calling ``_record`` for each result, but with one
+    DELETE for the sent and skipped messages, an UPDATE for each batch of
+    deferred messages due to be retried at the same time (to the second) and
+    multi-row INSERTs for the logs, all in a single transaction.
+
+    If a ``worker_id`` is provided, only messages which are still leased to
+    it are deleted or deferred, so that a message which another sending
+    process has claimed in the meantime is left to that process.
+
+    The queue counters are adjusted by the state of the messages as they are
+    found (and locked, see ``QueueManager.lock_states``) in the queue, so
+    that messages which are no longer there aren't counted again.
+
+    """
+    if not results:
+        return
+    now = datetime.datetime.now()
+    logs = [models.Log(message_id=queued_message.message_id, result=result,
+                       log_message=log_message)
+            for queued_message, result, log_message in results]
+
+    @transaction.commit_on_success
+    def record():
+        pks = [queued_message.pk for queued_message, _, _ in results]
+        states = {}
+        for start in range(0, len(pks), bulk.BATCH_SIZE):
+            states.update(models.QueuedMessage.objects.lock_states(
+                pks[start:start + bulk.BATCH_SIZE], owner=worker_id))
+        finished = []
+        deferred = {}
+        # The changes to the queue counters.
+        counts = {}
+        for queued_message, result, _ in results:
+            state = states.pop(queued_message.pk, None)
+            if state is None:
+                continue
+            counts[state] = counts.get(state, 0) - 1
+            retries = queued_message.retries + 1
+            if result != constants.RESULT_FAILED or \
+                    retry.should_delete(retries):
+                finished.append(queued_message.pk)
+                continue
+            key = (state[0], True)
+            counts[key] = counts.get(key, 0) + 1
+            next_attempt = retry.next_attempt(retries, now)
+            if next_attempt is not None:
+                next_attempt = next_attempt.replace(microsecond=0)
+            deferred.setdefault((retries, next_attempt), []).append(
+                queued_message.pk)
+        queryset = models.QueuedMessage.objects.all()
+        if worker_id is not None:
+            queryset = queryset.filter(lease_owner=worker_id)
+        start_time = time.time()
+        for start in range(0, len(finished), bulk.BATCH_SIZE):
+            queryset.filter(pk__in=finished[start:start + bulk.BATCH_SIZE])\
+                    .delete()
+        if finished:
+            metrics.registry.observe('db_delete_seconds',
+                                     time.time() - start_time)
+        start_time = time.time()
+        for (retries, next_attempt), pks in deferred.items():
+            for start in range(0, len(pks), bulk.BATCH_SIZE):
+                queryset.filter(pk__in=pks[start:start + bulk.BATCH_SIZE])\
+                        .update(deferred=now, retries=retries,
+                                next_attempt=next_attempt, lease_owner='',
+                                lease_expires=None)
+        if deferred:
+            metrics.registry.observe('db_defer_seconds',
+                                     time.time() - start_time)
+        models.QueueCounter.objects.adjust(counts)
+        start_time = time.time()
+        bulk.insert(logs)
+        metrics.registry.observe('db_log_seconds', time.time() - start_time)
+    start_time = time.time()
+    record()
+    metrics.registry.observe('db_write_seconds', time.time() - start_time)
+    metrics.report_results(results, now)
+
+
+class ResultBuffer(object):
+    """
+    A write-behind buffer for the results of sending queued messages.
+
+    Results are collected with ``add`` and written to the database with
+    ``_record_many`` (one DELETE, one UPDATE and multi-row INSERTs) when the
+    buffer is flushed. The buffer flushes itself once it holds ``size``
+    results (the ``MAILER_WRITE_BUFFER_SIZE`` setting, or 500) or its oldest
+    result is ``interval`` seconds old (``MAILER_WRITE_BUFFER_INTERVAL``, or
+    5); the sending engine also flushes it at the end of each block. Given a
+    ``worker_id``, only messages still leased to it are updated.
+
+    Buffering results means that if the sending process dies, the messages
+    it sent since the last flush are still in the queue and will be sent
+    again once their leases expire. Delivery is at-least-once: at most the
+    results of one flush interval can be lost.
+
+    """
+    def __init__(self, size=None, interval=None, worker_id=None):
+        self.size = size or WRITE_BUFFER_SIZE
+        self.interval = interval or WRITE_BUFFER_INTERVAL
+        self.worker_id = worker_id
+        self.results = []
+        self.started = None
+
+    def add(self, queued_message, result, log_message):
+        if not self.results:
+            self.started = time.time()
+        self.results.append((queued_message, result, log_message))
+        if len(self.results) >= self.size or \
+                time.time() - self.started >= self.interval:
+            self.flush()
+
+    def flush(self):
+        results, self.results = self.results, []
+        _record_many(results, worker_id=self.worker_id)
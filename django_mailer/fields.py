@@ -0,0 +1,23 @@
+from django.db import models
+from django_mailer import compression
+
+
+class CompressedTextField(models.TextField):
+    """
+    A text field which is compressed in the database if the
+    ``MAILER_COMPRESSION`` setting is set (see ``django_mailer.compression``).
+
+    Values are always uncompressed in Python, and uncompressed values in the
+    database are read as they are. Lookups compare against the stored values,
+    so they don't match compressed values.
+
+    """
+    __metaclass__ = models.SubfieldBase
+
+    def to_python(self, value):
+        return compression.decompress(value)
+
+    def get_db_prep_save(self, value, connection):
+        value = super(CompressedTextField, self).get_db_prep_save(
+            value, connection=connection)
+        return compression.compress(value)
@@ -0,0 +1,42 @@
+from django.core.management.base import NoArgsCommand
+from django_mailer import models
+from django_mailer.management.commands import create_handler
+from optparse import make_option
+import logging
+import time
+
+
+class Command(NoArgsCommand):
+    help = 'Compress the stored message bodies which are not compressed yet.'
+    option_list = NoArgsCommand.option_list + (
+        make_option('-m', '--method', choices=('zlib', 'zstd'),
+            help='The compression method (defaults to the MAILER_COMPRESSION '
+                'setting, or zlib).'),
+        make_option('-l', '--level', type='int',
+            help='The compression level.'),
+        make_option('-b', '--batch-size', type='int', default=500,
+            help='The number of bodies compressed in each transaction.'),
+    )
+
+    def handle_noargs(self, verbosity, method=None, level=None,
+                      batch_size=500, **options):
+        # Send logged messages to the console.
+        logger = logging.getLogger('django_mailer')
+        handler = create_handler(verbosity)
+        logger.addHandler(handler)
+
+        logger = logging.getLogger(
+            'django_mailer.commands.compress_message_bodies')
+
+        def progress(count):
+            logger.info("%s bodies processed..." % count)
+        start_time = time.time()
+        count, before, after = models.MessageBody.objects.compress(
+            method=method, level=level, batch_size=batch_size,
+            progress=progress)
+        logger.warning("%s message bod%s compressed, %s characters saved "
+                       "(%s to %s)." % (count, count != 1 and 'ies' or 'y',
+                                        before - after, before, after))
+        logger.debug("Completed in %.2f seconds." % (time.time() - start_time))
+
+        logger.removeHandler(handler)
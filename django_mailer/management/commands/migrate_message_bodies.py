@@ -0,0 +1,32 @@
+from django.core.management.base import NoArgsCommand
+from django_mailer import bulk
+from django_mailer.management.commands import create_handler
+from optparse import make_option
+import logging
+
+
+class Command(NoArgsCommand):
+    help = ('Move the encoded messages of messages queued by older versions '
+            'into shared message bodies.')
+    option_list = NoArgsCommand.option_list + (
+        make_option('-c', '--chunk-size', type='int',
+            help='The number of messages converted in each transaction.'),
+    )
+
+    def handle_noargs(self, verbosity, chunk_size=None, **options):
+        # Send logged messages to the console.
+        logger = logging.getLogger('django_mailer')
+        handler = create_handler(verbosity)
+        logger.addHandler(handler)
+
+        logger = logging.getLogger(
+            'django_mailer.commands.migrate_message_bodies')
+
+        def progress(count):
+            logger.info("%s messages converted..." % count)
+        count = bulk.migrate_message_bodies(chunk_size=chunk_size,
+                                            progress=progress)
+        logger.warning("%s message%s converted" %
+                       (count, count != 1 and 's' or ''))
+
+        logger.removeHandler(handler)
@@ -0,0 +1,51 @@
+from django.core.management.base import CommandError, NoArgsCommand
+from django_mailer import retention
+from django_mailer.management.commands import create_handler
+from optparse import make_option
+import datetime
+import logging
+import os
+
+
+class Command(NoArgsCommand):
+    help = ('Delete old logs, and the sent messages which are no longer '
+            'logged.')
+    option_list = NoArgsCommand.option_list + (
+        make_option('-d', '--days', type='int', default=90,
+            help='Delete logs older than this many days (default 90).'),
+        make_option('-c', '--chunk-size', type='int',
+            help='The number of rows deleted in each transaction.'),
+        make_option('-a', '--archive',
+            help='Append the rows to this gzip-compressed JSON lines file '
+                'before deleting them.'),
+    )
+
+    def handle_noargs(self, verbosity, days=90, chunk_size=None,
+                      archive=None, **options):
+        if days < 0:
+            raise CommandError('--days must not be negative.')
+        if archive and not os.path.isdir(
+                os.path.dirname(os.path.abspath(archive))):
+            raise CommandError('The archive directory does not exist.')
+        # Send logged messages to the console.
+        logger = logging.getLogger('django_mailer')
+        handler = create_handler(verbosity)
+        logger.addHandler(handler)
+
+        logger = logging.getLogger('django_mailer.commands.purge_mail_log')
+        before = datetime.datetime.now() - datetime.timedelta(days=days)
+        if archive:
+            count = retention.archive(before, archive, chunk_size=chunk_size)
+            logger.info("%s row%s archived to %s" %
+                        (count, count != 1 and 's' or '', archive))
+
+        def progress(logs, messages):
+            logger.debug("%s logs and %s messages deleted..." %
+                         (logs, messages))
+        logs, messages = retention.purge(before, chunk_size=chunk_size,
+                                         progress=progress)
+        logger.warning("%s log%s and %s message%s deleted" %
+                       (logs, logs != 1 and 's' or '',
+                        messages, messages != 1 and 's' or ''))
+
+        logger.removeHandler(handler)
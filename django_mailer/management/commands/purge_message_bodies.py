@@ -0,0 +1,32 @@
+from django.core.management.base import NoArgsCommand
+from django_mailer import models
+from django_mailer.management.commands import create_handler
+from optparse import make_option
+import logging
+
+
+class Command(NoArgsCommand):
+    help = 'Delete message bodies which are no longer used by any message.'
+    option_list = NoArgsCommand.option_list + (
+        make_option('-a', '--min-age', type='int', default=3600,
+            help="Don't delete bodies which were last used less than this "
+                "many seconds ago (default 3600)."),
+        make_option('-c', '--chunk-size', type='int', default=1000,
+            help='The number of bodies deleted in each transaction.'),
+    )
+
+    def handle_noargs(self, verbosity, min_age=3600, chunk_size=1000,
+                      **options):
+        # Send logged messages to the console.
+        logger = logging.getLogger('django_mailer')
+        handler = create_handler(verbosity)
+        logger.addHandler(handler)
+
+        count = models.MessageBody.objects.purge_unused(
+            min_age=min_age, chunk_size=chunk_size)
+        logger = logging.getLogger(
+            'django_mailer.commands.purge_message_bodies')
+        logger.warning("%s unused message bod%s deleted" %
+                       (count, count != 1 and 'ies' or 'y'))
+
+        logger.removeHandler(handler)
@@ -0,0 +1,27 @@
+from django.core.management.base import NoArgsCommand
+from django_mailer import models
+from django_mailer.management.commands import create_handler
+import logging
+
+
+class Command(NoArgsCommand):
+    help = ('Recount the queue and reset the queue counters used by '
+            'send_mail --count and the queue depth metrics.')
+
+    def handle_noargs(self, verbosity, **options):
+        # Send logged messages to the console.
+        logger = logging.getLogger('django_mailer')
+        handler = create_handler(verbosity)
+        logger.addHandler(handler)
+
+        counts = models.QueueCounter.objects.rebuild()
+        queued = sum([count for (priority, deferred), count in counts.items()
+                      if not deferred])
+        deferred = sum(counts.values()) - queued
+        logger = logging.getLogger(
+            'django_mailer.commands.rebuild_queue_counters')
+        logger.warning("Queue counters reset to %s queued and %s deferred "
+                       "message%s" % (queued, deferred,
+                                      deferred != 1 and 's' or ''))
+
+        logger.removeHandler(handler)
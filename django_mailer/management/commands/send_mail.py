@@ -1,10 +1,11 @@
 from django.conf import settings
-from django.core.management.base import NoArgsCommand
+from django.core.management.base import CommandError, NoArgsCommand
 from django.db import connection
-from django_mailer import models
+from django_mailer import models, profiling
 from django_mailer.engine import send_all
 from django_mailer.management.commands import create_handler
 from optparse import make_option
+import datetime
 import logging
 import sys
 
@@ -20,33 +21,76 @@ class Command(NoArgsCommand):
             help='The number of messages to iterate before checking the queue '
                 'again (in case new messages have been added while the queue '
                 'is being cleared).'),
+        make_option('-w', '--workers', default=1, type='int',
+            help='The number of threads delivering messages in parallel, each '
+                'with its own SMTP connection.'),
+        make_option('-a', '--async', action='store_true', dest='use_async',
+            default=False,
+            help='Deliver messages over many concurrent SMTP sessions from a '
+                'single thread.'),
+        make_option('--concurrency', type='int',
+            help='The maximum number of concurrent SMTP sessions used with '
+                '--async.'),
         make_option('-c', '--count', action='store_true', default=False,
             help='Return the number of messages in the queue (without '
                 'actually sending any)'),
+        make_option('--exact', action='store_true', default=False,
+            help='Count the queue itself with --count, rather than reading '
+                'the queue counters.'),
+        make_option('-p', '--profile', action='store_true', default=False,
+            help='Write a summary of the time spent in each phase of sending '
+                '(and a cProfile dump for sampled runs).'),
+        make_option('--profile-dir',
+            help='The directory the profiling files are written to (default '
+                'the current directory).'),
+        make_option('--profile-rate', type='float', default=1.0,
+            help='The fraction of --profile runs which are run under '
+                'cProfile (default 1).'),
     )
 
-    def handle_noargs(self, verbosity, block_size, count, **options):
+    def handle_noargs(self, verbosity, block_size, count, workers=1,
+                      use_async=False, concurrency=None, profile=False,
+                      profile_dir=None, profile_rate=1.0, exact=False,
+                      **options):
         # If this is just a count request the just calculate, report and exit.
         if count:
-            queued = models.QueuedMessage.objects.non_deferred().count()
-            deferred = models.QueuedMessage.objects.non_deferred().count()
-            sys.stdout.write('%s queued message%s (and %s deferred message%s).'
-                             '\n' % (queued, queued != 1 and 's' or '',
-                                     deferred, deferred != 1 and 's' or ''))
+            self.write_count(exact)
             sys.exit()
 
+        if not 0 <= profile_rate <= 1:
+            raise CommandError('--profile-rate must be between 0 and 1.')
+
         # Send logged messages to the console.
         logger = logging.getLogger('django_mailer')
         handler = create_handler(verbosity)
         logger.addHandler(handler)
 
         # if PAUSE_SEND is turned on don't do anything.
-        if not PAUSE_SEND:
-            send_all(block_size)
-        else:
+        if PAUSE_SEND:
             logger = logging.getLogger('django_mailer.commands.send_mail')
             logger.warning("Sending is paused, exiting without sending "
                            "queued mail.")
+        else:
+            if use_async:
+                from django_mailer import async_engine
+
+                def send():
+                    async_engine.send_all(block_size, concurrency=concurrency)
+            else:
+                def send():
+                    send_all(block_size, workers=workers)
+            if profile:
+                summary_path, profile_path = profiling.profile(
+                    send, directory=profile_dir, rate=profile_rate)
+                command_logger = logging.getLogger(
+                    'django_mailer.commands.send_mail')
+                command_logger.info("Profile summary written to %s" %
+                                    summary_path)
+                if profile_path:
+                    command_logger.info("cProfile statistics written to %s" %
+                                        profile_path)
+            else:
+                send()
 
         logger.removeHandler(handler)
 
@@ -54,3 +98,29 @@ class Command(NoArgsCommand):
         # Postgres log files caused by the database connection not being
         # explicitly closed.
         connection.close()
+
+    def write_count(self, exact=False):
+        if exact:
+            counts = models.QueuedMessage.objects.exact_counts()
+        else:
+            counts = models.QueueCounter.objects.counts()
+        queued = sum([count for (priority, deferred), count in counts.items()
+                      if not deferred])
+        deferred = sum(counts.values()) - queued
+        sys.stdout.write('%s queued message%s (and %s deferred message%s).'
+                         '\n' % (queued, queued != 1 and 's' or '',
+                                 deferred, deferred != 1 and 's' or ''))
+        now = datetime.datetime.now()
+        for priority, name in models.PRIORITIES:
+            queued = counts.get((priority, False), 0)
+            deferred = counts.get((priority, True), 0)
+            if not queued and not deferred:
+                continue
+            line = '  %s: %s queued, %s deferred' % (name, queued,
+                                                      deferred)
+            oldest = queued and models.QueuedMessage.objects.oldest(priority)
+            if oldest:
+                age = now - oldest
+                line += ', oldest queued %s seconds ago' % max(
+                    0, age.days * 86400 + age.seconds)
+            sys.stdout.write(line + '\n')
@@ -1,5 +1,28 @@
-from django.db import models
-from django_mailer import constants
+from django.conf import settings
+from django.db import connections, models, transaction, IntegrityError
+from django_mailer import compression, constants
+import datetime
+
+
+def supports_skip_locked(connection):
+    """
+    Return whether the database connection supports ``SELECT ... FOR UPDATE
+    SKIP LOCKED`` (PostgreSQL 9.5+ and MySQL 8.0.1+).
+
+    The ``MAILER_SKIP_LOCKED`` setting can be set to ``True`` or ``False`` to
+    override the detection.
+
+    """
+    skip_locked = getattr(settings, 'MAILER_SKIP_LOCKED', None)
+    if skip_locked is not None:
+        return skip_locked
+    if connection.vendor == 'postgresql':
+        connection.cursor()
+        return connection.connection.server_version >= 90500
+    if connection.vendor == 'mysql':
+        connection.cursor()
+        return connection.get_server_version() >= (8, 0, 1)
+    return False
 
 
 class QueueManager(models.Manager):
@@ -43,9 +66,9 @@ class QueueManager(models.Manager):
     def retry_deferred(self, max_retries=None, new_priority=None):
         """
         Reset the deferred flag for all deferred messages so they will be
-        retried.
+        retried straight away.
         
-        If ``max_retries`` is set, deferred messages which have been retried
+        If ``max_retries`` is set, deferred messages which have failed
         more than this many times will *not* have their deferred flag reset.
         
         If ``new_priority`` is ``None`` (default), deferred messages retain
@@ -56,9 +79,418 @@ class QueueManager(models.Manager):
         queryset = self.deferred()
         if max_retries:
             queryset = queryset.filter(retries__lte=max_retries)
-        count = queryset.count()
-        update_kwargs = dict(deferred=None, retries=models.F('retries')+1)
+        update_kwargs = dict(deferred=None, next_attempt=None)
         if new_priority is not None:
             update_kwargs['priority'] = new_priority
-        queryset.update(**update_kwargs)
-        return count
+        counters = models.get_model('django_mailer', 'QueueCounter').objects
+
+        @transaction.commit_on_success(using=self.db)
+        def retry():
+            changes = {}
+            for priority, count in queryset.order_by()\
+                                           .values_list('priority')\
+                                           .annotate(models.Count('pk')):
+                changes[(priority, True)] = \
+                    changes.get((priority, True), 0) - count
+                key = (new_priority is None and priority or new_priority,
+                       False)
+                changes[key] = changes.get(key, 0) + count
+            queryset.update(**update_kwargs)
+            counters.adjust(changes)
+            return sum([count for count in changes.values() if count > 0])
+        return retry()
+
+    def exact_counts(self):
+        """
+        Count the queued messages with ``COUNT`` queries, returning a
+        dictionary of the counts keyed by ``(priority, deferred)`` tuples.
+
+        """
+        counts = {}
+        for deferred, queryset in ((False, self.non_deferred()),
+                                   (True, self.deferred())):
+            for priority, count in queryset.order_by()\
+                                           .values_list('priority')\
+                                           .annotate(models.Count('pk')):
+                counts[(priority, deferred)] = count
+        return counts
+
+    def oldest(self, priority, deferred=False):
+        """
+        Return when the oldest queued message with a priority and state was
+        queued, or ``None`` if there are none.
+
+        For messages which aren't deferred, this is a single seek of the
+        queue index.
+
+        """
+        if deferred:
+            queryset = self.deferred()
+        else:
+            queryset = self.non_deferred()
+        dates = list(queryset.filter(priority=priority)
+                     .order_by('date_queued')
+                     .values_list('date_queued', flat=True)[:1])
+        return dates and dates[0] or None
+
+    def due(self):
+        """
+        Return a QuerySet of queued messages which are due to be sent: those
+        which aren't deferred and deferred messages whose next attempt is
+        due.
+
+        """
+        now = datetime.datetime.now()
+        return self.filter(models.Q(deferred=None) |
+                           models.Q(next_attempt__lte=now))
+
+    def available(self):
+        """
+        Return a QuerySet of queued messages which are due to be sent and not
+        leased to a sending process (or whose lease has expired).
+
+        """
+        now = datetime.datetime.now()
+        return self.due().filter(models.Q(lease_expires=None) |
+                                 models.Q(lease_expires__lte=now))
+
+    def claim(self, owner, limit=None, lease_duration=300, after=None):
+        """
+        Lease up to ``limit`` available messages (in queue order) to
+        ``owner`` for ``lease_duration`` seconds, returning a QuerySet of all
+        messages leased to ``owner``.
+
+        Deferred messages which are due to be retried are claimed first, then
+        messages in queue order. To claim the blocks of a large queue one
+        after another without sorting the whole queue for each block, pass
+        the ``(priority, date_queued, pk)`` of the last message claimed from
+        the previous block as ``after``: only messages which come after it in
+        the queue are claimed (seeking through the composite index on
+        ``(deferred, priority, date_queued, id)``). If a message with a higher
+        priority has become available since, ``after`` is ignored so that it
+        is claimed straight away.
+
+        Claiming is atomic, so concurrent processes never lease the same
+        message. Where the database supports it, the available messages are
+        locked with ``SELECT ... FOR UPDATE SKIP LOCKED`` so that concurrent
+        processes claim different blocks without waiting on each other.
+        Otherwise the leases are set with a compare-and-set UPDATE which only
+        matches messages that are still available.
+
+        """
+        connection = connections[self.db]
+        now = datetime.datetime.now()
+        expires = now + datetime.timedelta(seconds=lease_duration)
+        unleased = models.Q(lease_expires=None) | \
+            models.Q(lease_expires__lte=now)
+        retries = self.filter(unleased, deferred__isnull=False,
+                              next_attempt__lte=now).order_by('next_attempt')
+        queue = self.filter(unleased, deferred=None)\
+                    .order_by('priority', 'date_queued', 'pk')
+        if after is not None and \
+                queue.filter(priority__lt=after[0]).exists():
+            after = None
+        if after is None:
+            sources = [retries, queue]
+        else:
+            priority, date_queued, pk = after
+            sources = [
+                retries,
+                queue.filter(priority=priority, date_queued__gte=date_queued)
+                     .exclude(date_queued=date_queued, pk__lte=pk),
+                queue.filter(priority__gt=priority),
+            ]
+
+        def lease(ids):
+            self.available().filter(pk__in=ids)\
+                .update(lease_owner=owner, lease_expires=expires)
+
+        def claim_all(select):
+            remaining = limit
+            for queryset in sources:
+                ids = queryset.values_list('pk', flat=True)
+                if limit:
+                    if remaining <= 0:
+                        break
+                    ids = ids[:remaining]
+                ids = select(ids)
+                if ids:
+                    lease(ids)
+                    if limit:
+                        remaining -= len(ids)
+
+        if supports_skip_locked(connection):
+            def select_locked(ids):
+                sql, params = ids.query.get_compiler(self.db).as_sql()
+                cursor = connection.cursor()
+                cursor.execute('%s FOR UPDATE SKIP LOCKED' % sql, params)
+                return [row[0] for row in cursor.fetchall()]
+            transaction.commit_on_success(using=self.db)(claim_all)(
+                select_locked)
+        else:
+            claim_all(list)
+        return self.filter(lease_owner=owner)
+
+    def lock_states(self, ids, owner=None):
+        """
+        Return the ``(priority, deferred)`` state of the queued messages with
+        the given ids (which are leased to ``owner``, if given) as a
+        dictionary keyed by their ids. Messages which are no longer in the
+        queue are left out.
+
+        Call this in a transaction: except on SQLite (which serializes writes
+        anyway), the messages are locked with ``SELECT ... FOR UPDATE`` until
+        the transaction ends, so they can't be changed by another process
+        before they are updated.
+
+        """
+        connection = connections[self.db]
+        queryset = self.filter(pk__in=ids)
+        if owner is not None:
+            queryset = queryset.filter(lease_owner=owner)
+        queryset = queryset.order_by().values_list('pk', 'priority',
+                                                   'deferred')
+        if connection.vendor == 'sqlite':
+            rows = list(queryset)
+        else:
+            sql, params = queryset.query.get_compiler(self.db).as_sql()
+            cursor = connection.cursor()
+            cursor.execute('%s FOR UPDATE' % sql, params)
+            rows = cursor.fetchall()
+        return dict((pk, (priority, deferred is not None))
+                    for pk, priority, deferred in rows)
+
+    def renew_leases(self, owner, lease_duration=300):
+        """
+        Extend the lease of all messages leased to ``owner`` so they expire
+        ``lease_duration`` seconds from now.
+
+        """
+        expires = datetime.datetime.now() + \
+            datetime.timedelta(seconds=lease_duration)
+        return self.filter(lease_owner=owner).update(lease_expires=expires)
+
+    def hold(self, ids, until):
+        """
+        Hold back the (leased) messages with the given ids until ``until``
+        without deferring them: they are released, but can't be claimed again
+        before then.
+
+        """
+        return self.filter(pk__in=ids)\
+                   .update(lease_owner='', lease_expires=until)
+
+    def release_leases(self, owner):
+        """
+        Release all messages leased to ``owner`` so that they are immediately
+        available to other sending processes.
+
+        """
+        return self.filter(lease_owner=owner)\
+                   .update(lease_owner='', lease_expires=None)
+
+
+class CounterManager(models.Manager):
+    """
+    The manager of ``QueueCounter``, which keeps a count of the queued
+    messages for each priority and state (deferred or not).
+
+    """
+    def adjust(self, changes):
+        """
+        Apply a dictionary of changes to the counts, keyed by ``(priority,
+        deferred)`` tuples. Call this in the same transaction as the change
+        to the queue.
+
+        The counts are changed with ``UPDATE ... SET count = count + n`` so
+        concurrent changes never overwrite each other.
+
+        """
+        for (priority, deferred), change in sorted(changes.items()):
+            if not change:
+                continue
+            queryset = self.filter(priority=priority, deferred=deferred)
+            if queryset.update(count=models.F('count') + change):
+                continue
+            sid = transaction.savepoint(using=self.db)
+            try:
+                self.create(priority=priority, deferred=deferred,
+                            count=change)
+            except IntegrityError:
+                # A concurrent transaction created the counter first.
+                transaction.savepoint_rollback(sid, using=self.db)
+                queryset.update(count=models.F('count') + change)
+            else:
+                transaction.savepoint_commit(sid, using=self.db)
+
+    def counts(self):
+        """
+        Return a dictionary of the counts, keyed by ``(priority, deferred)``
+        tuples.
+
+        """
+        return dict(((priority, deferred), count)
+                    for priority, deferred, count in
+                    self.values_list('priority', 'deferred', 'count'))
+
+    def rebuild(self):
+        """
+        Recount the queue (with ``COUNT`` queries) and replace the counts in
+        a single transaction, returning the new counts.
+
+        The counters are locked (by updating them) before the queue is
+        counted, so that changes made to the queue while it is counted are
+        neither lost nor counted twice.
+
+        """
+        queue = models.get_model('django_mailer', 'QueuedMessage').objects
+
+        @transaction.commit_on_success(using=self.db)
+        def rebuild():
+            self.update(count=models.F('count'))
+            counts = queue.exact_counts()
+            for key in set(self.counts()) - set(counts):
+                counts[key] = 0
+            for (priority, deferred), count in counts.items():
+                if not self.filter(priority=priority, deferred=deferred)\
+                           .update(count=count):
+                    self.create(priority=priority, deferred=deferred,
+                                count=count)
+            return counts
+        return rebuild()
+
+
+class TemplateManager(models.Manager):
+
+    def store(self, from_address, subject, text, html=''):
+        """
+        Return the ``MessageTemplate`` for a set of mail merge templates,
+        creating it if it doesn't exist yet.
+
+        """
+        template, created = self.get_or_create(
+            hash=self.model.get_hash(from_address, subject, text, html),
+            defaults={'from_address': from_address, 'subject': subject,
+                      'text': text, 'html': html})
+        if not created:
+            template.date_used = datetime.datetime.now()
+            self.filter(pk=template.pk).update(date_used=template.date_used)
+        return template
+
+
+class BodyManager(models.Manager):
+
+    def store(self, encoded_message):
+        """
+        Return the ``MessageBody`` for an encoded message, creating it if it
+        doesn't exist yet.
+
+        """
+        body, created = self.get_or_create(
+            hash=self.model.get_hash(encoded_message),
+            defaults={'encoded_message': encoded_message})
+        if not created:
+            body.date_used = datetime.datetime.now()
+            self.filter(pk=body.pk).update(date_used=body.date_used)
+        return body
+
+    def unused(self, min_age=3600):
+        """
+        Return a QuerySet of bodies which no message uses and which haven't
+        been given to a new message for at least ``min_age`` seconds.
+
+        """
+        cutoff = datetime.datetime.now() - \
+            datetime.timedelta(seconds=min_age)
+        return self.filter(message=None, date_used__lt=cutoff)
+
+    def purge_unused(self, min_age=3600, chunk_size=1000):
+        """
+        Delete the bodies which no message uses (see ``unused``) in chunks
+        of ``chunk_size``, each in its own transaction, returning the number
+        of bodies deleted.
+
+        A body is only deleted if it is still unused at the time of the
+        DELETE, so that a body which has just been given to a new message
+        survives. The ``min_age`` grace period covers messages which are
+        being queued in a transaction that hasn't been committed yet.
+
+        """
+        connection = connections[self.db]
+        qn = connection.ops.quote_name
+        related = self.model.message_set.related
+        body_table = qn(self.model._meta.db_table)
+        body_pk = qn(self.model._meta.pk.column)
+        message_table = qn(related.model._meta.db_table)
+        message_body = qn(related.field.column)
+        deleted = 0
+        while True:
+            ids = list(self.unused(min_age).values_list('pk', flat=True)
+                       .order_by('pk')[:chunk_size])
+            if not ids:
+                break
+
+            @transaction.commit_on_success(using=self.db)
+            def delete():
+                cursor = connection.cursor()
+                cursor.execute(
+                    'DELETE FROM %s WHERE %s IN (%s) AND NOT EXISTS '
+                    '(SELECT 1 FROM %s WHERE %s.%s = %s.%s)' % (
+                        body_table, body_pk, ', '.join(['%s'] * len(ids)),
+                        message_table, message_table, message_body,
+                        body_table, body_pk), ids)
+                transaction.set_dirty(using=self.db)
+                return cursor.rowcount
+            count = delete()
+            deleted += count
+            if not count:
+                # Every body in the chunk is in use again.
+                break
+        return deleted
+
+    def compress(self, method=None, level=None, batch_size=500,
+                 progress=None):
+        """
+        Compress the stored bodies which aren't compressed yet with
+        ``method`` (the ``MAILER_COMPRESSION`` setting by default, or
+        ``'zlib'``), in batches of ``batch_size`` bodies, each in its own
+        transaction.
+
+        If a ``progress`` callable is provided, it is called after each batch
+        with the number of bodies looked at so far.
+
+        Returns a tuple of the number of bodies compressed and their total
+        stored size (in characters) before and after compression.
+
+        """
+        method = method or compression.METHOD or 'zlib'
+        queryset = self.order_by('pk')
+        count = size_before = size_after = seen = 0
+        last_pk = 0
+        while True:
+            rows = list(queryset.filter(pk__gt=last_pk)
+                        .values_list('pk', 'encoded_message')[:batch_size])
+            if not rows:
+                break
+            last_pk = rows[-1][0]
+            compressed = []
+            for pk, stored in rows:
+                if compression.method_of(stored):
+                    continue
+                value = compression.compress(stored, method=method,
+                                             level=level)
+                if value is not stored:
+                    compressed.append((pk, value))
+                    size_before += len(stored)
+                    size_after += len(value)
+
+            @transaction.commit_on_success(using=self.db)
+            def update():
+                for pk, value in compressed:
+                    self.filter(pk=pk).update(encoded_message=value)
+            update()
+            count += len(compressed)
+            seen += len(rows)
+            if progress:
+                progress(seen)
+        return count, size_before, size_after
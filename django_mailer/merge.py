@@ -0,0 +1,75 @@
+"""
+Mail merges: messages rendered from templates for each recipient when they
+are sent, rather than when they are queued.
+
+A mail merge stores its subject, text and (optional) HTML templates once, in
+a ``MessageTemplate``, and each queued message only stores its recipient's
+context as JSON. Compiled templates are cached by each sending process, so a
+template is only compiled once however many messages use it.
+
+"""
+from django.conf import settings
+from django.core.mail import EmailMultiAlternatives
+from django.core.serializers.json import DjangoJSONEncoder
+from django.template import Context, Template
+from django.utils import simplejson
+from django.utils.encoding import force_unicode
+import threading
+
+
+# The number of compiled templates kept by each sending process.
+CACHE_SIZE = getattr(settings, "MAILER_MERGE_CACHE_SIZE", 100)
+
+_cache = {}
+_cache_lock = threading.Lock()
+
+
+def encode_context(context):
+    """
+    Return a recipient's context encoded as compact JSON. Dates and decimals
+    are encoded as strings.
+
+    """
+    return DjangoJSONEncoder(separators=(',', ':')).encode(context or {})
+
+
+def compiled(template):
+    """
+    Return the compiled subject, text and HTML (or ``None``) templates of a
+    ``MessageTemplate``, from the cache if it has been compiled before.
+
+    """
+    templates = _cache.get(template.hash)
+    if templates is None:
+        templates = (Template(template.subject), Template(template.text),
+                     template.html and Template(template.html) or None)
+        _cache_lock.acquire()
+        try:
+            if len(_cache) >= CACHE_SIZE:
+                _cache.clear()
+            _cache[template.hash] = templates
+        finally:
+            _cache_lock.release()
+    return templates
+
+
+def render(template, context, to_address):
+    """
+    Render a ``MessageTemplate`` with a recipient's JSON encoded context,
+    returning the encoded message.
+
+    The recipient is available to the templates as ``to_address``. The
+    subject and text are rendered without autoescaping.
+
+    """
+    subject, text, html = compiled(template)
+    context = simplejson.loads(context or '{}')
+    context.setdefault('to_address', to_address)
+    plain = Context(context, autoescape=False)
+    email_message = EmailMultiAlternatives(
+        ' '.join(subject.render(plain).split()), text.render(plain),
+        template.from_address, [to_address])
+    if html is not None:
+        email_message.attach_alternative(html.render(Context(context)),
+                                         'text/html')
+    return force_unicode(email_message.message().as_string())
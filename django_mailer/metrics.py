@@ -0,0 +1,400 @@
+"""
+Metrics for the sending engines.
+
+The engines report counters, gauges and histograms to the in-process
+``registry``, which passes each measurement on to the configured sinks (see
+``Sink``). The registry can be exported in the Prometheus text format, to a
+file for the node exporter's textfile collector (``PrometheusFileSink``) or
+over HTTP for a local scraper (``start_http_server``).
+
+The metrics reported by the engines are described in ``METRICS``.
+
+"""
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.importlib import import_module
+from django_mailer import constants, models
+import BaseHTTPServer
+import bisect
+import os
+import tempfile
+import threading
+
+
+# Dotted paths of the sink classes (or ``(path, kwargs)`` tuples) which
+# measurements are passed on to.
+SINKS = getattr(settings, "MAILER_METRICS_SINKS", ())
+
+# A file to write the metrics to in the Prometheus text format at the end of
+# each sending run.
+PROMETHEUS_FILE = getattr(settings, "MAILER_METRICS_FILE", None)
+
+# The port (on localhost) which ``send_loop`` serves the metrics on in the
+# Prometheus text format.
+PROMETHEUS_PORT = getattr(settings, "MAILER_METRICS_PORT", None)
+
+PREFIX = 'django_mailer_'
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0)
+AGE_BUCKETS = (1, 5, 15, 60, 300, 900, 3600, 4 * 3600, 24 * 3600,
+               7 * 24 * 3600)
+
+# The type, description and (for histograms) buckets of each metric.
+METRICS = {
+    'messages_total': ('counter', 'Messages processed, by result and '
+                       'recipient domain.'),
+    'smtp_reconnects_total': ('counter', 'Reconnections to the mail server '
+                              'after the connection was lost.'),
+    'smtp_seconds': ('histogram', 'Time taken by each SMTP transaction.',
+                     LATENCY_BUCKETS),
+    'db_fetch_seconds': ('histogram', 'Time taken to claim and load each '
+                         'block of queued messages.', LATENCY_BUCKETS),
+    'db_write_seconds': ('histogram', 'Time taken to write each batch of '
+                         'results to the database.', LATENCY_BUCKETS),
+    'db_delete_seconds': ('histogram', 'Time taken to delete the sent and '
+                          'skipped messages of each batch of results.',
+                          LATENCY_BUCKETS),
+    'db_defer_seconds': ('histogram', 'Time taken to defer the failed '
+                         'messages of each batch of results.',
+                         LATENCY_BUCKETS),
+    'db_log_seconds': ('histogram', 'Time taken to insert the logs of each '
+                       'batch of results.', LATENCY_BUCKETS),
+    'blacklist_seconds': ('histogram', 'Time taken to check the recipients '
+                          'of each block against the blacklist.',
+                          LATENCY_BUCKETS),
+    'queue_age_seconds': ('histogram', 'Time messages spent in the queue '
+                          'before they were sent.', AGE_BUCKETS),
+    'queue_depth': ('gauge', 'Messages in the queue, by priority and '
+                    'state.'),
+}
+
+# The ``result`` label of each result code.
+RESULTS = {
+    constants.RESULT_SENT: 'sent',
+    constants.RESULT_FAILED: 'deferred',
+    constants.RESULT_SKIPPED: 'skipped',
+}
+
+_label_escapes = (('\\', '\\\\'), ('\n', '\\n'), ('"', '\\"'))
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(labels, extra=()):
+    items = list(labels) + list(extra)
+    if not items:
+        return ''
+    formatted = []
+    for name, value in items:
+        value = unicode(value)
+        for character, escaped in _label_escapes:
+            value = value.replace(character, escaped)
+        formatted.append(u'%s="%s"' % (name, value))
+    return u'{%s}' % u','.join(formatted)
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Histogram(object):
+    """
+    The cumulative bucket counts, sum and count of a histogram.
+
+    """
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        total = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            yield bound, total
+
+
+class Sink(object):
+    """
+    The interface of a metrics sink. Each measurement reported to the
+    registry is passed on to every sink, and ``flush`` is called at the end
+    of each sending run with the registry.
+
+    Sinks must be thread-safe, since messages can be delivered by several
+    threads at once.
+
+    """
+    def increment(self, name, value, labels):
+        pass
+
+    def set(self, name, value, labels):
+        pass
+
+    def observe(self, name, value, labels):
+        pass
+
+    def flush(self, registry):
+        pass
+
+
+class PrometheusFileSink(Sink):
+    """
+    Write the whole registry to ``path`` in the Prometheus text format when
+    it is flushed. The file is replaced atomically, so a scraper never sees a
+    partial file.
+
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def flush(self, registry):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        try:
+            os.write(fd, registry.render().encode('utf-8'))
+        finally:
+            os.close(fd)
+        os.chmod(temp_path, 0644)
+        os.rename(temp_path, self.path)
+
+
+class Registry(object):
+    """
+    An in-process registry of counters, gauges and histograms, each
+    identified by its name and labels.
+
+    """
+    def __init__(self, sinks=()):
+        self.lock = threading.Lock()
+        self.sinks = list(sinks)
+        self.reset()
+
+    def reset(self):
+        self.lock.acquire()
+        try:
+            self.counters = {}
+            self.gauges = {}
+            self.histograms = {}
+        finally:
+            self.lock.release()
+
+    def increment(self, name, value=1, **labels):
+        key = (name, _label_key(labels))
+        self.lock.acquire()
+        try:
+            self.counters[key] = self.counters.get(key, 0) + value
+        finally:
+            self.lock.release()
+        for sink in self.sinks:
+            sink.increment(name, value, labels)
+
+    def set(self, name, value, **labels):
+        key = (name, _label_key(labels))
+        self.lock.acquire()
+        try:
+            self.gauges[key] = value
+        finally:
+            self.lock.release()
+        for sink in self.sinks:
+            sink.set(name, value, labels)
+
+    def observe(self, name, value, **labels):
+        key = (name, _label_key(labels))
+        self.lock.acquire()
+        try:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                metric = METRICS.get(name, ())
+                buckets = len(metric) > 2 and metric[2] or LATENCY_BUCKETS
+                histogram = self.histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+        finally:
+            self.lock.release()
+        for sink in self.sinks:
+            sink.observe(name, value, labels)
+
+    def flush(self):
+        for sink in self.sinks:
+            sink.flush(self)
+
+    def value(self, name, **labels):
+        """
+        Return the value of a counter or gauge (or the ``Histogram`` of a
+        histogram), or ``None`` if nothing has been reported for it.
+
+        """
+        key = (name, _label_key(labels))
+        for metrics in (self.counters, self.gauges, self.histograms):
+            if key in metrics:
+                return metrics[key]
+
+    def render(self):
+        """
+        Return the metrics in the Prometheus text exposition format.
+
+        """
+        self.lock.acquire()
+        try:
+            metrics = {}
+            for kind, values in (('counter', self.counters),
+                                 ('gauge', self.gauges)):
+                for (name, labels), value in values.items():
+                    metrics.setdefault(name, (kind, []))[1].append(
+                        (labels, value))
+            for (name, labels), histogram in self.histograms.items():
+                metrics.setdefault(name, ('histogram', []))[1].append(
+                    (labels, (list(histogram.cumulative()), histogram.sum,
+                              histogram.count)))
+        finally:
+            self.lock.release()
+        lines = []
+        for name in sorted(metrics):
+            kind, samples = metrics[name]
+            full_name = PREFIX + name
+            description = METRICS.get(name, (None, None))[1]
+            if description:
+                lines.append(u'# HELP %s %s' % (full_name, description))
+            lines.append(u'# TYPE %s %s' % (full_name, kind))
+            for labels, value in sorted(samples):
+                if kind != 'histogram':
+                    lines.append(u'%s%s %s' % (full_name,
+                                               _format_labels(labels),
+                                               _format_value(value)))
+                    continue
+                buckets, total, count = value
+                for bound, bucket_count in buckets:
+                    lines.append(u'%s_bucket%s %s' % (
+                        full_name,
+                        _format_labels(labels, [('le', _format_value(bound))]),
+                        bucket_count))
+                lines.append(u'%s_sum%s %s' % (full_name,
+                                               _format_labels(labels),
+                                               _format_value(total)))
+                lines.append(u'%s_count%s %s' % (full_name,
+                                                 _format_labels(labels),
+                                                 count))
+        return u'\n'.join(lines) + u'\n'
+
+
+def load_sink(import_path, **kwargs):
+    """
+    Create a sink from the dotted path of its class.
+
+    """
+    module_name, _, class_name = import_path.rpartition('.')
+    try:
+        sink_class = getattr(import_module(module_name), class_name)
+    except (ImportError, AttributeError), err:
+        raise ImproperlyConfigured('Error loading metrics sink %s: %s' %
+                                   (import_path, err))
+    return sink_class(**kwargs)
+
+
+def get_sinks():
+    """
+    Return the sinks configured by the ``MAILER_METRICS_SINKS`` and
+    ``MAILER_METRICS_FILE`` settings.
+
+    """
+    sinks = []
+    for sink in SINKS:
+        if isinstance(sink, basestring):
+            sinks.append(load_sink(sink))
+        else:
+            sinks.append(load_sink(sink[0], **sink[1]))
+    if PROMETHEUS_FILE:
+        sinks.append(PrometheusFileSink(PROMETHEUS_FILE))
+    return sinks
+
+
+registry = Registry(get_sinks())
+
+
+def is_exported():
+    """
+    Return whether the metrics are passed on to any sink or exporter, which
+    is when the queue depth is worth counting.
+
+    """
+    return bool(registry.sinks or PROMETHEUS_PORT)
+
+
+def report_results(results, now):
+    """
+    Count a list of ``(queued_message, result, log_message)`` tuples by
+    result and recipient domain, and the time the messages which were sent
+    spent in the queue (until ``now``).
+
+    """
+    counts = {}
+    for queued_message, result, log_message in results:
+        domain = queued_message.message.to_address.rpartition('@')[2].lower()
+        key = (RESULTS[result], domain)
+        counts[key] = counts.get(key, 0) + 1
+        if result == constants.RESULT_SENT:
+            age = now - queued_message.date_queued
+            registry.observe('queue_age_seconds', age.days * 86400 +
+                             age.seconds + age.microseconds / 1e6)
+    for (result, domain), count in counts.items():
+        registry.increment('messages_total', count, result=result,
+                           domain=domain)
+
+
+def collect_queue_depth():
+    """
+    Set the ``queue_depth`` gauges from the queue counters.
+
+    """
+    depths = dict(((priority, state), 0)
+                  for priority, name in models.PRIORITIES
+                  for state in ('queued', 'deferred'))
+    for (priority, deferred), count in \
+            models.QueueCounter.objects.counts().items():
+        depths[(priority, deferred and 'deferred' or 'queued')] = count
+    names = dict(models.PRIORITIES)
+    for (priority, state), count in depths.items():
+        registry.set('queue_depth', count,
+                     priority=names.get(priority, priority), state=state)
+
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Serve the registry in the Prometheus text format.
+
+    """
+    def do_GET(self):
+        body = registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_http_server(port=None, host='127.0.0.1'):
+    """
+    Serve the metrics over HTTP from a daemon thread, on ``port`` (the
+    ``MAILER_METRICS_PORT`` setting by default), returning the server.
+
+    """
+    if port is None:
+        port = PROMETHEUS_PORT
+    server = BaseHTTPServer.HTTPServer((host, port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.setDaemon(True)
+    thread.start()
+    return server
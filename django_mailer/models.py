@@ -1,6 +1,8 @@
-from django.db import models
-from django_mailer import constants, managers
+from django.db import models, router, transaction
+from django_mailer import constants, managers, merge, retry
+from django_mailer.fields import CompressedTextField
 import datetime
+import hashlib
 
 
 PRIORITIES = (
@@ -16,21 +18,112 @@ RESULT_CODES = (
 )
 
 
+def _in_transaction(func, using):
+    """
+    Call ``func`` in the current transaction if the transaction is managed,
+    otherwise in a transaction of its own.
+
+    """
+    if transaction.is_managed(using=using):
+        return func()
+    return transaction.commit_on_success(using=using)(func)()
+
+
+class MessageBody(models.Model):
+    """
+    The encoded content of one or more email messages.
+
+    Bodies are content-addressed: each distinct encoded message is stored
+    once, keyed by its SHA-1 ``hash``, and shared by every ``Message`` with
+    that content (such as the messages to each recipient of a mass mailing).
+    ``date_used`` is updated whenever a new message is given the body, so
+    that unused bodies are only removed once they have been unused for a
+    while (see ``BodyManager.purge_unused``).
+
+    The ``encoded_message`` is compressed in the database if the
+    ``MAILER_COMPRESSION`` setting is set.
+
+    """
+    hash = models.CharField(max_length=40, unique=True, editable=False)
+    encoded_message = CompressedTextField()
+    date_used = models.DateTimeField(default=datetime.datetime.now,
+                                     db_index=True)
+
+    objects = managers.BodyManager()
+
+    @staticmethod
+    def get_hash(encoded_message):
+        """
+        Return the hash which addresses an encoded message.
+
+        """
+        if isinstance(encoded_message, unicode):
+            encoded_message = encoded_message.encode('utf-8')
+        return hashlib.sha1(encoded_message).hexdigest()
+
+    def __unicode__(self):
+        return self.hash
+
+
+class MessageTemplate(models.Model):
+    """
+    The templates of a mail merge, which are rendered for each recipient when
+    their message is sent (see ``django_mailer.merge``).
+
+    Like message bodies, templates are addressed by the SHA-1 ``hash`` of
+    their content, so queueing the same mail merge again reuses them.
+
+    """
+    hash = models.CharField(max_length=40, unique=True, editable=False)
+    from_address = models.CharField(max_length=200)
+    subject = models.TextField()
+    text = models.TextField()
+    html = models.TextField(blank=True)
+    date_used = models.DateTimeField(default=datetime.datetime.now,
+                                     db_index=True)
+
+    objects = managers.TemplateManager()
+
+    @staticmethod
+    def get_hash(from_address, subject, text, html=''):
+        """
+        Return the hash which addresses a set of mail merge templates.
+
+        """
+        content = u'\0'.join([from_address, subject, text, html or ''])
+        return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+    def __unicode__(self):
+        return self.subject
+
+
 class Message(models.Model):
     """
     An email message.
     
     The ``to_address``, ``from_address`` and ``subject`` fields are merely for
-    easy of access for these common values. The ``encoded_message`` field
+    easy of access for these common values. The ``encoded_message`` property
     contains the entire encoded email message ready to be sent to an SMTP
-    connection.
+    connection, which is stored in a shared ``MessageBody``.
+
+    Messages queued before bodies were stored separately keep their encoded
+    message in ``legacy_encoded_message`` until they are moved with the
+    ``migrate_message_bodies`` command.
+
+    Messages queued by a mail merge have no body: their encoded message is
+    rendered from the ``template`` with the recipient's JSON ``context``
+    each time it is read.
     
     """
     to_address = models.CharField(max_length=200)
     from_address = models.CharField(max_length=200)
     subject = models.CharField(max_length=255)
 
-    encoded_message = models.TextField()
+    body = models.ForeignKey(MessageBody, null=True, editable=False)
+    legacy_encoded_message = models.TextField(blank=True, editable=False,
+                                              db_column='encoded_message')
+    template = models.ForeignKey(MessageTemplate, null=True, editable=False)
+    context = models.TextField(blank=True, editable=False)
     date_created = models.DateTimeField(default=datetime.datetime.now)
 
     class Meta:
@@ -39,6 +132,29 @@ class Message(models.Model):
     def __unicode__(self):
         return '%s: %s' % (self.to_address, self.subject)
 
+    def _get_encoded_message(self):
+        if hasattr(self, '_new_encoded_message'):
+            return self._new_encoded_message
+        if self.body_id:
+            return self.body.encoded_message
+        if self.template_id:
+            return merge.render(self.template, self.context, self.to_address)
+        return self.legacy_encoded_message
+
+    def _set_encoded_message(self, encoded_message):
+        # The body is looked up (or created) when the message is saved.
+        self._new_encoded_message = encoded_message
+        self.body = None
+
+    encoded_message = property(_get_encoded_message, _set_encoded_message)
+
+    def save(self, *args, **kwargs):
+        if hasattr(self, '_new_encoded_message'):
+            self.body = MessageBody.objects.store(self._new_encoded_message)
+            self.legacy_encoded_message = ''
+            del self._new_encoded_message
+        super(Message, self).save(*args, **kwargs)
+
 
 class QueuedMessage(models.Model):
     """
@@ -46,6 +162,16 @@ class QueuedMessage(models.Model):
     
     Messages in the queue can be prioritised so that the higher priority
     messages are sent first (secondarily sorted by the oldest message).
+
+    A message which fails to send is deferred and automatically retried at
+    ``next_attempt``, with an exponentially growing delay after each failure
+    (see ``django_mailer.retry``). ``retries`` counts the failures. Messages
+    which won't be retried automatically have no ``next_attempt``.
+
+    A sending process claims a block of queued messages before sending them
+    by leasing them: ``lease_owner`` identifies the process and the lease runs
+    until ``lease_expires``. Messages with an expired lease can be claimed
+    again by any process.
     
     """
     message = models.OneToOneField(Message, editable=False)
@@ -53,16 +179,90 @@ class QueuedMessage(models.Model):
                                             default=constants.PRIORITY_NORMAL)
     deferred = models.DateTimeField(null=True, blank=True)
     retries = models.PositiveIntegerField(default=0)
+    next_attempt = models.DateTimeField(null=True, blank=True, db_index=True)
     date_queued = models.DateTimeField(default=datetime.datetime.now)
+    lease_owner = models.CharField(max_length=100, blank=True, editable=False,
+                                   db_index=True)
+    lease_expires = models.DateTimeField(null=True, blank=True,
+                                         editable=False, db_index=True)
 
     objects = managers.QueueManager()
 
     class Meta:
         ordering = ('priority', 'date_queued')
 
+    def __init__(self, *args, **kwargs):
+        super(QueuedMessage, self).__init__(*args, **kwargs)
+        # The (priority, deferred) state the message is counted in, as it was
+        # loaded from the queue (or last saved).
+        self._counted = self.pk is not None and self._counter_key() or None
+
+    def _counter_key(self):
+        return (self.priority, self.deferred is not None)
+
     def defer(self):
+        previous = self._counter_key()
         self.deferred = datetime.datetime.now()
-        self.save()
+        self.retries += 1
+        self.next_attempt = retry.next_attempt(self.retries, self.deferred)
+        self.lease_owner = ''
+        self.lease_expires = None
+        self.save(previous=previous)
+
+    def save(self, *args, **kwargs):
+        """
+        Save the queued message, keeping the queue counters in step in the
+        same transaction.
+
+        The state the message is counted in can be passed as ``previous``;
+        it defaults to the state the message was loaded in.
+
+        """
+        previous = kwargs.pop('previous', self._counted)
+        using = kwargs.get('using') or router.db_for_write(self.__class__)
+
+        def save():
+            changes = {}
+            if previous is not None:
+                changes[previous] = -1
+            key = self._counter_key()
+            changes[key] = changes.get(key, 0) + 1
+            super(QueuedMessage, self).save(*args, **kwargs)
+            QueueCounter.objects.adjust(changes)
+        _in_transaction(save, using)
+        self._counted = self._counter_key()
+
+    def delete(self, *args, **kwargs):
+        using = kwargs.get('using') or router.db_for_write(self.__class__)
+        counted = self._counted or self._counter_key()
+
+        def delete():
+            super(QueuedMessage, self).delete(*args, **kwargs)
+            QueueCounter.objects.adjust({counted: -1})
+        _in_transaction(delete, using)
+        self._counted = None
+
+
+class QueueCounter(models.Model):
+    """
+    The number of queued messages with a priority, which are either
+    deferred or not.
+
+    The counts are kept up to date as messages are queued, sent, deferred
+    and retried, so the size of the queue can be found without counting it.
+    Changes made to the queue in other ways (such as deleting messages in the
+    admin) are only reflected once the counts are rebuilt with the
+    ``rebuild_queue_counters`` command.
+
+    """
+    priority = models.PositiveSmallIntegerField(choices=PRIORITIES)
+    deferred = models.BooleanField()
+    count = models.IntegerField(default=0)
+
+    objects = managers.CounterManager()
+
+    class Meta:
+        unique_together = ('priority', 'deferred')
 
 
 class Blacklist(models.Model):
@@ -70,17 +270,32 @@ class Blacklist(models.Model):
     A blacklisted email address.
     
     Messages attempted to be sent to e-mail addresses which appear on this
-    blacklist will be skipped entirely.
+    blacklist will be skipped entirely. Addresses are matched
+    case-insensitively, and an address of ``*@domain`` blacklists every
+    address at that domain.
     
     """
-    email = models.EmailField(max_length=200)
-    date_added = models.DateTimeField(default=datetime.datetime.now)
+    email = models.CharField(max_length=200,
+                             help_text='An e-mail address, or *@domain to '
+                                       'blacklist a whole domain.')
+    # The address as it is matched (lowercase, without any display name), so
+    # that it can be looked up by an index.
+    normalized_email = models.CharField(max_length=200, db_index=True,
+                                        editable=False)
+    date_added = models.DateTimeField(default=datetime.datetime.now,
+                                      db_index=True)
 
     class Meta:
         ordering = ('-date_added',)
         verbose_name = 'blacklisted e-mail address'
         verbose_name_plural = 'blacklisted e-mail addresses'
 
+    def save(self, *args, **kwargs):
+        # Imported here since the blacklist module imports this one.
+        from django_mailer.blacklist import normalize
+        self.normalized_email = normalize(self.email)
+        super(Blacklist, self).save(*args, **kwargs)
+
 
 class Log(models.Model):
     """
@@ -89,8 +304,23 @@ class Log(models.Model):
     """
     message = models.ForeignKey(Message, editable=False)
     result = models.PositiveSmallIntegerField(choices=RESULT_CODES)
-    date = models.DateTimeField(default=datetime.datetime.now)
+    date = models.DateTimeField(default=datetime.datetime.now, db_index=True)
     log_message = models.TextField()
 
     class Meta:
         ordering = ('-date',)
+
+
+class RateLimit(models.Model):
+    """
+    The state of a rate limit token bucket shared by sending processes (see
+    ``django_mailer.ratelimit``).
+
+    """
+    key = models.CharField(max_length=255, unique=True)
+    tokens = models.FloatField()
+    updated = models.FloatField(null=True)
+    version = models.PositiveIntegerField(default=0)
+
+    def __unicode__(self):
+        return self.key
@@ -0,0 +1,164 @@
+"""
+Waking up sending processes as soon as messages are queued.
+
+Rather than polling the queue, ``engine.send_loop`` waits on a ``Listener``
+which ``notify`` wakes up whenever messages have been queued. PostgreSQL
+(with psycopg2) uses ``LISTEN`` / ``NOTIFY``, which works across hosts. Other
+databases use a Unix datagram socket, which only wakes up a sending process
+on the same host. Either way, the sending process still checks the queue
+every ``MAILER_EMPTY_QUEUE_SLEEP`` seconds in case a notification is missed.
+
+"""
+from django.conf import settings
+from django.db import connection, transaction
+import errno
+import logging
+import os
+import select
+import socket
+import tempfile
+import time
+
+
+# Whether to notify sending processes when messages are queued.
+NOTIFY = getattr(settings, "MAILER_NOTIFY", True)
+
+# The PostgreSQL notification channel.
+CHANNEL = getattr(settings, "MAILER_NOTIFY_CHANNEL", "django_mailer")
+
+# The path of the Unix socket used with other databases. Processes queueing
+# messages need permission to write to it.
+SOCKET_PATH = getattr(settings, "MAILER_NOTIFY_SOCKET",
+                      os.path.join(tempfile.gettempdir(),
+                                   'django_mailer.sock'))
+
+logger = logging.getLogger('django_mailer.notify')
+
+
+def _use_postgresql():
+    return connection.vendor == 'postgresql' and \
+        'psycopg2' in connection.settings_dict['ENGINE']
+
+
+def _use_socket():
+    return hasattr(socket, 'AF_UNIX')
+
+
+def notify():
+    """
+    Wake up any sending processes waiting for messages to be queued.
+
+    Call this once the queued messages have been committed. With
+    PostgreSQL, the notification is delivered when the current transaction
+    is committed if there is one.
+
+    """
+    if not NOTIFY:
+        return
+    if _use_postgresql():
+        cursor = connection.cursor()
+        cursor.execute('NOTIFY %s' % connection.ops.quote_name(CHANNEL))
+        transaction.commit_unless_managed()
+    elif _use_socket():
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        try:
+            sock.setblocking(False)
+            sock.sendto('1', SOCKET_PATH)
+        except socket.error:
+            # Nothing is listening, or the listener has plenty of unread
+            # notifications already.
+            pass
+        sock.close()
+
+
+class Listener(object):
+    """
+    Wait for notifications that messages have been queued.
+
+    Create the listener *before* checking whether the queue is empty, so that
+    messages queued in between aren't missed. Only one process on a host can
+    listen on the Unix socket; any others fall back to polling.
+
+    """
+    def __init__(self):
+        self.method = None
+        self.sock = None
+        if not NOTIFY:
+            return
+        if _use_postgresql():
+            self.method = 'postgresql'
+            self.listen()
+        elif _use_socket():
+            try:
+                self.sock = self.bind()
+            except socket.error, err:
+                logger.debug("Not listening for notifications on %s: %s" %
+                             (SOCKET_PATH, err))
+            else:
+                self.method = 'socket'
+
+    def bind(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        try:
+            sock.bind(SOCKET_PATH)
+        except socket.error, err:
+            if err.args[0] != errno.EADDRINUSE or self.in_use():
+                sock.close()
+                raise
+            # The socket was left behind by a process which has stopped.
+            os.unlink(SOCKET_PATH)
+            sock.bind(SOCKET_PATH)
+        sock.setblocking(False)
+        return sock
+
+    def in_use(self):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        try:
+            probe.connect(SOCKET_PATH)
+        except socket.error:
+            return False
+        finally:
+            probe.close()
+        return True
+
+    def listen(self):
+        cursor = connection.cursor()
+        cursor.execute('LISTEN %s' % connection.ops.quote_name(CHANNEL))
+        transaction.commit_unless_managed()
+
+    def wait(self, timeout):
+        """
+        Wait up to ``timeout`` seconds for a notification, returning whether
+        there was one.
+
+        """
+        if self.method == 'postgresql':
+            # Listen again in case the database connection was reopened.
+            self.listen()
+            pg_connection = connection.connection
+            if not pg_connection.notifies:
+                select.select([pg_connection], [], [], timeout)
+                pg_connection.poll()
+            notified = bool(pg_connection.notifies)
+            del pg_connection.notifies[:]
+            return notified
+        if self.method == 'socket':
+            select.select([self.sock], [], [], timeout)
+            notified = False
+            while True:
+                try:
+                    self.sock.recv(64)
+                except socket.error:
+                    return notified
+                notified = True
+        time.sleep(timeout)
+        return False
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+            try:
+                os.unlink(SOCKET_PATH)
+            except OSError:
+                pass
@@ -0,0 +1,115 @@
+"""
+Profiling for sending runs.
+
+``profile`` runs a function (such as ``engine.send_all``) and reports where
+its time went: per-phase wall-clock timers (taken from the histograms the
+engines report to ``django_mailer.metrics``) and, for a sampled fraction of
+runs, a ``cProfile`` dump which can be loaded with ``pstats``.
+
+"""
+from django_mailer import metrics
+import cProfile
+import datetime
+import os
+import pstats
+import random
+import socket
+import StringIO
+import time
+
+
+# The phases of a sending run, as the histogram each phase is timed by and a
+# description.
+PHASES = (
+    ('db_fetch_seconds', 'block fetch'),
+    ('blacklist_seconds', 'blacklist lookup'),
+    ('smtp_seconds', 'SMTP send'),
+    ('db_delete_seconds', 'delete'),
+    ('db_defer_seconds', 'defer'),
+    ('db_log_seconds', 'log insert'),
+)
+
+
+def _snapshot():
+    totals = {}
+    for name, description in PHASES:
+        count = seconds = 0
+        for (metric, labels), histogram in \
+                metrics.registry.histograms.items():
+            if metric == name:
+                count += histogram.count
+                seconds += histogram.sum
+        totals[name] = (count, seconds)
+    return totals
+
+
+def summary(before, after, elapsed):
+    """
+    Return a table of the time spent in each phase between two snapshots of
+    the phase timers, out of a total of ``elapsed`` seconds.
+
+    """
+    lines = ['%-18s %8s %12s %10s %8s' % ('phase', 'calls', 'seconds',
+                                          'mean (ms)', '% wall')]
+    accounted = 0.0
+    for name, description in PHASES:
+        count = after[name][0] - before[name][0]
+        seconds = after[name][1] - before[name][1]
+        accounted += seconds
+        lines.append('%-18s %8d %12.3f %10.2f %7.1f%%' % (
+            description, count, seconds, count and seconds * 1000 / count,
+            elapsed and seconds * 100 / elapsed))
+    other = max(0.0, elapsed - accounted)
+    lines.append('%-18s %8s %12.3f %10s %7.1f%%' % (
+        'other', '', other, '', elapsed and other * 100 / elapsed))
+    lines.append('%-18s %8s %12.3f' % ('total (wall)', '', elapsed))
+    return '\n'.join(lines) + '\n'
+
+
+def profile(func, directory=None, rate=1.0, top=30):
+    """
+    Call ``func`` and write a summary of the time spent in each phase to a
+    ``.txt`` file in ``directory`` (the current directory by default).
+
+    With a probability of ``rate``, ``func`` is also run under ``cProfile``,
+    whose statistics are dumped to a ``.prof`` file (and the ``top``
+    functions by cumulative time added to the summary). The phase timers are
+    always collected, so a low ``rate`` makes the profiling cheap enough to
+    leave on.
+
+    Returns a tuple of the paths of the summary and the profile (``None`` if
+    this run wasn't profiled).
+
+    """
+    directory = directory or os.getcwd()
+    base = os.path.join(directory, 'send_mail-%s-%s-%s' % (
+        datetime.datetime.now().strftime('%Y%m%d-%H%M%S'),
+        socket.gethostname(), os.getpid()))
+    profiler = None
+    if random.random() < rate:
+        profiler = cProfile.Profile()
+    before = _snapshot()
+    start_time = time.time()
+    try:
+        if profiler is None:
+            func()
+        else:
+            profiler.runcall(func)
+    finally:
+        elapsed = time.time() - start_time
+        report = summary(before, _snapshot(), elapsed)
+        profile_path = None
+        if profiler is not None:
+            profile_path = base + '.prof'
+            profiler.dump_stats(profile_path)
+            output = StringIO.StringIO()
+            stats = pstats.Stats(profiler, stream=output)
+            stats.sort_stats('cumulative').print_stats(top)
+            report += '\n' + output.getvalue()
+        summary_path = base + '.txt'
+        summary_file = open(summary_path, 'w')
+        try:
+            summary_file.write(report)
+        finally:
+            summary_file.close()
+    return summary_path, profile_path
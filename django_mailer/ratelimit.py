@@ -0,0 +1,345 @@
+"""
+Token-bucket rate limiting of the messages sent to each recipient domain, and
+of all messages sent.
+
+Limits are given as a number of messages per second, or a tuple of the rate
+and the burst size (the number of messages which can be sent at once after a
+quiet period, which defaults to the rate)::
+
+    MAILER_RATE_LIMIT = 50
+    MAILER_DOMAIN_RATE_LIMITS = {
+        'gmail.com': (5, 20),
+        'outlook.com': 2,
+        # Every other domain.
+        '*': 10,
+    }
+
+The state of the buckets is kept in memory by default, so each sending
+process has its own limits. To share limits between sending processes, set
+``MAILER_RATE_LIMIT_STORAGE`` to ``'database'`` (shared by every host) or
+``'file'`` (a memory-mapped file, shared by the processes on one host).
+
+"""
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import IntegrityError, transaction
+import hashlib
+import logging
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+# The limit of all messages sent.
+GLOBAL_LIMIT = getattr(settings, "MAILER_RATE_LIMIT", None)
+
+# The limits of messages sent to each recipient domain.
+DOMAIN_LIMITS = getattr(settings, "MAILER_DOMAIN_RATE_LIMITS", {})
+
+# Where the state of the buckets is kept: 'memory', 'database' or 'file'.
+STORAGE = getattr(settings, "MAILER_RATE_LIMIT_STORAGE", 'memory')
+
+# The path of the file used by the 'file' storage.
+FILE_PATH = getattr(settings, "MAILER_RATE_LIMIT_FILE",
+                    os.path.join(tempfile.gettempdir(),
+                                 'django_mailer.ratelimit'))
+
+# The key of the bucket for the global limit.
+GLOBAL = '*'
+
+logger = logging.getLogger('django_mailer.ratelimit')
+
+# The shared limiter (see ``get_limiter``) and the settings it was made for.
+_limiter = None
+_limiter_lock = threading.Lock()
+
+
+def parse_limit(limit):
+    """
+    Return a ``(rate, burst)`` tuple for a limit setting.
+
+    """
+    if isinstance(limit, (tuple, list)):
+        rate, burst = limit
+    else:
+        rate, burst = limit, max(1, limit)
+    if rate <= 0 or burst <= 0:
+        raise ImproperlyConfigured("Rate limits must be positive: %r" %
+                                   (limit,))
+    return float(rate), float(burst)
+
+
+def refill(tokens, updated, rate, burst, now):
+    """
+    Return the tokens in a bucket which had ``tokens`` at ``updated``.
+
+    A bucket which hasn't been used (``updated`` is ``None``) is full.
+
+    """
+    if updated is None:
+        return burst
+    return min(burst, tokens + max(0, now - updated) * rate)
+
+
+def take(states, buckets, count, now):
+    """
+    Take ``count`` tokens from every bucket, given a list of the current
+    ``(tokens, updated)`` state and a list of the ``(key, rate, burst)`` of
+    each bucket.
+
+    A bucket only needs ``count`` tokens (or to be full, if ``count`` is more
+    than its burst size) to be taken from; it can end up with fewer than
+    none, which delays the following messages.
+
+    Returns a tuple of the number of seconds until all the tokens could be
+    taken (0 if they were taken), the key of the bucket which had to be
+    waited for longest (or ``None``) and the new states.
+
+    """
+    current = []
+    wait = 0
+    limited = None
+    for (tokens, updated), (key, rate, burst) in zip(states, buckets):
+        tokens = refill(tokens, updated, rate, burst, now)
+        needed = min(count, burst)
+        if tokens < needed and (needed - tokens) / rate > wait:
+            wait = (needed - tokens) / rate
+            limited = key
+        current.append(tokens)
+    if wait:
+        return wait, limited, None
+    return 0, None, [(tokens - count, now) for tokens in current]
+
+
+class MemoryStorage(object):
+    """
+    Keep the state of the buckets in this process.
+
+    """
+    def __init__(self):
+        self.states = {}
+        self.lock = threading.Lock()
+
+    def take(self, buckets, count, now):
+        self.lock.acquire()
+        try:
+            states = [self.states.get(key, (0, None))
+                      for key, rate, burst in buckets]
+            wait, limited, states = take(states, buckets, count, now)
+            if not wait:
+                for (key, rate, burst), state in zip(buckets, states):
+                    self.states[key] = state
+            return wait, limited
+        finally:
+            self.lock.release()
+
+
+class DatabaseStorage(object):
+    """
+    Keep the state of the buckets in the ``RateLimit`` table, shared by every
+    sending process using the database.
+
+    Buckets are updated with a compare-and-set UPDATE on a version number, so
+    concurrent processes never take the same tokens.
+
+    """
+    attempts = 10
+
+    def take(self, buckets, count, now):
+        from django_mailer.models import RateLimit
+        for attempt in range(self.attempts):
+            try:
+                return self._take(RateLimit, buckets, count, now)
+            except (IntegrityError, _Conflict):
+                # Another process updated the buckets first.
+                pass
+        logger.warning("Couldn't update the rate limits, not limiting.")
+        return 0, None
+
+    @transaction.commit_on_success
+    def _take(self, RateLimit, buckets, count, now):
+        rows = []
+        for key, rate, burst in buckets:
+            row, created = RateLimit.objects.get_or_create(
+                key=key, defaults={'tokens': burst})
+            rows.append(row)
+        states = [(row.tokens, row.updated) for row in rows]
+        wait, limited, states = take(states, buckets, count, now)
+        if wait:
+            return wait, limited
+        for row, (tokens, updated) in zip(rows, states):
+            if not RateLimit.objects.filter(pk=row.pk, version=row.version)\
+                    .update(tokens=tokens, updated=updated,
+                            version=row.version + 1):
+                raise _Conflict
+        return 0, None
+
+
+class _Conflict(Exception):
+    pass
+
+
+class FileStorage(object):
+    """
+    Keep the state of the buckets in a memory-mapped file, shared by the
+    sending processes on this host.
+
+    The file is a hash table of ``SLOTS`` buckets, each holding a hash of the
+    bucket key, its tokens, when it was last updated and when it will be full
+    again. A bucket which is full again is the same as an unused one, so its
+    slot can be reused by another key. Access is serialized with ``flock``.
+
+    """
+    SLOTS = 4096
+    slot = struct.Struct('<16sddd')
+
+    def __init__(self, path=None):
+        if fcntl is None:
+            raise ImproperlyConfigured("The 'file' rate limit storage needs "
+                                       "fcntl.")
+        self.path = path or FILE_PATH
+        size = self.SLOTS * self.slot.size
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0660)
+        if os.fstat(self.fd).st_size < size:
+            os.ftruncate(self.fd, size)
+        self.map = mmap.mmap(self.fd, size)
+
+    def find(self, key, now):
+        """
+        Return the slot for a key (or ``None`` if the table is full) and its
+        current state.
+
+        """
+        digest = hashlib.md5(key.encode('utf-8')).digest()
+        start = struct.unpack('<Q', digest[:8])[0] % self.SLOTS
+        free = None
+        for i in range(self.SLOTS):
+            index = (start + i) % self.SLOTS
+            slot_digest, tokens, updated, full_at = self.slot.unpack_from(
+                self.map, index * self.slot.size)
+            if slot_digest == digest:
+                if full_at <= now:
+                    return index, (0, None)
+                return index, (tokens, updated)
+            if free is None and (slot_digest == '\0' * 16 or full_at <= now):
+                free = index
+            if slot_digest == '\0' * 16:
+                break
+        if free is not None:
+            self.slot.pack_into(self.map, free * self.slot.size, digest, 0, 0,
+                                0)
+        return free, (0, None)
+
+    def take(self, buckets, count, now):
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        try:
+            slots = []
+            states = []
+            for key, rate, burst in buckets:
+                index, state = self.find(key, now)
+                if index is None:
+                    logger.warning("The rate limit file %s is full, not "
+                                   "limiting." % self.path)
+                    return 0, None
+                slots.append(index)
+                states.append(state)
+            wait, limited, states = take(states, buckets, count, now)
+            if wait:
+                return wait, limited
+            for index, (key, rate, burst), (tokens, updated) in zip(
+                    slots, buckets, states):
+                offset = index * self.slot.size
+                digest = self.map[offset:offset + 16]
+                self.slot.pack_into(self.map, offset, digest, tokens, updated,
+                                    updated + (burst - tokens) / rate)
+            return 0, None
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    def close(self):
+        self.map.close()
+        os.close(self.fd)
+
+
+STORAGES = {
+    'memory': MemoryStorage,
+    'database': DatabaseStorage,
+    'file': FileStorage,
+}
+
+
+class RateLimiter(object):
+    """
+    Limit the rate of messages sent, in total (``global_limit``) and to each
+    recipient domain (``domain_limits``, where the ``'*'`` limit applies to
+    each domain which doesn't have its own).
+
+    """
+    def __init__(self, global_limit=None, domain_limits=None, storage=None):
+        self.global_limit = global_limit and parse_limit(global_limit)
+        self.domain_limits = dict([
+            (domain.lower(), parse_limit(limit))
+            for domain, limit in (domain_limits or {}).items()])
+        if storage is None or isinstance(storage, basestring):
+            try:
+                storage = STORAGES[storage or 'memory']()
+            except KeyError:
+                raise ImproperlyConfigured("Unknown rate limit storage: %r" %
+                                           storage)
+        self.storage = storage
+
+    def buckets(self, domain):
+        buckets = []
+        if self.global_limit:
+            buckets.append((GLOBAL,) + self.global_limit)
+        limit = self.domain_limits.get(domain, self.domain_limits.get('*'))
+        if limit:
+            buckets.append(('@%s' % domain,) + limit)
+        return buckets
+
+    def acquire(self, domain, count=1, now=None):
+        """
+        Try to take ``count`` tokens for sending messages to recipients at
+        ``domain``.
+
+        Returns a tuple of 0 and ``None`` if the messages can be sent,
+        otherwise the number of seconds until they could be and the key of
+        the bucket which is limiting them (``GLOBAL`` for the global limit).
+
+        """
+        buckets = self.buckets(domain.lower())
+        if not buckets:
+            return 0, None
+        return self.storage.take(buckets, count, now or time.time())
+
+
+def get_limiter():
+    """
+    Return the ``RateLimiter`` for the rate limit settings, or ``None`` if no
+    limits are set.
+
+    The limiter is shared by every call (until the settings change), so that
+    with the ``'memory'`` storage the state of the buckets carries over from
+    one run of the sending engine to the next in the same process.
+
+    """
+    global _limiter
+    if not GLOBAL_LIMIT and not DOMAIN_LIMITS:
+        return None
+    key = (GLOBAL_LIMIT, sorted(DOMAIN_LIMITS.items()), STORAGE)
+    _limiter_lock.acquire()
+    try:
+        if _limiter is None or _limiter[0] != key:
+            _limiter = (key, RateLimiter(GLOBAL_LIMIT, DOMAIN_LIMITS,
+                                         STORAGE))
+        return _limiter[1]
+    finally:
+        _limiter_lock.release()
@@ -0,0 +1,215 @@
+"""
+Delete old logs, and the messages which are no longer needed once their logs
+are gone, optionally archiving them first.
+
+Rows are deleted in chunks, each in its own transaction, so the tables are
+never locked for long. The archive is a gzip-compressed file with one JSON
+object per line for each row.
+
+"""
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connections, transaction, DEFAULT_DB_ALIAS
+from django_mailer import models
+import gzip
+import itertools
+
+
+# The number of rows deleted in each transaction.
+CHUNK_SIZE = getattr(settings, "MAILER_PURGE_CHUNK_SIZE", 1000)
+
+
+def old_logs(before):
+    """
+    Return a queryset of the logs dated before ``before``.
+
+    """
+    return models.Log.objects.filter(date__lt=before)
+
+
+def old_messages(before):
+    """
+    Return a queryset of the messages created before ``before`` which are no
+    longer queued and have no log dated from ``before`` onwards (so they are
+    unused once the older logs are deleted).
+
+    """
+    return models.Message.objects.filter(date_created__lt=before,
+                                         queuedmessage__isnull=True)\
+                                 .exclude(log__date__gte=before)
+
+
+def _rows(queryset, chunk_size):
+    """
+    Yield each row of a queryset as a dictionary of its field values, in
+    primary key order.
+
+    PostgreSQL rows are streamed through a server-side cursor. Other
+    databases are read in chunks of ``chunk_size`` rows.
+
+    """
+    names = [field.name for field in queryset.model._meta.local_fields]
+    queryset = queryset.order_by('pk').values_list(*names)
+    connection = connections[queryset.db]
+    if connection.vendor == 'postgresql':
+        sql, params = queryset.query.get_compiler(queryset.db).as_sql()
+        # Make sure the connection is open.
+        connection.cursor()
+        cursor = connection.connection.cursor(name='django_mailer_archive')
+        cursor.itersize = chunk_size
+        try:
+            cursor.execute(sql, params)
+            for row in cursor:
+                yield dict(zip(names, row))
+        finally:
+            cursor.close()
+        return
+    pk_index = names.index(queryset.model._meta.pk.name)
+    last_pk = None
+    while True:
+        chunk = queryset
+        if last_pk is not None:
+            chunk = chunk.filter(pk__gt=last_pk)
+        rows = list(chunk[:chunk_size])
+        if not rows:
+            break
+        last_pk = rows[-1][pk_index]
+        for row in rows:
+            yield dict(zip(names, row))
+
+
+def _message_rows(queryset, chunk_size):
+    """
+    Yield each row of a queryset of messages as ``_rows`` does, with the
+    ``encoded_message`` of the message added, since the bodies (which are
+    shared) are left to be purged later. The messages are loaded
+    ``chunk_size`` at a time to read it.
+
+    The ``encoded_message`` of a mail merge message is rendered from its
+    template, or is ``None`` if it fails to render.
+
+    """
+    rows = _rows(queryset, chunk_size)
+    while True:
+        chunk = list(itertools.islice(rows, chunk_size))
+        if not chunk:
+            break
+        messages = models.Message.objects.select_related('body', 'template')
+        messages = messages.in_bulk([row['id'] for row in chunk])
+        for row in chunk:
+            try:
+                row['encoded_message'] = messages[row['id']].encoded_message
+            except Exception:
+                # A mail merge template (or context) which fails to render.
+                row['encoded_message'] = None
+            yield row
+
+
+def archive(before, path, chunk_size=None):
+    """
+    Append the logs and messages which ``purge`` would delete to a
+    gzip-compressed JSON lines file, returning the number of rows written.
+
+    Each line is an object with the ``model`` (``"log"`` or ``"message"``)
+    and the ``fields`` of the row. Messages also have their
+    ``encoded_message`` (see ``_message_rows``). Each call adds a new gzip
+    member to the file, which gzip readers treat as one stream.
+
+    """
+    chunk_size = max(1, chunk_size or CHUNK_SIZE)
+    encoder = DjangoJSONEncoder()
+    count = 0
+    archive_file = gzip.open(path, 'ab')
+    try:
+        for model, rows in (('log', _rows(old_logs(before), chunk_size)),
+                            ('message', _message_rows(old_messages(before),
+                                                      chunk_size))):
+            for row in rows:
+                archive_file.write(encoder.encode(
+                    {'model': model, 'fields': row}) + '\n')
+                count += 1
+    finally:
+        archive_file.close()
+    return count
+
+
+def _delete_chunks(queryset, sql, params, chunk_size, using):
+    """
+    Delete the rows of a queryset in chunks, each with a ``DELETE`` statement
+    which rechecks the conditions in ``sql`` (``%(table)s``, ``%(pk)s`` and
+    ``%(ids)s`` are filled in) so that rows which no longer match survive.
+
+    Yields the number of rows deleted by each chunk.
+
+    """
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    opts = queryset.model._meta
+    last_pk = None
+    while True:
+        chunk = queryset.order_by('pk')
+        if last_pk is not None:
+            chunk = chunk.filter(pk__gt=last_pk)
+        ids = list(chunk.values_list('pk', flat=True)[:chunk_size])
+        if not ids:
+            break
+        last_pk = ids[-1]
+
+        @transaction.commit_on_success(using=using)
+        def delete():
+            cursor = connection.cursor()
+            cursor.execute(sql % {'table': qn(opts.db_table),
+                                  'pk': qn(opts.pk.column),
+                                  'ids': ', '.join(['%s'] * len(ids))},
+                           ids + params)
+            transaction.set_dirty(using=using)
+            return cursor.rowcount
+        yield delete()
+
+
+def purge(before, chunk_size=None, progress=None, using=DEFAULT_DB_ALIAS):
+    """
+    Delete the logs dated before ``before``, then the messages created
+    before then which are no longer queued or logged, in chunks of
+    ``chunk_size`` rows (default ``MAILER_PURGE_CHUNK_SIZE``, or 1000), each
+    in its own transaction.
+
+    A message is only deleted if it is still unused at the time of the
+    ``DELETE``. Message bodies are left for the ``purge_message_bodies``
+    command.
+
+    If a ``progress`` callable is provided, it is called after each chunk
+    with the number of logs and messages deleted so far.
+
+    Returns a tuple of the number of logs and messages deleted.
+
+    """
+    chunk_size = max(1, chunk_size or CHUNK_SIZE)
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    log_date = qn(models.Log._meta.get_field('date').column)
+    logs = messages = 0
+    for count in _delete_chunks(
+            old_logs(before),
+            'DELETE FROM %%(table)s WHERE %%(pk)s IN (%%(ids)s) '
+            'AND %s < %%%%s' % log_date,
+            [connection.ops.value_to_db_datetime(before)], chunk_size, using):
+        logs += count
+        if progress:
+            progress(logs, messages)
+
+    # The queue and the logs refer to messages.
+    dependents = []
+    for related in models.Message._meta.get_all_related_objects():
+        dependents.append(
+            'NOT EXISTS (SELECT 1 FROM %s WHERE %s.%s = %%(table)s.%%(pk)s)' %
+            ((qn(related.model._meta.db_table),) * 2 +
+             (qn(related.field.column),)))
+    for count in _delete_chunks(
+            old_messages(before),
+            'DELETE FROM %%(table)s WHERE %%(pk)s IN (%%(ids)s) AND %s' %
+            ' AND '.join(dependents), [], chunk_size, using):
+        messages += count
+        if progress:
+            progress(logs, messages)
+    return logs, messages
@@ -0,0 +1,70 @@
+"""
+Scheduling of automatic retries for messages which failed to send.
+
+A deferred message is retried after an exponentially growing delay (with
+random jitter, so that messages which failed together aren't all retried at
+once) until it has failed ``MAILER_MAX_RETRIES`` times, when the
+``MAILER_FINAL_FAILURE`` action is taken.
+
+"""
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+import datetime
+import random
+
+
+# The delay (in seconds) before the first retry of a failed message. Each
+# further retry waits twice as long as the last.
+RETRY_DELAY = getattr(settings, "MAILER_RETRY_DELAY", 60)
+
+# The longest delay (in seconds) between two attempts to send a message.
+MAX_RETRY_DELAY = getattr(settings, "MAILER_MAX_RETRY_DELAY", 24 * 60 * 60)
+
+# How many times a failed message is automatically retried. Set to 0 to never
+# retry messages automatically (only with ``retry_deferred``) or None to retry
+# them indefinitely.
+MAX_RETRIES = getattr(settings, "MAILER_MAX_RETRIES", 10)
+
+# What happens to a message once it has failed and won't be retried
+# automatically again: 'defer' leaves it deferred in the queue (so it can
+# still be retried with ``retry_deferred``), 'delete' removes it from the
+# queue. Either way, the failure is logged.
+FINAL_FAILURE = getattr(settings, "MAILER_FINAL_FAILURE", 'defer')
+
+if FINAL_FAILURE not in ('defer', 'delete'):
+    raise ImproperlyConfigured("MAILER_FINAL_FAILURE must be 'defer' or "
+                               "'delete'.")
+
+
+def delay(retries):
+    """
+    Return the delay (in seconds) before retrying a message which has failed
+    ``retries`` times.
+
+    The delay doubles with each failure up to ``MAILER_MAX_RETRY_DELAY``, and
+    is randomly spread over the upper half of that range.
+
+    """
+    delay = min(MAX_RETRY_DELAY, RETRY_DELAY * 2 ** max(0, retries - 1))
+    return random.uniform(delay / 2.0, delay)
+
+
+def next_attempt(retries, now=None):
+    """
+    Return when to retry a message which has failed ``retries`` times, or
+    ``None`` if it shouldn't be retried automatically.
+
+    """
+    if MAX_RETRIES is not None and retries > MAX_RETRIES:
+        return None
+    now = now or datetime.datetime.now()
+    return now + datetime.timedelta(seconds=delay(retries))
+
+
+def should_delete(retries):
+    """
+    Return whether a message which has failed ``retries`` times should be
+    removed from the queue.
+
+    """
+    return FINAL_FAILURE == 'delete' and next_attempt(retries) is None
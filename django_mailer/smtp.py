@@ -0,0 +1,322 @@
+"""
+A persistent SMTP connection which survives the mail server dropping it.
+
+Messages are sent with the ESMTP ``PIPELINING`` (RFC 2920) and ``CHUNKING``
+(RFC 3030) extensions where the mail server offers them, which saves a round
+trip to the server for each command of the SMTP transaction.
+
+"""
+from django.conf import settings
+from django.core.mail import SMTPConnection
+import logging
+import re
+import smtplib
+import socket
+import time
+
+
+# Reconnect after sending this many messages over a connection (0 to never).
+MAX_MESSAGES = getattr(settings, "MAILER_SMTP_MAX_MESSAGES", 500)
+
+# Reconnect once a connection is this many seconds old (0 to never).
+MAX_AGE = getattr(settings, "MAILER_SMTP_MAX_AGE", 600)
+
+# How many times sending a message is retried over a new connection when the
+# connection turns out to be dead.
+RETRIES = getattr(settings, "MAILER_SMTP_RETRIES", 2)
+
+# Send a NOOP over a connection which has been idle for this many seconds
+# when ``keepalive`` is called, to stop the mail server dropping it.
+KEEPALIVE = getattr(settings, "MAILER_SMTP_KEEPALIVE", 60)
+
+# Whether to send the envelope commands of each message in a single batch if
+# the mail server supports PIPELINING.
+PIPELINING = getattr(settings, "MAILER_SMTP_PIPELINING", True)
+
+# Whether to send message data with BDAT if the mail server supports
+# CHUNKING.
+CHUNKING = getattr(settings, "MAILER_SMTP_CHUNKING", True)
+
+# Errors which mean the SMTP session is dead.
+DISCONNECTED = (smtplib.SMTPServerDisconnected, socket.error)
+
+logger = logging.getLogger('django_mailer.smtp')
+
+_line_ending = re.compile(r'\r\n|\n|\r')
+
+
+def _is_dead(err):
+    """
+    Return whether an SMTP error means the session can't be used any more.
+
+    """
+    if isinstance(err, DISCONNECTED):
+        return True
+    # 421: the service is not available and is closing the connection.
+    return getattr(err, 'smtp_code', None) == 421
+
+
+def _rset(connection):
+    try:
+        connection.rset()
+    except smtplib.SMTPServerDisconnected:
+        pass
+
+
+def sendmail(connection, from_address, to_addresses, message,
+             pipelining=None, chunking=None):
+    """
+    Send a message over a connected ``smtplib.SMTP`` instance, with the same
+    arguments, return value and exceptions as ``smtplib.SMTP.sendmail``.
+
+    If the server supports PIPELINING, the ``MAIL FROM``, ``RCPT TO`` and
+    ``DATA`` (or ``BDAT``) commands are sent together and their replies read
+    afterwards. If it supports CHUNKING, the message data is sent in a single
+    ``BDAT`` chunk rather than dot-stuffed after ``DATA``.
+
+    An error raised once the message data has been sent (while waiting for
+    the server to accept it) has a true ``data_sent`` attribute: the server
+    may have accepted the message, so it mustn't be sent again.
+
+    A connection which only provides ``sendmail`` (rather than the commands
+    of ``smtplib.SMTP``) is left to send the message itself.
+
+    """
+    if pipelining is None:
+        pipelining = PIPELINING
+    if chunking is None:
+        chunking = CHUNKING
+    connection.ehlo_or_helo_if_needed()
+    if not hasattr(connection, 'putcmd'):
+        return connection.sendmail(from_address, to_addresses, message)
+    pipelining = pipelining and connection.has_extn('pipelining')
+    chunking = chunking and connection.has_extn('chunking')
+
+    if isinstance(to_addresses, basestring):
+        to_addresses = [to_addresses]
+    if isinstance(message, unicode):
+        message = message.encode('utf-8')
+    if chunking:
+        data = _line_ending.sub(smtplib.CRLF, message)
+        final = 'BDAT %s LAST' % len(data)
+    else:
+        data = smtplib.quotedata(message)
+        if data[-2:] != smtplib.CRLF:
+            data += smtplib.CRLF
+        data += '.' + smtplib.CRLF
+        final = 'DATA'
+    options = ''
+    if connection.has_extn('size'):
+        options = ' SIZE=%s' % len(data)
+    commands = ['MAIL FROM:%s%s' % (smtplib.quoteaddr(from_address),
+                                    options)]
+    commands.extend(['RCPT TO:%s' % smtplib.quoteaddr(address)
+                     for address in to_addresses])
+
+    data_sent = False
+    try:
+        if pipelining:
+            batch = smtplib.CRLF.join(commands + [final]) + smtplib.CRLF
+            if chunking:
+                batch += data
+                data_sent = True
+            connection.send(batch)
+            replies = [connection.getreply() for command in commands]
+            final_reply = connection.getreply()
+        else:
+            replies = []
+            for command in commands:
+                connection.putcmd(command)
+                replies.append(connection.getreply())
+                if replies[0][0] != 250:
+                    break
+            final_reply = None
+
+        code, reply = replies[0]
+        refused = {}
+        for address, (rcpt_code, rcpt_reply) in zip(to_addresses,
+                                                     replies[1:]):
+            if rcpt_code not in (250, 251):
+                refused[address] = (rcpt_code, rcpt_reply)
+        if final_reply is not None and final_reply[0] == 354:
+            # The server accepted DATA although the transaction failed, so
+            # end the (empty) message to get back in step with it.
+            if code != 250 or len(refused) == len(to_addresses):
+                connection.send('.' + smtplib.CRLF)
+                connection.getreply()
+        if code != 250:
+            _rset(connection)
+            raise smtplib.SMTPSenderRefused(code, reply, from_address)
+        if len(refused) == len(to_addresses):
+            _rset(connection)
+            raise smtplib.SMTPRecipientsRefused(refused)
+
+        if final_reply is None:
+            if chunking:
+                # CHUNKING without PIPELINING.
+                data_sent = True
+                connection.send(final + smtplib.CRLF + data)
+            else:
+                connection.putcmd(final)
+            final_reply = connection.getreply()
+        code, reply = final_reply
+        if not chunking and code == 354:
+            data_sent = True
+            connection.send(data)
+            code, reply = connection.getreply()
+        if code != 250:
+            _rset(connection)
+            raise smtplib.SMTPDataError(code, reply)
+    except (smtplib.SMTPException, socket.error), err:
+        if data_sent:
+            err.data_sent = True
+        raise
+    return refused
+
+
+class ConnectionManager(object):
+    """
+    Manage a persistent connection to the mail server, given an email backend
+    instance such as Django's SMTP backend (a new ``SMTPConnection`` by
+    default).
+
+    The connection is opened when it is first needed. If the session turns
+    out to be dead while sending a message, the connection is reopened and
+    the message sent again (up to ``retries`` times), unless the message
+    data had already been sent: the server may have accepted the message,
+    so the error is raised rather than risk sending it twice. Connections are
+    recycled after ``max_messages`` messages or ``max_age`` seconds, and
+    ``keepalive`` sends a NOOP over a connection which has been idle for
+    ``keepalive`` seconds.
+
+    ``reconnects`` counts the connections reopened after a dead session and
+    ``recycled`` the connections closed by recycling.
+
+    """
+    def __init__(self, backend=None, max_messages=None, max_age=None,
+                 retries=None, keepalive=None):
+        if max_messages is None:
+            max_messages = MAX_MESSAGES
+        if max_age is None:
+            max_age = MAX_AGE
+        if retries is None:
+            retries = RETRIES
+        if keepalive is None:
+            keepalive = KEEPALIVE
+        self.backend = backend or SMTPConnection()
+        self.max_messages = max_messages
+        self.max_age = max_age
+        self.retries = retries
+        self.keepalive_interval = keepalive
+        self.messages = 0
+        self.opened = self.last_used = None
+        self.reconnects = 0
+        self.recycled = 0
+
+    def is_open(self):
+        return bool(self.backend.connection)
+
+    def open(self):
+        """
+        Open the connection if it isn't open, returning whether it was opened.
+
+        """
+        if self.backend.open():
+            self.messages = 0
+            self.opened = self.last_used = time.time()
+            return True
+        if self.opened is None:
+            # The backend was already connected.
+            self.opened = self.last_used = time.time()
+        return False
+
+    def close(self):
+        """
+        Close the connection (if it is open), saying goodbye to the server.
+
+        """
+        if self.is_open():
+            try:
+                self.backend.close()
+            except (smtplib.SMTPException, socket.error):
+                self.discard()
+        self.opened = None
+
+    def discard(self):
+        """
+        Drop a dead connection without talking to the server.
+
+        """
+        connection = self.backend.connection
+        self.backend.connection = None
+        self.opened = None
+        if connection is not None:
+            try:
+                connection.close()
+            except (smtplib.SMTPException, socket.error):
+                pass
+
+    def recycle_if_needed(self):
+        if not self.is_open() or self.opened is None:
+            return
+        if (self.max_messages and self.messages >= self.max_messages) or \
+                (self.max_age and time.time() - self.opened >= self.max_age):
+            logger.debug("Recycling the SMTP connection after %s messages." %
+                         self.messages)
+            self.close()
+            self.recycled += 1
+
+    def sendmail(self, from_address, to_addresses, message):
+        """
+        Send a message, returning the recipients refused by the server (as
+        ``smtplib.SMTP.sendmail`` does).
+
+        """
+        self.recycle_if_needed()
+        attempt = 0
+        while True:
+            try:
+                self.open()
+                refused = sendmail(self.backend.connection, from_address,
+                                   to_addresses, message)
+            except smtplib.SMTPRecipientsRefused:
+                self.used()
+                raise
+            except (smtplib.SMTPException, socket.error), err:
+                if not _is_dead(err) or attempt >= self.retries or \
+                        getattr(err, 'data_sent', False):
+                    if _is_dead(err):
+                        self.discard()
+                    raise
+                logger.warning("SMTP connection lost (%s), reconnecting." %
+                               err)
+                self.discard()
+                self.reconnects += 1
+                attempt += 1
+                continue
+            self.used()
+            return refused
+
+    def used(self):
+        self.messages += 1
+        self.last_used = time.time()
+
+    def keepalive(self):
+        """
+        Send a NOOP over the connection if it has been idle for the keepalive
+        interval, dropping it if the server doesn't answer (it is reopened
+        when it is next needed).
+
+        """
+        if not self.is_open() or self.last_used is None or \
+                time.time() - self.last_used < self.keepalive_interval:
+            return
+        try:
+            code = self.backend.connection.noop()[0]
+        except (smtplib.SMTPException, socket.error):
+            code = None
+        if code != 250:
+            logger.debug("SMTP connection dropped while idle.")
+            self.discard()
+        else:
+            self.last_used = time.time()
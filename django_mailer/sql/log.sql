@@ -0,0 +1,3 @@
+-- The admin filters the logs by result, paging through them by id.
+CREATE INDEX django_mailer_log_result
+    ON django_mailer_log (result, id);
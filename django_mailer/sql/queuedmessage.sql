@@ -0,0 +1,8 @@
+-- Sending processes claim blocks of non-deferred messages in queue order
+-- (see QueueManager.claim), which this index serves without a sort.
+CREATE INDEX django_mailer_queuedmessage_queue
+    ON django_mailer_queuedmessage (deferred, priority, date_queued, id);
+
+-- The admin filters the queue by priority, paging through it by id.
+CREATE INDEX django_mailer_queuedmessage_priority
+    ON django_mailer_queuedmessage (priority, id);
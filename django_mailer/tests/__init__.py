@@ -1,2 +1,19 @@
+from django_mailer.tests.admin import AdminTest
+from django_mailer.tests.async_engine import AsyncEngineTest
+from django_mailer.tests.backend import TestBackend
+from django_mailer.tests.blacklist import BlacklistTest
+from django_mailer.tests.bodies import BodyTest
+from django_mailer.tests.bulk import BulkTest, TransactionTest
 from django_mailer.tests.commands import TestCommands
-from django_mailer.tests.engine import LockTest
+from django_mailer.tests.compression import CompressionTest
+from django_mailer.tests.counters import CounterTest, \
+    CounterTransactionTest
+from django_mailer.tests.engine import GroupTest, LeaseTest, LockTest, \
+    ResultBufferTest, ThreadedSendTest
+from django_mailer.tests.merge import MergeTest
+from django_mailer.tests.metrics import MetricsTest
+from django_mailer.tests.notify import NotifyTest
+from django_mailer.tests.ratelimit import RateLimitTest
+from django_mailer.tests.retention import RetentionTest
+from django_mailer.tests.retry import RetryTest
+from django_mailer.tests.smtp import ConnectionManagerTest, PipeliningTest
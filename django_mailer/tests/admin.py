@@ -0,0 +1,89 @@
+from django.contrib import admin
+from django.test.client import RequestFactory
+from django_mailer import admin as mailer_admin, constants, models
+from django_mailer.tests.base import MailerTestCase
+
+
+class AdminTest(MailerTestCase):
+    """
+    Tests for the admin change lists.
+
+    """
+    def setUp(self):
+        super(AdminTest, self).setUp()
+        for i in range(5):
+            self.queue_message(subject='message %s' % i)
+        self.ids = list(models.QueuedMessage.objects.order_by('pk')
+                        .values_list('pk', flat=True))
+
+    def changelist(self, model, **params):
+        model_admin = admin.site._registry[model]
+        request = RequestFactory().get('/', params)
+        return model_admin.get_changelist(request)(
+            request, model, model_admin.list_display,
+            model_admin.list_display_links, model_admin.list_filter,
+            model_admin.date_hierarchy, model_admin.search_fields,
+            model_admin.list_select_related, 2, model_admin.list_editable,
+            model_admin)
+
+    def test_estimated_count(self):
+        queryset = models.QueuedMessage.objects.all()
+        self.assertEqual(mailer_admin.estimated_count(queryset, limit=10),
+                         (5, False))
+        # SQLite has no planner statistics, so it counts every row.
+        self.assertEqual(mailer_admin.estimated_count(queryset, limit=2),
+                         (5, False))
+        self.assertEqual(mailer_admin.estimated_count(
+            queryset.filter(pk__in=[]), limit=2), (0, False))
+
+    def test_keyset_pagination(self):
+        pages = []
+        params = {}
+        while True:
+            cl = self.changelist(models.QueuedMessage, **params)
+            self.assert_(cl.keyset)
+            self.assertEqual(cl.result_count, 5)
+            pages.append([queued_message.pk
+                          for queued_message in cl.result_list])
+            self.assertEqual(cl.first_url is None, not params)
+            if not cl.next_url:
+                break
+            params = {'after': cl.next_url.split('=')[-1]}
+        self.assertEqual(pages, [self.ids[:2], self.ids[2:4], self.ids[4:]])
+
+    def test_numbered_pages(self):
+        # Ordered by priority, pages are numbered.
+        column = list(admin.site._registry[models.QueuedMessage]
+                      .list_display).index('priority')
+        cl = self.changelist(models.QueuedMessage, o=str(column), p='2')
+        self.assert_(not cl.keyset)
+        self.assertEqual(len(list(cl.result_list)), 1)
+
+    def test_filters(self):
+        models.QueuedMessage.objects.get(pk=self.ids[0]).defer()
+        models.QueuedMessage.objects.filter(pk=self.ids[1])\
+                                    .update(priority=constants.PRIORITY_HIGH)
+        cl = self.changelist(models.QueuedMessage, deferred__isnull='False')
+        self.assertEqual([queued_message.pk
+                          for queued_message in cl.result_list],
+                         self.ids[:1])
+        self.assertEqual((cl.result_count, cl.full_result_count), (1, 5))
+        cl = self.changelist(models.QueuedMessage,
+                             priority=str(constants.PRIORITY_HIGH))
+        self.assertEqual([queued_message.pk
+                          for queued_message in cl.result_list],
+                         self.ids[1:2])
+        filters = dict((spec.title(), spec) for spec in cl.filter_specs)
+        self.assert_(isinstance(filters['deferred'],
+                                mailer_admin.DeferredFilterSpec))
+
+    def test_restricted_columns(self):
+        cl = self.changelist(models.Log)
+        sql = str(cl.query_set.query)
+        self.assert_('encoded_message' not in sql)
+        self.assert_('messagebody' not in sql)
+        self.assert_('django_mailer_message' in sql)
+        cl = self.changelist(models.Message)
+        self.assert_('encoded_message' not in str(cl.query_set.query))
+        self.assertEqual([message.subject for message in cl.result_list],
+                         ['message 4', 'message 3'])
@@ -0,0 +1,63 @@
+from django.conf import settings
+from django_mailer import async_engine, constants, models
+from django_mailer.tests.base import MailerTestCase, SMTPSink
+
+
+class AsyncEngineTest(MailerTestCase):
+    """
+    Tests for delivering messages with the asynchronous engine, against a
+    local SMTP server.
+
+    """
+    def setUp(self):
+        super(AsyncEngineTest, self).setUp()
+        self.sink = SMTPSink(refuse=['refused@djangomailer'])
+        self.sink.start()
+        self.original_settings = (settings.EMAIL_HOST, settings.EMAIL_PORT)
+        settings.EMAIL_HOST = self.sink.host
+        settings.EMAIL_PORT = self.sink.port
+
+    def tearDown(self):
+        super(AsyncEngineTest, self).tearDown()
+        settings.EMAIL_HOST, settings.EMAIL_PORT = self.original_settings
+        self.sink.stop()
+
+    def test_send_all(self):
+        for i in range(20):
+            self.queue_message(subject='test %s' % i,
+                               recipient_list=['recipient%s@djangomailer' % i])
+        self.queue_message(recipient_list=['refused@djangomailer',
+                                           'group1@djangomailer',
+                                           'group2@djangomailer'])
+        self.queue_message(recipient_list=['blacklisted@djangomailer'])
+        models.Blacklist.objects.create(email='blacklisted@djangomailer')
+        result = async_engine.send_all(block_size=8, concurrency=3)
+        self.assertEqual(result, (22, 1, 1))
+        self.assertEqual(len(self.sink.messages), 21)
+        self.assertEqual(sorted(sum([recipients for _, recipients, _
+                                     in self.sink.messages], [])),
+                         sorted(['recipient%s@djangomailer' % i
+                                 for i in range(20)] +
+                                ['group1@djangomailer',
+                                 'group2@djangomailer']))
+        queued = models.QueuedMessage.objects.get()
+        self.assertEqual(queued.message.to_address, 'refused@djangomailer')
+        self.assertNotEqual(queued.deferred, None)
+        logs = models.Log.objects.all()
+        self.assertEqual(logs.filter(result=constants.RESULT_SENT).count(),
+                         22)
+        self.assertEqual(logs.filter(result=constants.RESULT_FAILED).count(),
+                         1)
+        self.assertEqual(logs.filter(result=constants.RESULT_SKIPPED).count(),
+                         1)
+
+    def test_unreachable_server(self):
+        self.queue_message()
+        self.queue_message()
+        self.sink.stop()
+        result = async_engine.send_all()
+        self.assertEqual(result, (0, 2, 0))
+        self.assertEqual(models.QueuedMessage.objects.deferred().count(), 2)
+        # Start a new sink so that tearDown can stop it.
+        self.sink = SMTPSink()
+        self.sink.start()
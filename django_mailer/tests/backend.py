@@ -0,0 +1,36 @@
+from django.core import mail
+from django_mailer import constants, models
+from django_mailer.tests.base import MailerTestCase
+
+
+class TestBackend(MailerTestCase):
+    """
+    Tests for the ``DbBackend`` email backend.
+
+    """
+    def test_send_messages(self):
+        connection = mail.get_connection('django_mailer.backend.DbBackend')
+        email_messages = [
+            mail.EmailMessage('first', 'body', 'sender@djangomailer',
+                              ['a@djangomailer', 'b@djangomailer']),
+            mail.EmailMessage('no recipients', 'body', 'sender@djangomailer'),
+            mail.EmailMessage('second', 'body', 'sender@djangomailer',
+                              ['c@djangomailer'], bcc=['d@djangomailer']),
+        ]
+        self.assertEqual(connection.send_messages(email_messages), 2)
+        self.assertEqual(connection.send_messages([]), 0)
+        queued = models.QueuedMessage.objects.select_related()
+        self.assertEqual(sorted([q.message.to_address for q in queued]),
+                         ['a@djangomailer', 'b@djangomailer',
+                          'c@djangomailer', 'd@djangomailer'])
+        self.assertEqual(set([q.priority for q in queued]),
+                         set([constants.PRIORITY_NORMAL]))
+        self.assertEqual(len(mail.outbox), 0)
+
+    def test_priority(self):
+        connection = mail.get_connection('django_mailer.backend.DbBackend',
+                                         priority=constants.PRIORITY_LOW)
+        mail.EmailMessage('test', 'body', 'sender@djangomailer',
+                          ['a@djangomailer'], connection=connection).send()
+        queued = models.QueuedMessage.objects.get()
+        self.assertEqual(queued.priority, constants.PRIORITY_LOW)
@@ -1,6 +1,9 @@
 from django.core import mail
 from django.test import TestCase
 from django_mailer import queue_email_message
+import SocketServer
+import threading
+import time
 
 
 class FakeConnection(object):
@@ -9,6 +12,12 @@ class FakeConnection(object):
     sending.
     
     """
+    def ehlo_or_helo_if_needed(self):
+        pass
+
+    def has_extn(self, extension):
+        return False
+
     def sendmail(self, *args, **kwargs):
         """
         Divert an email to the test buffer.
@@ -44,3 +53,194 @@ class MailerTestCase(TestCase):
         email_message = mail.EmailMessage(subject, message, from_email,
                                           recipient_list)
         return queue_email_message(email_message, priority=priority)
+
+
+class SMTPSinkHandler(SocketServer.BaseRequestHandler):
+    """
+    Handle one SMTP session for ``SMTPSink``.
+
+    Replies are held back until the client is waiting for them, so that
+    pipelined commands only cost one (simulated) round trip.
+
+    """
+    def setup(self):
+        self.buffer = ''
+        self.pending = []
+        self.server.lock.acquire()
+        try:
+            self.server.sessions += 1
+        finally:
+            self.server.lock.release()
+
+    def reply(self, line):
+        self.pending.append(line + '\r\n')
+
+    def flush(self):
+        if not self.pending:
+            return
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        self.request.sendall(''.join(self.pending))
+        self.pending = []
+
+    def receive(self):
+        self.flush()
+        data = self.request.recv(65536)
+        self.buffer += data
+        return data
+
+    def readline(self):
+        while '\n' not in self.buffer:
+            if not self.receive():
+                line, self.buffer = self.buffer, ''
+                return line
+        line, self.buffer = self.buffer.split('\n', 1)
+        return line + '\n'
+
+    def read(self, size):
+        while len(self.buffer) < size:
+            if not self.receive():
+                break
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def handle(self):
+        self.reply('220 djangomailer SMTP sink')
+        sender = None
+        recipients = []
+        chunks = []
+        received = 0
+        while True:
+            if self.server.drop_after and received >= self.server.drop_after:
+                # Hang up without a goodbye, like an idle timeout would.
+                break
+            line = self.readline()
+            if not line:
+                break
+            command = line.strip().split(' ', 1)[0].upper()
+            argument = line.strip()[len(command):].strip()
+            if command == 'EHLO':
+                lines = ['djangomailer'] + list(self.server.extensions)
+                for extension in lines[:-1]:
+                    self.reply('250-%s' % extension)
+                self.reply('250 %s' % lines[-1])
+            elif command == 'HELO':
+                self.reply('250 djangomailer')
+            elif command == 'MAIL':
+                sender = argument.split(':', 1)[1].split()[0].strip('<>')
+                recipients = []
+                chunks = []
+                self.reply('250 OK')
+            elif command == 'RCPT':
+                recipient = argument.split(':', 1)[1].split()[0].strip('<>')
+                if sender is None:
+                    self.reply('503 Need MAIL command')
+                elif recipient in self.server.refuse:
+                    self.reply('550 No such user')
+                else:
+                    recipients.append(recipient)
+                    self.reply('250 OK')
+            elif command == 'DATA':
+                if not recipients:
+                    self.reply('554 No valid recipients')
+                    continue
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                data = []
+                while True:
+                    line = self.readline()
+                    if not line or line == '.\r\n':
+                        break
+                    if line.startswith('.'):
+                        line = line[1:]
+                    data.append(line)
+                self.server.received(sender, recipients, ''.join(data))
+                self.server.commands.append('DATA')
+                if self.server.drop_data:
+                    break
+                received += 1
+                sender = None
+                self.reply('250 OK')
+            elif command == 'BDAT':
+                arguments = argument.split()
+                # The chunk is read even if the transaction has failed.
+                chunks.append(self.read(int(arguments[0])))
+                if not recipients:
+                    self.reply('554 No valid recipients')
+                elif len(arguments) > 1 and arguments[1].upper() == 'LAST':
+                    self.server.received(sender, recipients, ''.join(chunks))
+                    self.server.commands.append('BDAT')
+                    if self.server.drop_data:
+                        break
+                    received += 1
+                    sender = None
+                    self.reply('250 OK')
+                else:
+                    self.reply('250 OK')
+            elif command == 'RSET':
+                sender = None
+                recipients = []
+                self.reply('250 OK')
+            elif command == 'NOOP':
+                self.server.noops += 1
+                self.reply('250 OK')
+            elif command == 'QUIT':
+                self.reply('221 Bye')
+                break
+            else:
+                self.reply('502 Command not implemented')
+        self.flush()
+
+
+class SMTPSink(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    """
+    A local SMTP server which accepts messages and stores them in the
+    ``messages`` list as ``(sender, recipients, data)`` tuples.
+
+    Each session is handled in its own thread. Every reply is delayed by
+    ``latency`` seconds to simulate the round trip to a remote server.
+    Recipients in ``refuse`` are refused. If ``drop_after`` is set, each
+    session is dropped after that many messages. If ``drop_data`` is set,
+    sessions are dropped as soon as the data of a message has been received
+    (without accepting it, although it is stored).
+
+    ``PIPELINING`` and ``BDAT`` are always supported, but only advertised if
+    they are included in ``extensions``. The command used to send the data of
+    each message (``DATA`` or ``BDAT``) is recorded in ``commands``, and the
+    number of sessions in ``sessions``.
+
+    """
+    allow_reuse_address = True
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, latency=0, extensions=(), refuse=(), drop_after=0,
+                 drop_data=False):
+        SocketServer.TCPServer.__init__(self, ('127.0.0.1', 0),
+                                        SMTPSinkHandler)
+        self.latency = latency
+        self.extensions = extensions
+        self.refuse = refuse
+        self.drop_after = drop_after
+        self.drop_data = drop_data
+        self.messages = []
+        self.commands = []
+        self.noops = 0
+        self.sessions = 0
+        self.lock = threading.Lock()
+        self.host, self.port = self.server_address
+
+    def received(self, sender, recipients, data):
+        self.lock.acquire()
+        try:
+            self.messages.append((sender, recipients, data))
+        finally:
+            self.lock.release()
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
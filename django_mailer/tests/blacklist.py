@@ -0,0 +1,93 @@
+from django.test import TestCase
+from django_mailer import models
+from django_mailer.blacklist import BlacklistIndex, is_blacklisted
+import datetime
+
+
+class BlacklistTest(TestCase):
+    """
+    Tests for matching addresses against the blacklist.
+
+    """
+    def setUp(self):
+        models.Blacklist.objects.create(email='Someone@Example.com')
+        models.Blacklist.objects.create(email='*@blocked.example.com')
+
+    def assertBlacklisted(self, blacklist):
+        self.assert_('someone@example.com' in blacklist)
+        self.assert_('SOMEONE@example.com' in blacklist)
+        self.assert_('Some One <someone@example.com>' in blacklist)
+        self.assert_('anyone@blocked.example.com' in blacklist)
+        self.assertFalse('someone@example.org' in blacklist)
+        self.assertFalse('anyone@not.blocked.example.com' in blacklist)
+
+    def test_index(self):
+        self.assertBlacklisted(self.refreshed_index())
+
+    def test_bloom_filter(self):
+        blacklist = self.refreshed_index(use_bloom_filter=True)
+        self.assertNotEqual(blacklist.bloom_filter, None)
+        self.assertBlacklisted(blacklist)
+
+    def test_is_blacklisted(self):
+        self.assertBlacklisted(BlacklistChecker())
+
+    def test_normalized_email(self):
+        entry = models.Blacklist.objects.create(
+            email=' Some One <Some.One@Example.com>')
+        self.assertEqual(models.Blacklist.objects.get(pk=entry.pk)
+                         .normalized_email, 'some.one@example.com')
+
+    def test_refresh(self):
+        blacklist = self.refreshed_index()
+        self.assertEqual(blacklist.rows, 2)
+        models.Blacklist.objects.create(email='new@example.com')
+        # An entry backdated to before the last one loaded.
+        models.Blacklist.objects.create(
+            email='late@example.com',
+            date_added=datetime.datetime.now() - datetime.timedelta(days=1))
+        blacklist.refresh()
+        self.assertEqual(blacklist.rows, 4)
+        self.assert_('new@example.com' in blacklist)
+        self.assert_('late@example.com' in blacklist)
+        # Removed entries cause the index to be rebuilt.
+        models.Blacklist.objects.filter(email='new@example.com').delete()
+        models.Blacklist.objects.filter(email='late@example.com').delete()
+        blacklist.refresh()
+        self.assertEqual(blacklist.rows, 2)
+        self.assertFalse('new@example.com' in blacklist)
+
+    def test_refresh_replaced(self):
+        blacklist = self.refreshed_index()
+        # Removing one entry and adding another keeps the number of entries
+        # the same.
+        models.Blacklist.objects.filter(email='Someone@Example.com').delete()
+        models.Blacklist.objects.create(email='new@example.com')
+        blacklist.refresh()
+        self.assertEqual(blacklist.rows, 2)
+        self.assertFalse('someone@example.com' in blacklist)
+        self.assert_('new@example.com' in blacklist)
+
+    def test_refresh_out_of_order(self):
+        blacklist = self.refreshed_index()
+        # An entry committed after one with a greater primary key had been
+        # loaded.
+        last_pk = blacklist.last_pk
+        models.Blacklist.objects.create(email='next@example.com',
+                                        pk=last_pk + 2)
+        blacklist.refresh()
+        models.Blacklist.objects.create(email='late@example.com',
+                                        pk=last_pk + 1)
+        blacklist.refresh()
+        self.assertEqual(blacklist.rows, 4)
+        self.assert_('late@example.com' in blacklist)
+
+    def refreshed_index(self, **kwargs):
+        blacklist = BlacklistIndex(**kwargs)
+        blacklist.refresh()
+        return blacklist
+
+
+class BlacklistChecker(object):
+    def __contains__(self, address):
+        return is_blacklisted(address)
@@ -0,0 +1,104 @@
+from django.core import mail
+from django_mailer import bulk, engine, models, queue_email_message
+from django_mailer.tests.base import MailerTestCase
+import datetime
+
+
+class BodyTest(MailerTestCase):
+    """
+    Tests for storing the encoded messages in shared, content-addressed
+    bodies.
+
+    """
+    def test_shared_body(self):
+        recipients = ['recipient%s@djangomailer' % i for i in range(5)]
+        email_message = mail.EmailMessage('test', 'a test message',
+                                          'sender@djangomailer', recipients)
+        queue_email_message(email_message)
+        self.assertEqual(models.MessageBody.objects.count(), 1)
+        body = models.MessageBody.objects.get()
+        self.assertEqual(body.hash,
+                         models.MessageBody.get_hash(body.encoded_message))
+        for message in models.Message.objects.all():
+            self.assertEqual(message.body_id, body.pk)
+            self.assertEqual(message.legacy_encoded_message, '')
+            self.assertEqual(message.encoded_message, body.encoded_message)
+        # Queueing the same content again reuses the body.
+        bulk.queue_messages([models.Message(
+            to_address='other@djangomailer',
+            from_address='sender@djangomailer', subject='test',
+            encoded_message=body.encoded_message)])
+        self.assertEqual(models.MessageBody.objects.count(), 1)
+        self.assertEqual(models.Message.objects.filter(body=body).count(), 6)
+
+    def test_concurrent_store(self):
+        insert = bulk.insert
+
+        def racing_insert(objs):
+            # Another process stores the first body just before this one.
+            bulk.insert = insert
+            models.MessageBody.objects.create(
+                hash=objs[0].hash, encoded_message=objs[0].encoded_message)
+            insert(objs)
+        bulk.insert = racing_insert
+        try:
+            bodies = bulk.store_bodies(['first body', 'second body'])
+        finally:
+            bulk.insert = insert
+        self.assertEqual(models.MessageBody.objects.count(), 2)
+        self.assertEqual([body.encoded_message for body in
+                          models.MessageBody.objects.filter(
+                              pk__in=[body.pk for body in bodies])
+                          .order_by('encoded_message')],
+                         ['first body', 'second body'])
+
+    def test_save(self):
+        message = models.Message.objects.create(
+            to_address='a@djangomailer', from_address='sender@djangomailer',
+            subject='test', encoded_message='Subject: test\n\nbody')
+        other = models.Message.objects.create(
+            to_address='b@djangomailer', from_address='sender@djangomailer',
+            subject='test', encoded_message='Subject: test\n\nbody')
+        self.assertEqual(message.body_id, other.body_id)
+        message = models.Message.objects.get(pk=message.pk)
+        self.assertEqual(message.encoded_message, 'Subject: test\n\nbody')
+
+    def test_load_bodies(self):
+        self.queue_message(recipient_list=['a@djangomailer',
+                                           'b@djangomailer'])
+        block = engine._message_blocks(10, 'worker').next()
+        messages = [queued_message.message for queued_message in block]
+        self.assert_(messages[0].body is messages[1].body)
+
+    def test_migrate(self):
+        for i in range(5):
+            models.Message.objects.create(
+                to_address='recipient%s@djangomailer' % i,
+                from_address='sender@djangomailer', subject='test',
+                legacy_encoded_message='Subject: test %s\n\nbody' % (i % 2))
+        progress = []
+        count = bulk.migrate_message_bodies(chunk_size=2,
+                                            progress=progress.append)
+        self.assertEqual(count, 5)
+        self.assertEqual(progress, [2, 4, 5])
+        self.assertEqual(models.MessageBody.objects.count(), 2)
+        for i, message in enumerate(models.Message.objects.order_by('pk')):
+            self.assertEqual(message.legacy_encoded_message, '')
+            self.assertEqual(message.encoded_message,
+                             'Subject: test %s\n\nbody' % (i % 2))
+        self.assertEqual(bulk.migrate_message_bodies(), 0)
+
+    def test_purge_unused(self):
+        self.queue_message(message='used')
+        self.queue_message(message='unused')
+        models.Message.objects.filter(
+            body__encoded_message__contains='unused').delete()
+        self.assertEqual(models.MessageBody.objects.count(), 2)
+        # Unused bodies are kept for a grace period.
+        self.assertEqual(models.MessageBody.objects.purge_unused(), 0)
+        models.MessageBody.objects.update(
+            date_used=datetime.datetime.now() - datetime.timedelta(days=1))
+        self.assertEqual(models.MessageBody.objects.purge_unused(), 1)
+        body = models.MessageBody.objects.get()
+        self.assert_('used' in body.encoded_message)
+        self.assertEqual(models.Message.objects.count(), 1)
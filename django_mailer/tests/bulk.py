@@ -0,0 +1,117 @@
+from django.core import mail
+from django.db import transaction
+from django.test import TransactionTestCase
+from django_mailer import bulk, constants, models, queue_email_message, \
+    send_mail, send_mass_mail
+from django_mailer.tests.base import MailerTestCase
+
+
+class BulkTest(MailerTestCase):
+    """
+    Tests for writing queued messages with multi-row INSERT statements.
+
+    """
+    def setUp(self):
+        super(BulkTest, self).setUp()
+        self.original_batch_size = bulk.BATCH_SIZE
+        # Use a tiny batch size so that multiple statements are exercised.
+        bulk.BATCH_SIZE = 3
+
+    def tearDown(self):
+        super(BulkTest, self).tearDown()
+        bulk.BATCH_SIZE = self.original_batch_size
+
+    def test_queue_email_message(self):
+        recipients = ['recipient%s@djangomailer' % i for i in range(10)]
+        email_message = mail.EmailMessage('test', 'a test message',
+                                          'sender@djangomailer', recipients)
+        count = queue_email_message(email_message,
+                                    priority=constants.PRIORITY_HIGH)
+        self.assertEqual(count, 10)
+        queued = models.QueuedMessage.objects.select_related()\
+                                             .order_by('message__id')
+        self.assertEqual([q.message.to_address for q in queued], recipients)
+        self.assertEqual(set([q.priority for q in queued]),
+                         set([constants.PRIORITY_HIGH]))
+        self.assertEqual(len(set([q.message.encoded_message
+                                  for q in queued])), 1)
+
+    def test_queue_email_messages(self):
+        email_messages = [
+            mail.EmailMessage('first', 'body', 'sender@djangomailer',
+                              ['a@djangomailer', 'b@djangomailer']),
+            mail.EmailMessage('empty', 'body', 'sender@djangomailer', []),
+            mail.EmailMessage('second', 'body', 'sender@djangomailer',
+                              ['c@djangomailer']),
+        ]
+        self.assertEqual(bulk.queue_email_messages(email_messages), 3)
+        queued = models.QueuedMessage.objects.select_related()\
+                                             .order_by('message__id')
+        self.assertEqual([(q.message.to_address, q.message.subject)
+                          for q in queued],
+                         [('a@djangomailer', 'first'),
+                          ('b@djangomailer', 'first'),
+                          ('c@djangomailer', 'second')])
+        self.assertEqual(set([q.priority for q in queued]),
+                         set([constants.PRIORITY_NORMAL]))
+
+    def test_send_mass_mail(self):
+        datatuple = (('subject %s' % i, 'body', 'sender@djangomailer',
+                      ['a@djangomailer', 'b@djangomailer'])
+                     for i in range(5))
+        progress = []
+        count = send_mass_mail(datatuple, chunk_size=4,
+                               progress=progress.append)
+        self.assertEqual(count, 10)
+        self.assertEqual(progress, [4, 8, 10])
+        self.assertEqual(models.QueuedMessage.objects.count(), 10)
+        self.assertEqual(models.Message.objects.filter(
+                                        subject='subject 4').count(), 2)
+
+    def test_encode_parallel(self):
+        email_messages = [mail.EmailMessage('subject %s' % i, 'body %s' % i,
+                                            'sender@djangomailer',
+                                            ['a%s@djangomailer' % i])
+                          for i in range(25)]
+        count = bulk.queue_email_message_stream(iter(email_messages),
+                                                chunk_size=10, processes=2)
+        self.assertEqual(count, 25)
+        messages = models.Message.objects.order_by('pk')
+        self.assertEqual([message.to_address for message in messages],
+                         ['a%s@djangomailer' % i for i in range(25)])
+        self.assert_('body 24' in messages[24].encoded_message)
+        # Encoding errors are raised in the queueing process.
+        email_messages.append(mail.EmailMessage(
+            'bad\nsubject', 'body', 'sender@djangomailer',
+            ['a@djangomailer']))
+        self.assertRaises(mail.BadHeaderError, list,
+                          bulk._encode_parallel(email_messages, 2,
+                                                chunk_size=4))
+
+
+class TransactionTest(TransactionTestCase):
+    """
+    Tests for queueing messages inside a transaction managed by the caller.
+
+    """
+    def test_rollback(self):
+        @transaction.commit_manually
+        def queue():
+            send_mail('test', 'a test message', 'sender@djangomailer',
+                      ['recipient@djangomailer'])
+            self.assertEqual(models.QueuedMessage.objects.count(), 1)
+            transaction.rollback()
+        queue()
+        # The messages were queued in the caller's transaction, rather than
+        # committing it.
+        self.assertEqual(models.QueuedMessage.objects.count(), 0)
+        self.assertEqual(models.QueueCounter.objects.counts(), {})
+
+    def test_commit(self):
+        @transaction.commit_manually
+        def queue():
+            send_mail('test', 'a test message', 'sender@djangomailer',
+                      ['recipient@djangomailer'])
+            transaction.commit()
+        queue()
+        self.assertEqual(models.QueuedMessage.objects.count(), 1)
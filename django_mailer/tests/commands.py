@@ -3,6 +3,10 @@ from django.core.management import call_command
 from django_mailer import models
 from django_mailer.tests.base import MailerTestCase
 import datetime
+import os
+import pstats
+import shutil
+import tempfile
 
 
 class TestCommands(MailerTestCase):
@@ -64,3 +68,33 @@ class TestCommands(MailerTestCase):
         self.assertEqual(non_deferred_messages.count(), 1)
         call_command('retry_deferred', verbosity='0', max_retries=3)
         self.assertEqual(non_deferred_messages.count(), 3)
+
+    def test_send_mail_profile(self):
+        """
+        The ``--profile`` option of ``send_mail`` writes a summary of the
+        time spent in each phase, and a cProfile dump for sampled runs.
+
+        """
+        self.queue_message()
+        directory = tempfile.mkdtemp()
+        try:
+            call_command('send_mail', verbosity='0', profile=True,
+                         profile_dir=directory)
+            files = sorted(os.listdir(directory))
+            self.assertEqual([os.path.splitext(name)[1] for name in files],
+                             ['.prof', '.txt'])
+            pstats.Stats(os.path.join(directory, files[0]))
+            summary = open(os.path.join(directory, files[1])).read()
+            for phase in ('block fetch', 'blacklist lookup', 'SMTP send',
+                          'delete', 'defer', 'log insert'):
+                self.assert_(phase in summary)
+            self.assertEqual(len(mail.outbox), 1)
+            # Unsampled runs only write the summary.
+            shutil.rmtree(directory)
+            os.mkdir(directory)
+            call_command('send_mail', verbosity='0', profile=True,
+                         profile_dir=directory, profile_rate=0)
+            self.assertEqual([os.path.splitext(name)[1]
+                              for name in os.listdir(directory)], ['.txt'])
+        finally:
+            shutil.rmtree(directory)
@@ -0,0 +1,71 @@
+from django.core import mail
+from django.db import connection
+from django_mailer import compression, engine, models, queue_email_message
+from django_mailer.tests.base import MailerTestCase
+
+
+class CompressionTest(MailerTestCase):
+    """
+    Tests for compressing stored message bodies.
+
+    """
+    def setUp(self):
+        super(CompressionTest, self).setUp()
+        self.original_method = compression.METHOD
+        self.body = u'A long message body \u2713.\n' * 100
+
+    def tearDown(self):
+        super(CompressionTest, self).tearDown()
+        compression.METHOD = self.original_method
+
+    def stored_bodies(self):
+        cursor = connection.cursor()
+        cursor.execute('SELECT encoded_message FROM %s ORDER BY id' %
+                       models.MessageBody._meta.db_table)
+        return [row[0] for row in cursor.fetchall()]
+
+    def test_compress(self):
+        compressed = compression.compress(self.body, method='zlib')
+        self.assertEqual(compression.method_of(compressed), 'zlib')
+        self.assert_(len(compressed) < len(self.body))
+        self.assertEqual(compression.decompress(compressed), self.body)
+        # Compressed values aren't compressed again.
+        self.assertEqual(compression.compress(compressed, method='zlib'),
+                         compressed)
+        # Short and uncompressed values are left alone.
+        self.assertEqual(compression.compress(u'short', method='zlib'),
+                         u'short')
+        self.assertEqual(compression.compress(self.body), self.body)
+        self.assertEqual(compression.decompress(self.body), self.body)
+
+    def test_stored_compressed(self):
+        compression.METHOD = 'zlib'
+        email_message = mail.EmailMessage('test', self.body,
+                                          'sender@djangomailer',
+                                          ['recipient@djangomailer'])
+        queue_email_message(email_message)
+        stored, = self.stored_bodies()
+        self.assertEqual(compression.method_of(stored), 'zlib')
+        message = models.Message.objects.get()
+        self.assertEqual(message.encoded_message,
+                         compression.decompress(stored))
+        engine.send_all()
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(models.QueuedMessage.objects.count(), 0)
+
+    def test_compress_existing(self):
+        self.queue_message(message=self.body)
+        self.queue_message(message='short')
+        before = dict((body.pk, body.encoded_message)
+                      for body in models.MessageBody.objects.all())
+        count, size_before, size_after = \
+            models.MessageBody.objects.compress(batch_size=1)
+        self.assertEqual(count, 1)
+        self.assert_(size_after < size_before)
+        self.assertEqual([compression.method_of(stored) is not None
+                          for stored in self.stored_bodies()],
+                         [True, False])
+        after = dict((body.pk, body.encoded_message)
+                     for body in models.MessageBody.objects.all())
+        self.assertEqual(after, before)
+        self.assertEqual(models.MessageBody.objects.compress(), (0, 0, 0))
@@ -0,0 +1,136 @@
+from django.core.management import call_command
+from django.db import transaction
+from django.test import TransactionTestCase
+from django_mailer import constants, engine, models, send_mail
+from django_mailer.tests.base import MailerTestCase
+import StringIO
+import sys
+
+
+class CounterTest(MailerTestCase):
+    """
+    Tests for the queue counters.
+
+    """
+    def assertCounts(self, expected):
+        counts = models.QueueCounter.objects.counts()
+        self.assertEqual(dict((key, count) for key, count in counts.items()
+                              if count), expected)
+        self.assertEqual(dict((key, count) for key, count in
+                              models.QueuedMessage.objects.exact_counts()
+                              .items() if count), expected)
+
+    def test_queue(self):
+        high, normal = constants.PRIORITY_HIGH, constants.PRIORITY_NORMAL
+        self.queue_message()
+        self.queue_message()
+        self.queue_message(priority=high)
+        self.assertCounts({(normal, False): 2, (high, False): 1})
+        engine.send_all()
+        self.assertCounts({})
+
+    def test_defer_and_retry(self):
+        normal, low = constants.PRIORITY_NORMAL, constants.PRIORITY_LOW
+        for i in range(3):
+            self.queue_message()
+        queued_messages = list(models.QueuedMessage.objects.all())
+        engine._record_many([(queued_messages[0], constants.RESULT_SENT, ''),
+                             (queued_messages[1], constants.RESULT_FAILED,
+                              '')])
+        self.assertCounts({(normal, False): 1, (normal, True): 1})
+        queued_message = models.QueuedMessage.objects.deferred().get()
+        queued_message.defer()
+        self.assertCounts({(normal, False): 1, (normal, True): 1})
+        self.assertEqual(models.QueuedMessage.objects.retry_deferred(
+            new_priority=low), 1)
+        self.assertCounts({(normal, False): 1, (low, False): 1})
+        models.QueuedMessage.objects.get(priority=low).delete()
+        self.assertCounts({(normal, False): 1})
+
+    def test_record_missing(self):
+        normal = constants.PRIORITY_NORMAL
+        for i in range(3):
+            self.queue_message()
+        queued_messages = list(models.QueuedMessage.objects.all())
+        models.QueuedMessage.objects.filter(pk=queued_messages[0].pk)\
+                                    .update(lease_owner='other')
+        queued_messages[1].delete()
+        models.QueuedMessage.objects.filter(pk=queued_messages[2].pk)\
+                                    .update(lease_owner='worker')
+        # Only the message still leased to the worker is counted.
+        engine._record_many([(queued_message, constants.RESULT_FAILED, '')
+                             for queued_message in queued_messages],
+                            worker_id='worker')
+        self.assertCounts({(normal, False): 1, (normal, True): 1})
+        self.assertEqual(models.Log.objects.count(), 3)
+
+    def test_save(self):
+        normal, high = constants.PRIORITY_NORMAL, constants.PRIORITY_HIGH
+        self.queue_message()
+        queued_message = models.QueuedMessage.objects.get()
+        # The counted state is known from loading the message, as when it is
+        # changed in the admin.
+        queued_message.priority = high
+        queued_message.save()
+        self.assertCounts({(high, False): 1})
+        queued_message.save(previous=(high, False))
+        self.assertCounts({(high, False): 1})
+        queued_message.delete()
+        self.assertCounts({})
+
+    def test_rebuild(self):
+        normal = constants.PRIORITY_NORMAL
+        self.queue_message()
+        self.queue_message()
+        # Bulk changes to the queue aren't counted.
+        models.QueuedMessage.objects.filter(
+            pk=models.QueuedMessage.objects.all()[0].pk).delete()
+        self.assertEqual(models.QueueCounter.objects.counts(),
+                         {(normal, False): 2})
+        call_command('rebuild_queue_counters', verbosity='0')
+        self.assertCounts({(normal, False): 1})
+
+    def test_send_mail_count(self):
+        self.queue_message()
+        self.queue_message(priority=constants.PRIORITY_HIGH)
+        models.QueuedMessage.objects.high_priority().get().defer()
+        for options in ({}, {'exact': True}):
+            stdout = sys.stdout
+            sys.stdout = StringIO.StringIO()
+            try:
+                try:
+                    call_command('send_mail', count=True, **options)
+                except SystemExit:
+                    pass
+                output = sys.stdout.getvalue()
+            finally:
+                sys.stdout = stdout
+            lines = output.splitlines()
+            self.assertEqual(lines[0],
+                             '1 queued message (and 1 deferred message).')
+            self.assertEqual(lines[1], '  high: 0 queued, 1 deferred')
+            self.assert_(lines[2].startswith(
+                '  normal: 1 queued, 0 deferred, oldest queued '))
+
+
+class CounterTransactionTest(TransactionTestCase):
+    """
+    Tests for changing queued messages inside a transaction managed by the
+    caller.
+
+    """
+    def test_rollback(self):
+        normal = constants.PRIORITY_NORMAL
+        send_mail('test', 'a test message', 'sender@djangomailer',
+                  ['recipient@djangomailer'])
+
+        @transaction.commit_manually
+        def change():
+            models.QueuedMessage.objects.get().defer()
+            transaction.rollback()
+        change()
+        # The message was deferred in the caller's transaction, rather than
+        # committing it.
+        self.assertEqual(models.QueuedMessage.objects.deferred().count(), 0)
+        self.assertEqual(models.QueueCounter.objects.counts(),
+                         {(normal, False): 1})
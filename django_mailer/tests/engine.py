@@ -1,9 +1,16 @@
+from django.conf import settings
+from django.core import mail
+from django.core.mail.backends import smtp
 from django.test import TestCase
-from django_mailer import engine
+from django_mailer import constants, engine, models, smtp as mailer_smtp
 from django_mailer.lockfile import FileLock
+from django_mailer.tests.base import MailerTestCase, SMTPSink
 from StringIO import StringIO
+import datetime
 import logging
+import sys
 import time
+import traceback
 
 
 class LockTest(TestCase):
@@ -28,6 +35,10 @@ class LockTest(TestCase):
         self.original_timeout = engine.LOCK_WAIT_TIMEOUT
         engine.LOCK_WAIT_TIMEOUT = -1
 
+        # Use the lock file.
+        self.original_use_file_lock = engine.USE_FILE_LOCK
+        engine.USE_FILE_LOCK = True
+
     def tearDown(self):
         # Remove the log handler.
         logger = logging.getLogger('django_mailer')
@@ -36,6 +47,8 @@ class LockTest(TestCase):
         # Revert the LOCK_WAIT_TIMEOUT to it's original value.
         engine.LOCK_WAIT_TIMEOUT = self.original_timeout
 
+        engine.USE_FILE_LOCK = self.original_use_file_lock
+
     def test_locked(self):
         # Acquire the lock (under a different unique name) so that send_all
         # will fail.
@@ -82,3 +95,262 @@ class LockTest(TestCase):
         finally:
             lock.release()
             time.time = original_time
+
+
+class LeaseTest(MailerTestCase):
+    """
+    Tests for leasing blocks of queued messages to sending processes.
+
+    """
+    def test_claim(self):
+        for i in range(5):
+            self.queue_message(subject='test %s' % i)
+        queue = models.QueuedMessage.objects
+        first = queue.claim('first', limit=3)
+        self.assertEqual([q.message.subject for q in first],
+                         ['test 0', 'test 1', 'test 2'])
+        # Another process can only claim messages which aren't leased.
+        second = queue.claim('second', limit=3)
+        self.assertEqual([q.message.subject for q in second],
+                         ['test 3', 'test 4'])
+        self.assertEqual(queue.claim('third', limit=3).count(), 0)
+        # Expired leases can be claimed again.
+        queue.filter(lease_owner='first')\
+             .update(lease_expires=datetime.datetime.now())
+        self.assertEqual(queue.claim('third', limit=2).count(), 2)
+        # Released messages are immediately available.
+        queue.release_leases('second')
+        self.assertEqual(queue.available().count(), 3)
+
+    def test_claim_after(self):
+        for i in range(4):
+            self.queue_message(subject='test %s' % i)
+        queue = models.QueuedMessage.objects
+        first = list(queue.claim('worker', limit=2))
+        last = first[-1]
+        after = (last.priority, last.date_queued, last.pk)
+        # Messages before the key aren't claimed, even if they're available.
+        queue.release_leases('worker')
+        self.assertEqual([q.message.subject for q in
+                          queue.claim('worker', limit=2, after=after)],
+                         ['test 2', 'test 3'])
+        queue.release_leases('worker')
+        # A higher priority message resets the key.
+        self.queue_message(subject='urgent',
+                           priority=constants.PRIORITY_HIGH)
+        self.assertEqual([q.message.subject for q in
+                          queue.claim('worker', limit=2, after=after)],
+                         ['urgent', 'test 0'])
+
+    def test_message_blocks_restart(self):
+        for i in range(4):
+            self.queue_message(subject='test %s' % i)
+        original_lease_duration = engine.LEASE_DURATION
+        engine.LEASE_DURATION = 0
+        try:
+            blocks = engine._message_blocks(2, 'worker')
+            self.assertEqual([q.message.subject for q in blocks.next()],
+                             ['test 0', 'test 1'])
+            # A message behind the key becomes available again.
+            queue = models.QueuedMessage.objects
+            queue.filter(message__subject='test 0').delete()
+            queue.filter(message__subject='test 1').update(
+                deferred=datetime.datetime.now())
+            queue.retry_deferred()
+            self.assertEqual([q.message.subject for q in blocks.next()],
+                             ['test 1', 'test 2'])
+        finally:
+            engine.LEASE_DURATION = original_lease_duration
+
+    def test_claim_due_retries_first(self):
+        self.queue_message(subject='new')
+        self.queue_message(subject='retry')
+        models.QueuedMessage.objects.filter(message__subject='retry').update(
+            deferred=datetime.datetime.now(), retries=1,
+            next_attempt=datetime.datetime.now())
+        self.assertEqual([q.message.subject for q in
+                          models.QueuedMessage.objects.claim('worker',
+                                                             limit=1)],
+                         ['retry'])
+
+    def test_defer_releases_lease(self):
+        self.queue_message()
+        queued_message = models.QueuedMessage.objects.claim('worker').get()
+        queued_message.defer()
+        queued_message = models.QueuedMessage.objects.get()
+        self.assertEqual(queued_message.lease_owner, '')
+        self.assertEqual(queued_message.lease_expires, None)
+
+    def test_send_all_skips_leased(self):
+        self.queue_message(subject='leased')
+        self.queue_message()
+        models.QueuedMessage.objects.claim('other', limit=1)
+        engine.send_all()
+        self.assertEqual(len(mail.outbox), 1)
+        queued_message = models.QueuedMessage.objects.get()
+        self.assertEqual(queued_message.message.subject, 'leased')
+        self.assertEqual(queued_message.lease_owner, 'other')
+
+
+    def test_send_all_lost_lease(self):
+        for i in range(3):
+            self.queue_message(subject='test %s' % i)
+        deliver_group = engine._deliver_group
+
+        def stalled_deliver_group(messages, smtp_connection):
+            # The leases expire while the first message is being sent, and
+            # another process claims the messages.
+            models.QueuedMessage.objects.update(
+                lease_expires=datetime.datetime.now())
+            models.QueuedMessage.objects.claim('other')
+            return deliver_group(messages, smtp_connection)
+        engine._deliver_group = stalled_deliver_group
+        try:
+            engine.send_all()
+        finally:
+            engine._deliver_group = deliver_group
+        # Only the message which was already being sent is sent, and the
+        # queue is left to the other process.
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(
+            models.QueuedMessage.objects.filter(lease_owner='other').count(),
+            3)
+
+
+class ThreadedSendTest(MailerTestCase):
+    """
+    Tests for delivering messages with a pool of delivery threads.
+
+    """
+    def test_send_all(self):
+        for i in range(20):
+            self.queue_message(subject='test %s' % i)
+        self.queue_message(recipient_list=['blacklisted@djangomailer'])
+        models.Blacklist.objects.create(email='blacklisted@djangomailer')
+        engine.send_all(block_size=7, workers=3)
+        self.assertEqual(len(mail.outbox), 20)
+        self.assertEqual(models.QueuedMessage.objects.count(), 0)
+        logs = models.Log.objects.all()
+        self.assertEqual(logs.filter(result=constants.RESULT_SENT).count(),
+                         20)
+        self.assertEqual(logs.filter(result=constants.RESULT_SKIPPED).count(),
+                         1)
+
+    def test_connection_per_thread(self):
+        sink = SMTPSink()
+        sink.start()
+        original_settings = (settings.EMAIL_HOST, settings.EMAIL_PORT)
+        settings.EMAIL_HOST, settings.EMAIL_PORT = sink.host, sink.port
+        # The test runner replaces Django's SMTP backend.
+        original_backend = mailer_smtp.SMTPConnection
+        mailer_smtp.SMTPConnection = smtp.EmailBackend
+        try:
+            for i in range(20):
+                self.queue_message(subject='test %s' % i)
+            engine.send_all(block_size=7, workers=3)
+        finally:
+            settings.EMAIL_HOST, settings.EMAIL_PORT = original_settings
+            mailer_smtp.SMTPConnection = original_backend
+            sink.stop()
+        self.assertEqual(len(sink.messages), 20)
+        # Each thread keeps one SMTP session open for the whole run.
+        self.assertEqual(sink.sessions, 3)
+
+
+    def test_worker_error(self):
+        self.queue_message()
+        deliver_group = engine._deliver_group
+
+        def broken_deliver_group(messages, smtp_connection):
+            raise ValueError('broken')
+        engine._deliver_group = broken_deliver_group
+        try:
+            try:
+                engine.send_all(workers=2)
+            except ValueError:
+                error_traceback = traceback.extract_tb(sys.exc_info()[2])
+            else:
+                self.fail('The delivery thread error was not raised.')
+        finally:
+            engine._deliver_group = deliver_group
+        # The error is raised with the traceback from the delivery thread.
+        self.assertEqual(error_traceback[-1][2], 'broken_deliver_group')
+
+
+class ResultBufferTest(MailerTestCase):
+    """
+    Tests for buffering the results of sending messages.
+
+    """
+    def test_buffer(self):
+        for i in range(3):
+            self.queue_message(subject='test %s' % i)
+        queued = list(models.QueuedMessage.objects.all())
+        buffer = engine.ResultBuffer(size=3)
+        buffer.add(queued[0], constants.RESULT_SENT, '')
+        buffer.add(queued[1], constants.RESULT_FAILED, 'failed')
+        # Nothing is written until the buffer is flushed.
+        self.assertEqual(models.QueuedMessage.objects.count(), 3)
+        self.assertEqual(models.Log.objects.count(), 0)
+        # Filling the buffer flushes it.
+        buffer.add(queued[2], constants.RESULT_SKIPPED, '')
+        self.assertEqual(buffer.results, [])
+        queued_message = models.QueuedMessage.objects.get()
+        self.assertEqual(queued_message.message.subject, 'test 1')
+        self.assertNotEqual(queued_message.deferred, None)
+        self.assertEqual(models.Log.objects.count(), 3)
+        self.assertEqual(models.Log.objects.get(
+            result=constants.RESULT_FAILED).log_message, 'failed')
+
+
+class GroupTest(MailerTestCase):
+    """
+    Tests for sending identical messages to many recipients in a single SMTP
+    transaction.
+
+    """
+    def setUp(self):
+        super(GroupTest, self).setUp()
+        self.recipients = ['a@one.example.com', 'b@one.example.com',
+                           'c@one.example.com', 'a@two.example.com',
+                           'refused@two.example.com']
+        self.queue_message(recipient_list=self.recipients)
+        self.queue_message(recipient_list=['b@two.example.com'])
+
+    def test_group_messages(self):
+        queued = models.QueuedMessage.objects.select_related()\
+                                             .order_by('message__id')
+        groups = engine._group_messages(queued, max_recipients=2)
+        self.assertEqual([[q.message.to_address for q in group]
+                          for group in groups],
+                         [['a@one.example.com', 'b@one.example.com'],
+                          ['c@one.example.com'],
+                          ['a@two.example.com', 'refused@two.example.com'],
+                          ['b@two.example.com']])
+        groups = engine._group_messages(queued, max_recipients=1)
+        self.assertEqual(len(groups), 6)
+
+    def test_deliver_group(self):
+        sink = SMTPSink(refuse=['refused@two.example.com'])
+        sink.start()
+        try:
+            connection = smtp.EmailBackend(host=sink.host, port=sink.port)
+            messages = [q.message for q in models.QueuedMessage.objects
+                        .select_related().order_by('message__id')[:5]]
+            results = engine._deliver_group(messages, connection)
+        finally:
+            sink.stop()
+        self.assertEqual([result for result, log_message in results],
+                         [constants.RESULT_SENT] * 4 +
+                         [constants.RESULT_FAILED])
+        self.assert_('No such user' in results[-1][1])
+        self.assertEqual(len(sink.messages), 1)
+        self.assertEqual(sink.messages[0][1], self.recipients[:4])
+
+    def test_send_all(self):
+        engine.send_all()
+        # One transaction for each domain, and one for the other message.
+        self.assertEqual(len(mail.outbox), 3)
+        self.assertEqual(models.QueuedMessage.objects.count(), 0)
+        self.assertEqual(models.Log.objects.filter(
+            result=constants.RESULT_SENT).count(), 6)
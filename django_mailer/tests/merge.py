@@ -0,0 +1,114 @@
+from django.core import mail
+from django.template import TemplateSyntaxError
+from django_mailer import bulk, constants, engine, merge, models
+from django_mailer.tests.base import MailerTestCase
+import email
+
+
+class RecordingConnection(object):
+    """
+    A fake SMTP connection which keeps the messages sent through it.
+
+    """
+    def __init__(self):
+        self.sent = []
+
+    def ehlo_or_helo_if_needed(self):
+        pass
+
+    def has_extn(self, extension):
+        return False
+
+    def sendmail(self, from_address, to_addresses, encoded_message):
+        self.sent.append((to_addresses, encoded_message))
+        return {}
+
+
+class MergeTest(MailerTestCase):
+    """
+    Tests for mail merges.
+
+    """
+    def setUp(self):
+        super(MergeTest, self).setUp()
+        self.connection = RecordingConnection()
+        mail.SMTPConnection.connection = self.connection
+
+    def queue(self, recipients, **kwargs):
+        return bulk.queue_template_messages(
+            'Hello {{ name }}', 'Dear {{ name }} & co,\n{{ to_address }}',
+            'shop@example.com', recipients,
+            html='<p>Dear {{ name }}</p>', **kwargs)
+
+    def test_queue(self):
+        progress = []
+        count = self.queue([('a@example.com', {'name': 'Ann'}),
+                            ('b@example.com', {'name': '<Bob>'}),
+                            ('c@example.com', {'name': 'Cy'})],
+                           chunk_size=2, progress=progress.append)
+        self.assertEqual(count, 3)
+        self.assertEqual(progress, [2, 3])
+        self.assertEqual(models.MessageTemplate.objects.count(), 1)
+        self.assertEqual(models.MessageBody.objects.count(), 0)
+        message = models.Message.objects.get(to_address='b@example.com')
+        self.assertEqual(message.subject, 'Hello {{ name }}')
+        self.assertEqual(message.context, '{"name":"<Bob>"}')
+        # Queueing the same templates again reuses them.
+        self.queue([('d@example.com', {'name': 'Di'})])
+        self.assertEqual(models.MessageTemplate.objects.count(), 1)
+
+    def test_send(self):
+        self.queue([('a@example.com', {'name': 'Ann'}),
+                    ('b@example.com', {'name': '<Bob>'})])
+        engine.send_all()
+        self.assertEqual(models.QueuedMessage.objects.count(), 0)
+        self.assertEqual([to_addresses for to_addresses, _ in
+                          self.connection.sent],
+                         [['a@example.com'], ['b@example.com']])
+        message = email.message_from_string(self.connection.sent[1][1])
+        self.assertEqual(message['Subject'], 'Hello <Bob>')
+        self.assertEqual(message['To'], 'b@example.com')
+        text, html = message.get_payload()
+        self.assertEqual(text.get_payload(),
+                         'Dear <Bob> & co,\nb@example.com')
+        self.assertEqual(html.get_payload(), '<p>Dear &lt;Bob&gt;</p>')
+
+    def test_template_syntax_error(self):
+        self.assertRaises(TemplateSyntaxError, bulk.queue_template_messages,
+                          'Hello {% if %}', 'Dear {{ name }}',
+                          'shop@example.com', [('a@example.com', {})])
+        self.assertEqual(models.MessageTemplate.objects.count(), 0)
+        self.assertEqual(models.Message.objects.count(), 0)
+
+    def test_render_error(self):
+        self.assertRenderErrorDeferred()
+
+    def test_render_error_threaded(self):
+        self.assertRenderErrorDeferred(workers=2)
+
+    def assertRenderErrorDeferred(self, **kwargs):
+        self.queue([('a@example.com', {'name': 'Ann'}),
+                    ('b@example.com', {'name': 'Bob'}),
+                    ('c@example.com', {'name': 'Cy'})])
+        models.Message.objects.filter(to_address='b@example.com')\
+                              .update(context='{"name":')
+        engine.send_all(**kwargs)
+        # The message which can't be rendered is deferred, and the others
+        # are still sent.
+        self.assertEqual(sorted([to_addresses for to_addresses, _ in
+                                 self.connection.sent]),
+                         [['a@example.com'], ['c@example.com']])
+        queued = models.QueuedMessage.objects.get()
+        self.assertEqual(queued.message.to_address, 'b@example.com')
+        self.assertNotEqual(queued.deferred, None)
+        self.assertEqual(models.Log.objects.filter(
+            result=constants.RESULT_FAILED,
+            message__to_address='b@example.com').count(), 1)
+
+    def test_template_cache(self):
+        self.queue([('a@example.com', {'name': 'Ann'})])
+        template = models.MessageTemplate.objects.get()
+        merge._cache.clear()
+        compiled = merge.compiled(template)
+        self.assert_(merge.compiled(template) is compiled)
+        self.assert_(template.hash in merge._cache)
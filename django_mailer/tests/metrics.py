@@ -0,0 +1,117 @@
+from django_mailer import constants, engine, metrics, models
+from django_mailer.tests.base import MailerTestCase
+import os
+import shutil
+import tempfile
+import urllib2
+
+
+class RecordingSink(metrics.Sink):
+    def __init__(self):
+        self.measurements = []
+        self.flushed = 0
+
+    def increment(self, name, value, labels):
+        self.measurements.append(('increment', name, value, labels))
+
+    def observe(self, name, value, labels):
+        self.measurements.append(('observe', name, value, labels))
+
+    def flush(self, registry):
+        self.flushed += 1
+
+
+class MetricsTest(MailerTestCase):
+    """
+    Tests for the metrics registry and its exporters.
+
+    """
+    def setUp(self):
+        super(MetricsTest, self).setUp()
+        self.original_sinks = metrics.registry.sinks
+        metrics.registry.sinks = []
+        metrics.registry.reset()
+
+    def tearDown(self):
+        super(MetricsTest, self).tearDown()
+        metrics.registry.sinks = self.original_sinks
+        metrics.registry.reset()
+
+    def test_render(self):
+        registry = metrics.Registry()
+        registry.increment('messages_total', 2, result='sent',
+                           domain='example.com')
+        registry.increment('messages_total', result='sent',
+                           domain='example.com')
+        registry.set('queue_depth', 4, priority='high', state='queued')
+        registry.observe('smtp_seconds', 0.003)
+        registry.observe('smtp_seconds', 0.1)
+        registry.increment('custom', domain='quote"d')
+        lines = registry.render().splitlines()
+        self.assert_('# TYPE django_mailer_messages_total counter' in lines)
+        self.assert_('django_mailer_messages_total{domain="example.com",'
+                     'result="sent"} 3.0' in lines)
+        self.assert_('django_mailer_queue_depth{priority="high",'
+                     'state="queued"} 4.0' in lines)
+        self.assert_('# TYPE django_mailer_smtp_seconds histogram' in lines)
+        self.assert_('django_mailer_smtp_seconds_bucket{le="0.0025"} 0'
+                     in lines)
+        self.assert_('django_mailer_smtp_seconds_bucket{le="0.005"} 1'
+                     in lines)
+        self.assert_('django_mailer_smtp_seconds_bucket{le="0.1"} 2' in lines)
+        self.assert_('django_mailer_smtp_seconds_bucket{le="+Inf"} 2'
+                     in lines)
+        self.assert_('django_mailer_smtp_seconds_count 2' in lines)
+        self.assert_('django_mailer_custom{domain="quote\\"d"} 1.0' in lines)
+
+    def test_send_all(self):
+        sink = RecordingSink()
+        metrics.registry.sinks = [sink]
+        self.queue_message(recipient_list=['a@one.example.com',
+                                           'b@one.example.com'])
+        self.queue_message(recipient_list=['a@two.example.com'])
+        self.queue_message(subject='deferred')
+        models.QueuedMessage.objects.filter(
+            message__subject='deferred').update(
+            deferred='2000-01-01 00:00:00', next_attempt='2100-01-01 00:00:00')
+        # The queue depth is read from the counters, which bulk updates skip.
+        models.QueueCounter.objects.rebuild()
+        engine.send_all()
+        registry = metrics.registry
+        self.assertEqual(registry.value('messages_total', result='sent',
+                                        domain='one.example.com'), 2)
+        self.assertEqual(registry.value('messages_total', result='sent',
+                                        domain='two.example.com'), 1)
+        self.assertEqual(registry.value('smtp_seconds').count, 2)
+        self.assertEqual(registry.value('queue_age_seconds').count, 3)
+        self.assert_(registry.value('db_fetch_seconds').count >= 1)
+        self.assertEqual(registry.value('db_write_seconds').count, 1)
+        self.assertEqual(registry.value('queue_depth', priority='normal',
+                                        state='deferred'), 1)
+        self.assertEqual(registry.value('queue_depth', priority='normal',
+                                        state='queued'), 0)
+        self.assert_(('observe', 'db_write_seconds') in
+                     [measurement[:2] for measurement in sink.measurements])
+        self.assertEqual(sink.flushed, 1)
+
+    def test_exporters(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'django_mailer.prom')
+            sink = metrics.load_sink(
+                'django_mailer.metrics.PrometheusFileSink', path=path)
+            metrics.registry.increment('messages_total', result='sent',
+                                       domain='example.com')
+            sink.flush(metrics.registry)
+            self.assertEqual(open(path).read(), metrics.registry.render())
+            self.assertEqual(os.listdir(directory), ['django_mailer.prom'])
+        finally:
+            shutil.rmtree(directory)
+        server = metrics.start_http_server(port=0)
+        try:
+            response = urllib2.urlopen('http://127.0.0.1:%s/metrics' %
+                                       server.server_address[1])
+            self.assertEqual(response.read(), metrics.registry.render())
+        finally:
+            server.shutdown()
+            server.server_close()
@@ -0,0 +1,51 @@
+from django_mailer import notify
+from django_mailer.tests.base import MailerTestCase
+import os
+import tempfile
+import time
+
+
+class NotifyTest(MailerTestCase):
+    """
+    Tests for waking up sending processes when messages are queued.
+
+    """
+    def setUp(self):
+        super(NotifyTest, self).setUp()
+        self.original_path = notify.SOCKET_PATH
+        self.directory = tempfile.mkdtemp()
+        notify.SOCKET_PATH = os.path.join(self.directory, 'notify.sock')
+        self.listener = notify.Listener()
+
+    def tearDown(self):
+        super(NotifyTest, self).tearDown()
+        self.listener.close()
+        notify.SOCKET_PATH = self.original_path
+        os.rmdir(self.directory)
+
+    def test_wait(self):
+        self.assertEqual(self.listener.method, 'socket')
+        start = time.time()
+        self.assertFalse(self.listener.wait(0.1))
+        self.assert_(time.time() - start >= 0.1)
+        notify.notify()
+        notify.notify()
+        start = time.time()
+        self.assert_(self.listener.wait(10))
+        self.assert_(time.time() - start < 1)
+        # Pending notifications are all consumed by one wait.
+        self.assertFalse(self.listener.wait(0))
+
+    def test_queueing_notifies(self):
+        self.queue_message()
+        self.assert_(self.listener.wait(0))
+
+    def test_one_listener(self):
+        other = notify.Listener()
+        self.assertEqual(other.method, None)
+        # A socket left behind by a stopped process is replaced.
+        self.listener.sock.close()
+        self.listener.sock = None
+        other = notify.Listener()
+        self.assertEqual(other.method, 'socket')
+        other.close()
@@ -0,0 +1,108 @@
+from django.core import mail
+from django_mailer import engine, models, ratelimit
+from django_mailer.tests.base import MailerTestCase
+import datetime
+import os
+import tempfile
+
+
+class RateLimitTest(MailerTestCase):
+    """
+    Tests for rate limiting the messages sent to each domain.
+
+    """
+    def setUp(self):
+        super(RateLimitTest, self).setUp()
+        self.original_settings = (ratelimit.GLOBAL_LIMIT,
+                                  ratelimit.DOMAIN_LIMITS, ratelimit.STORAGE)
+        ratelimit._limiter = None
+
+    def tearDown(self):
+        super(RateLimitTest, self).tearDown()
+        (ratelimit.GLOBAL_LIMIT, ratelimit.DOMAIN_LIMITS,
+         ratelimit.STORAGE) = self.original_settings
+        ratelimit._limiter = None
+
+    def check_limiter(self, limiter, other=None):
+        other = other or limiter
+        self.assertEqual(limiter.acquire('example.com', now=100), (0, None))
+        self.assertEqual(other.acquire('Example.com', now=100), (0, None))
+        # The burst is used up, so the next message must wait for a token.
+        wait, limited = limiter.acquire('example.com', now=100)
+        self.assertEqual((round(wait, 3), limited), (0.5, '@example.com'))
+        self.assertEqual(other.acquire('example.com', now=100.5), (0, None))
+        # Other domains aren't limited, apart from by the global limit.
+        for i in range(4):
+            self.assertEqual(limiter.acquire('other.com', now=100.5),
+                             (0, None))
+        wait, limited = limiter.acquire('other.com', now=100.5)
+        self.assertEqual((round(wait, 3), limited), (0.1, ratelimit.GLOBAL))
+        # Groups bigger than the burst size are sent once the bucket is full.
+        self.assertEqual(limiter.acquire('example.com', 5, now=101.5),
+                         (0, None))
+        wait, limited = limiter.acquire('example.com', now=101.5)
+        self.assertEqual(round(wait, 3), 2.0)
+
+    def make_limiter(self, storage):
+        return ratelimit.RateLimiter((10, 5), {'example.com': (2, 2)},
+                                     storage=storage)
+
+    def test_memory(self):
+        self.check_limiter(self.make_limiter('memory'))
+
+    def test_database(self):
+        self.check_limiter(self.make_limiter('database'),
+                           self.make_limiter('database'))
+        self.assertEqual(models.RateLimit.objects.count(), 2)
+
+    def test_file(self):
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'ratelimit')
+        storages = [ratelimit.FileStorage(path), ratelimit.FileStorage(path)]
+        try:
+            self.check_limiter(self.make_limiter(storages[0]),
+                               self.make_limiter(storages[1]))
+        finally:
+            for storage in storages:
+                storage.close()
+            os.unlink(path)
+            os.rmdir(directory)
+
+    def test_get_limiter(self):
+        ratelimit.GLOBAL_LIMIT = None
+        ratelimit.DOMAIN_LIMITS = {'example.com': (2, 2)}
+        ratelimit.STORAGE = 'memory'
+        limiter = ratelimit.get_limiter()
+        limiter.acquire('example.com', 2, now=100)
+        # The same limiter (with the same buckets) is used by the next run.
+        self.assert_(ratelimit.get_limiter() is limiter)
+        self.assertEqual(ratelimit.get_limiter().acquire('example.com',
+                                                         now=100),
+                         (0.5, '@example.com'))
+        ratelimit.DOMAIN_LIMITS = {'example.com': (4, 4)}
+        self.assert_(ratelimit.get_limiter() is not limiter)
+        ratelimit.DOMAIN_LIMITS = {}
+        self.assertEqual(ratelimit.get_limiter(), None)
+
+    def test_send_all(self):
+        ratelimit.GLOBAL_LIMIT = None
+        ratelimit.DOMAIN_LIMITS = {'slow.example.com': (0.01, 1)}
+        ratelimit.STORAGE = 'memory'
+        for i in range(3):
+            self.queue_message(subject='slow %s' % i,
+                               recipient_list=['user@slow.example.com'])
+        self.queue_message(recipient_list=['a@djangomailer',
+                                           'b@djangomailer'])
+        engine.send_all()
+        self.assertEqual(len(mail.outbox), 2)
+        # The other messages to the throttled domain are held back without
+        # being deferred.
+        held = models.QueuedMessage.objects.all()
+        self.assertEqual(held.count(), 2)
+        for queued_message in held:
+            self.assertEqual(queued_message.deferred, None)
+            self.assertEqual(queued_message.retries, 0)
+            self.assertEqual(queued_message.lease_owner, '')
+            self.assert_(queued_message.lease_expires >
+                         datetime.datetime.now())
+        self.assertEqual(models.QueuedMessage.objects.available().count(), 0)
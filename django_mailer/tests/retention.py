@@ -0,0 +1,88 @@
+from django.core.management import call_command
+from django_mailer import bulk, constants, engine, models, retention
+from django_mailer.tests.base import MailerTestCase
+import datetime
+import gzip
+import json
+import os
+import shutil
+import tempfile
+
+
+class RetentionTest(MailerTestCase):
+    """
+    Tests for purging (and archiving) old logs and messages.
+
+    """
+    def setUp(self):
+        super(RetentionTest, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        old = datetime.datetime.now() - datetime.timedelta(days=100)
+        for i in range(5):
+            self.queue_message(subject='sent %s' % i)
+        engine.send_all()
+        # A message which was retried recently keeps its old log.
+        self.queue_message(subject='recent')
+        engine.send_all()
+        self.queue_message(subject='queued')
+        models.Message.objects.update(date_created=old)
+        models.Log.objects.update(date=old)
+        recent = models.Message.objects.get(subject='recent')
+        models.Log.objects.create(message=recent,
+                                  result=constants.RESULT_FAILED,
+                                  log_message='retried')
+        self.before = datetime.datetime.now() - datetime.timedelta(days=90)
+
+    def tearDown(self):
+        super(RetentionTest, self).tearDown()
+        shutil.rmtree(self.directory)
+
+    def test_purge(self):
+        progress = []
+        logs, messages = retention.purge(
+            self.before, chunk_size=2,
+            progress=lambda *counts: progress.append(counts))
+        self.assertEqual((logs, messages), (6, 5))
+        self.assertEqual(progress, [(2, 0), (4, 0), (6, 0), (6, 2), (6, 4),
+                                    (6, 5)])
+        self.assertEqual(
+            sorted(models.Message.objects.values_list('subject', flat=True)),
+            ['queued', 'recent'])
+        self.assertEqual(models.Log.objects.count(), 1)
+        self.assertEqual(retention.purge(self.before), (0, 0))
+
+    def test_archive(self):
+        path = os.path.join(self.directory, 'archive.jsonl.gz')
+        call_command('purge_mail_log', verbosity='0', archive=path)
+        call_command('purge_mail_log', verbosity='0', archive=path)
+        rows = [json.loads(line) for line in gzip.open(path)]
+        self.assertEqual([row['model'] for row in rows],
+                         ['log'] * 6 + ['message'] * 5)
+        self.assertEqual(sorted(row['fields']['subject'] for row in rows
+                                if row['model'] == 'message'),
+                         ['sent %s' % i for i in range(5)])
+        self.assert_(rows[0]['fields']['date'])
+        # The content is archived, since the bodies are purged separately.
+        for row in rows[6:]:
+            self.assert_('a test message' in row['fields']['encoded_message'])
+            self.assert_(row['fields']['subject'] in
+                         row['fields']['encoded_message'])
+        self.assertEqual(models.Message.objects.count(), 2)
+
+    def test_archive_merge(self):
+        bulk.queue_template_messages('Hello {{ name }}', 'Dear {{ name }}',
+                                     'shop@example.com',
+                                     [('ann@example.com', {'name': 'Ann'})])
+        engine.send_all()
+        old = datetime.datetime.now() - datetime.timedelta(days=100)
+        models.Message.objects.filter(to_address='ann@example.com')\
+                              .update(date_created=old)
+        models.Log.objects.filter(message__to_address='ann@example.com')\
+                          .update(date=old)
+        path = os.path.join(self.directory, 'archive.jsonl.gz')
+        self.assertEqual(retention.archive(self.before, path), 13)
+        rows = [json.loads(line) for line in gzip.open(path)]
+        fields = [row['fields'] for row in rows if row['model'] == 'message'
+                  and row['fields']['to_address'] == 'ann@example.com'][0]
+        # Mail merge messages are archived as they were rendered.
+        self.assert_('Dear Ann' in fields['encoded_message'])
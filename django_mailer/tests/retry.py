@@ -0,0 +1,85 @@
+from django.core import mail
+from django_mailer import constants, engine, models, retry
+from django_mailer.tests.base import MailerTestCase
+import datetime
+
+
+class RetryTest(MailerTestCase):
+    """
+    Tests for automatically retrying deferred messages.
+
+    """
+    def setUp(self):
+        super(RetryTest, self).setUp()
+        self.original_settings = (retry.RETRY_DELAY, retry.MAX_RETRY_DELAY,
+                                  retry.MAX_RETRIES, retry.FINAL_FAILURE)
+        retry.RETRY_DELAY = 60
+        retry.MAX_RETRY_DELAY = 600
+        retry.MAX_RETRIES = 3
+        retry.FINAL_FAILURE = 'defer'
+
+    def tearDown(self):
+        super(RetryTest, self).tearDown()
+        (retry.RETRY_DELAY, retry.MAX_RETRY_DELAY, retry.MAX_RETRIES,
+         retry.FINAL_FAILURE) = self.original_settings
+
+    def fail_all(self):
+        engine._record_many([(queued_message, constants.RESULT_FAILED, '')
+                             for queued_message in
+                             models.QueuedMessage.objects.all()])
+
+    def test_delay(self):
+        for retries, low, high in ((1, 30, 60), (2, 60, 120),
+                                   (3, 120, 240), (10, 300, 600)):
+            for i in range(20):
+                delay = retry.delay(retries)
+                self.assert_(low <= delay <= high, (retries, delay))
+
+    def test_defer(self):
+        self.queue_message()
+        queued_message = models.QueuedMessage.objects.get()
+        before = datetime.datetime.now()
+        queued_message.defer()
+        self.assertEqual(queued_message.retries, 1)
+        self.assert_(before + datetime.timedelta(seconds=30) <=
+                     queued_message.next_attempt <=
+                     datetime.datetime.now() + datetime.timedelta(seconds=60))
+        self.assertEqual(models.QueuedMessage.objects.available().count(), 0)
+
+    def test_due_messages_are_sent(self):
+        self.queue_message()
+        self.fail_all()
+        queued_message = models.QueuedMessage.objects.get()
+        self.assertEqual(queued_message.retries, 1)
+        self.assert_(queued_message.deferred)
+        self.assert_(queued_message.next_attempt > datetime.datetime.now())
+        engine.send_all()
+        self.assertEqual(len(mail.outbox), 0)
+        models.QueuedMessage.objects.update(
+            next_attempt=datetime.datetime.now())
+        engine.send_all()
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(models.QueuedMessage.objects.count(), 0)
+
+    def test_final_failure_defer(self):
+        self.queue_message()
+        models.QueuedMessage.objects.update(retries=3)
+        self.fail_all()
+        queued_message = models.QueuedMessage.objects.get()
+        self.assertEqual(queued_message.retries, 4)
+        self.assertEqual(queued_message.next_attempt, None)
+        self.assertEqual(models.QueuedMessage.objects.available().count(), 0)
+        # It can still be retried by hand.
+        models.QueuedMessage.objects.retry_deferred()
+        self.assertEqual(models.QueuedMessage.objects.available().count(), 1)
+
+    def test_final_failure_delete(self):
+        retry.FINAL_FAILURE = 'delete'
+        self.queue_message()
+        self.queue_message()
+        models.QueuedMessage.objects.filter(pk=models.QueuedMessage.objects
+                                            .all()[0].pk).update(retries=3)
+        self.fail_all()
+        self.assertEqual(models.QueuedMessage.objects.count(), 1)
+        self.assertEqual(models.Log.objects.filter(
+            result=constants.RESULT_FAILED).count(), 2)
@@ -0,0 +1,166 @@
+from django.core.mail.backends.smtp import EmailBackend
+from django.test import TestCase
+from django_mailer import constants, engine, models, smtp
+from django_mailer.tests.base import MailerTestCase, SMTPSink
+import smtplib
+import time
+
+
+class ConnectionManagerTest(MailerTestCase):
+    """
+    Tests for the persistent SMTP connection manager.
+
+    """
+    def setUp(self):
+        super(ConnectionManagerTest, self).setUp()
+        self.sink = None
+
+    def tearDown(self):
+        super(ConnectionManagerTest, self).tearDown()
+        if self.sink is not None:
+            self.sink.stop()
+
+    def manager(self, **kwargs):
+        backend = EmailBackend(host=self.sink.host, port=self.sink.port)
+        return smtp.ConnectionManager(backend, **kwargs)
+
+    def test_reconnect(self):
+        self.sink = SMTPSink(drop_after=2)
+        self.sink.start()
+        connection = self.manager(max_messages=0)
+        try:
+            for i in range(5):
+                connection.sendmail('sender@djangomailer',
+                                    ['recipient@djangomailer'],
+                                    'message %s' % i)
+        finally:
+            connection.close()
+        self.assertEqual(len(self.sink.messages), 5)
+        self.assertEqual(connection.reconnects, 2)
+
+    def test_retries_exhausted(self):
+        self.sink = SMTPSink(drop_after=1)
+        self.sink.start()
+        connection = self.manager(max_messages=0, retries=0)
+        connection.sendmail('sender@djangomailer', ['recipient@djangomailer'],
+                            'message')
+        self.assertRaises(smtp.DISCONNECTED, connection.sendmail,
+                          'sender@djangomailer', ['recipient@djangomailer'],
+                          'message')
+        self.assertFalse(connection.is_open())
+
+    def test_dropped_after_data(self):
+        for extensions in ((), ['PIPELINING'], ['CHUNKING'],
+                           ['PIPELINING', 'CHUNKING']):
+            self.sink = SMTPSink(extensions=extensions, drop_data=True)
+            self.sink.start()
+            connection = self.manager()
+            # The server may have accepted the message, so it isn't sent
+            # again.
+            try:
+                connection.sendmail('sender@djangomailer',
+                                    ['recipient@djangomailer'], 'message')
+            except smtp.DISCONNECTED, err:
+                self.assert_(err.data_sent)
+            else:
+                self.fail('The dropped session was not reported.')
+            self.assertEqual(len(self.sink.messages), 1)
+            self.assertEqual(connection.reconnects, 0)
+            self.assertFalse(connection.is_open())
+            self.sink.stop()
+            self.sink = None
+
+    def test_recycle(self):
+        self.sink = SMTPSink()
+        self.sink.start()
+        connection = self.manager(max_messages=2)
+        try:
+            for i in range(5):
+                connection.sendmail('sender@djangomailer',
+                                    ['recipient@djangomailer'],
+                                    'message %s' % i)
+        finally:
+            connection.close()
+        self.assertEqual(len(self.sink.messages), 5)
+        self.assertEqual(connection.recycled, 2)
+        self.assertEqual(connection.reconnects, 0)
+
+    def test_keepalive(self):
+        self.sink = SMTPSink()
+        self.sink.start()
+        connection = self.manager(keepalive=0.05)
+        try:
+            connection.open()
+            connection.keepalive()
+            self.assertEqual(self.sink.noops, 0)
+            time.sleep(0.1)
+            connection.keepalive()
+            self.assertEqual(self.sink.noops, 1)
+            self.assert_(connection.is_open())
+        finally:
+            connection.close()
+
+    def test_send_all(self):
+        self.sink = SMTPSink(drop_after=1)
+        self.sink.start()
+        for i in range(3):
+            self.queue_message(subject='test %s' % i)
+        connection = self.manager()
+        try:
+            engine.send_all(smtp_connection=connection)
+        finally:
+            connection.close()
+        self.assertEqual(len(self.sink.messages), 3)
+        self.assertEqual(models.Log.objects.filter(
+            result=constants.RESULT_SENT).count(), 3)
+        self.assertEqual(models.QueuedMessage.objects.count(), 0)
+
+
+class PipeliningTest(TestCase):
+    """
+    Tests for sending messages with the PIPELINING and CHUNKING extensions.
+
+    """
+    message = 'Subject: test\n\n.leading dot\nsecond line\n'
+
+    def send(self, extensions, to_addresses, **kwargs):
+        sink = SMTPSink(extensions=extensions, refuse=['refused@djangomailer'])
+        sink.start()
+        connection = smtplib.SMTP(sink.host, sink.port)
+        try:
+            refused = smtp.sendmail(connection, 'sender@djangomailer',
+                                    to_addresses, self.message, **kwargs)
+            # The session can still be used after a refused transaction.
+            smtp.sendmail(connection, 'sender@djangomailer',
+                          ['recipient@djangomailer'], self.message, **kwargs)
+        finally:
+            connection.quit()
+            sink.stop()
+        return sink, refused
+
+    def test_extensions(self):
+        expected = self.message.replace('\n', '\r\n')
+        for extensions, command in ((), 'DATA'), (['PIPELINING'], 'DATA'), \
+                (['CHUNKING'], 'BDAT'), (['PIPELINING', 'CHUNKING'], 'BDAT'):
+            sink, refused = self.send(
+                extensions, ['a@djangomailer', 'refused@djangomailer'])
+            self.assertEqual(refused, {'refused@djangomailer':
+                                       (550, 'No such user')})
+            self.assertEqual(sink.commands, [command, command])
+            self.assertEqual(sink.messages,
+                             [('sender@djangomailer', ['a@djangomailer'],
+                               expected),
+                              ('sender@djangomailer',
+                               ['recipient@djangomailer'], expected)])
+
+    def test_turned_off(self):
+        sink, refused = self.send(['PIPELINING', 'CHUNKING'],
+                                  ['a@djangomailer'], pipelining=False,
+                                  chunking=False)
+        self.assertEqual(sink.commands, ['DATA', 'DATA'])
+
+    def test_all_refused(self):
+        for extensions in ((), ['PIPELINING'], ['CHUNKING'],
+                           ['PIPELINING', 'CHUNKING']):
+            self.assertRaises(smtplib.SMTPRecipientsRefused, self.send,
+                              extensions, ['refused@djangomailer'])
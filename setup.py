@@ -17,6 +17,8 @@ setup(
         'django_mailer.management.commands',
         'django_mailer.tests',
     ],
+    package_data={'django_mailer': ['sql/*.sql',
+                                    'templates/admin/django_mailer/*.html']},
     classifiers=[
         'Development Status :: 4 - Beta',
         'Environment :: Web Environment',